@@ -0,0 +1,107 @@
+"""
+Benchmark of bulk_update_segments(), used by the query page's bulk actions (mark_verified, set_60mhz, set_300mhz).
+
+Compares the previous implementation (load every segment and modify it through the ORM) with the set-based bulk update,
+checks that both leave the same film_segment_version rows, and checks that bulk_update_job() (which runs outside of a
+request, so continuum can't find the user itself) records the user and address it is given on the transaction of every
+version row it writes. Run from the repository root:
+
+    python -m benchmarks.bulk_update_benchmark --segments 10000
+
+Set BENCH_DATABASE_URL to run against PostgreSQL.
+"""
+import os
+import time
+import argparse
+from datetime import datetime
+
+import sqlalchemy as sa
+
+from explore_app import db
+from benchmarks.synthetic_db import make_app, seed_segments
+
+NOTE = 'Updated by bulk_update_benchmark'  # The change made to every updated segment
+
+
+def orm_update(ids):
+    """ The previous bulk action loop """
+    from explore_app.film_segment import FilmSegment
+
+    for seg in FilmSegment.query.filter(FilmSegment.id.in_(ids)).all():
+        seg.notes = NOTE
+    db.session.commit()
+
+
+def set_based_update(ids):
+    from explore_app.api.bulk_update import bulk_update_segments
+
+    bulk_update_segments(db.session, [(seg_id, {'notes': NOTE}) for seg_id in ids])
+    db.session.commit()
+
+
+def version_rows():
+    from sqlalchemy_continuum import version_class
+    from explore_app.film_segment import FilmSegment
+
+    table = version_class(FilmSegment).__table__
+    columns = [c for c in table.columns if c.name != 'last_changed']  # Set to the time of seeding
+    return db.session.execute(sa.select(*columns).order_by(table.c.id, table.c.transaction_id)).all()
+
+
+def timed_run(app, n_segments, update, ids):
+    with app.app_context():
+        seed_segments(n_segments)
+        t = time.perf_counter()
+        update(ids)
+        elapsed = time.perf_counter() - t
+        return elapsed, version_rows()
+
+
+def check_job_metadata(app, n_segments, ids):
+    """ Returns the number of version rows written by bulk_update_job() that don't carry its user and address """
+    from sqlalchemy_continuum import version_class, versioning_manager
+    from explore_app.film_segment import FilmSegment
+    from explore_app.user import User
+    from explore_app.api.bulk_update import bulk_update_job
+
+    with app.app_context():
+        seed_segments(n_segments)
+        user = User(first_name='Bench', last_name='Mark', email='bench@example.com', password='x',
+                    created_on=datetime.now())
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+        os.environ['DATABASE_URL'] = str(db.engine.url.render_as_string(hide_password=False))
+        bulk_update_job([(seg_id, {'notes': NOTE}) for seg_id in ids], user_id=user_id,
+                        remote_addr='192.0.2.1')
+
+        versions = version_class(FilmSegment).__table__
+        transactions = versioning_manager.transaction_cls.__table__
+        rows = db.session.execute(sa.select(transactions.c.user_id, transactions.c.remote_addr).select_from(
+            versions.join(transactions, versions.c.transaction_id == transactions.c.id))).all()
+
+    return len(rows), sum(1 for row in rows if tuple(row) != (user_id, '192.0.2.1'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--segments', type=int, default=10000)
+    parser.add_argument('--updated', type=int, default=5000, help="Number of segments to update")
+    args = parser.parse_args()
+
+    app = make_app()
+    ids = list(range(1, min(args.updated, args.segments) + 1))
+
+    print(f"Updating {len(ids)} of {args.segments} segments...")
+    orm_time, orm_rows = timed_run(app, args.segments, orm_update, ids)
+    bulk_time, bulk_rows = timed_run(app, args.segments, set_based_update, ids)
+
+    mismatches = sum(1 for a, b in zip(orm_rows, bulk_rows) if tuple(a) != tuple(b)) + abs(len(orm_rows) -
+                                                                                            len(bulk_rows))
+    print(f"Version row mismatches between implementations: {mismatches}")
+    print(f"ORM objects: {orm_time:.2f} s")
+    print(f"  set-based: {bulk_time:.2f} s")
+
+    n_rows, n_missing = check_job_metadata(app, args.segments, ids)
+    print(f"Version rows written by bulk_update_job() without its user and address: {n_missing} of {n_rows}")
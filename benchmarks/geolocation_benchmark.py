@@ -0,0 +1,117 @@
+"""
+Benchmark of segment_geolocation(), which geolocates a batch of segments with whole-array operations per flight line.
+
+Compares it with a straightforward per-segment loop over the track points (like the browser-side highlighting on the
+flight pages does), checks that both give the same results (and that the positions in exports, from
+segment_positions(), are the same start and end positions), and reports the time per segment. Segments are random CBD
+ranges on the flight lines in the repository's positioning directories. Run from the repository root:
+
+    python -m benchmarks.geolocation_benchmark --segments 100000
+"""
+import os
+import time
+import random
+import argparse
+
+import numpy as np
+
+from explore_app.main.map import load_flight_lines
+from explore_app.main.positioning import GEOLOCATION_FIELDS, track_finder, segment_geolocation, \
+    segment_positions, haversine
+
+DATASETS = {
+    'antarctica': os.environ.get('ANTARCTICA_FLIGHT_POSITIONING_DIR', 'antarctica_original_positioning'),
+    'greenland': os.environ.get('GREENLAND_FLIGHT_POSITIONING_DIR', 'greenland_positioning')
+}
+
+
+def per_segment(track, first_cbd, last_cbd):
+    """ Geolocation of one segment by walking over the track points """
+    cbd, lat, lon = track['cbd'], track['latitude'], track['longitude']
+    res = dict.fromkeys(GEOLOCATION_FIELDS, np.nan)
+    lo, hi = min(first_cbd, last_cbd), max(first_cbd, last_cbd)
+
+    def point(c, values):
+        return np.interp(c, cbd, values) if cbd[0] <= c <= cbd[-1] else np.nan
+
+    res['start_lat'], res['start_lon'] = point(first_cbd, lat), point(first_cbd, lon)
+    res['end_lat'], res['end_lon'] = point(last_cbd, lat), point(last_cbd, lon)
+
+    inside = [i for i in range(len(cbd)) if lo <= cbd[i] <= hi]
+    if cbd[0] <= lo and hi <= cbd[-1]:
+        path = [(lat[i], lon[i]) for i in inside]
+        if lo not in cbd:
+            path.insert(0, (point(lo, lat), point(lo, lon)))
+        if hi not in cbd:
+            path.append((point(hi, lat), point(hi, lon)))
+        if len(path) == 1:
+            path.append(path[0])
+        res['length_m'] = sum(float(haversine(*a, *b)) for a, b in zip(path[:-1], path[1:]))
+
+    lats = [lat[i] for i in inside] + [v for v in (res['start_lat'], res['end_lat']) if not np.isnan(v)]
+    xs = [track['x'][i] for i in inside] + [point(c, track['x']) for c in (first_cbd, last_cbd)]
+    ys = [track['y'][i] for i in inside] + [point(c, track['y']) for c in (first_cbd, last_cbd)]
+    xs, ys = [v for v in xs if not np.isnan(v)], [v for v in ys if not np.isnan(v)]
+    lons = [lon[i] for i in inside] + [v for v in (res['start_lon'], res['end_lon']) if not np.isnan(v)]
+    if lats:
+        res['min_lat'], res['max_lat'] = min(lats), max(lats)
+        res['min_x'], res['max_x'], res['min_y'], res['max_y'] = min(xs), max(xs), min(ys), max(ys)
+        lons360 = [v % 360 for v in lons]
+        if max(lons) - min(lons) > 180 and max(lons360) - min(lons360) < max(lons) - min(lons):
+            res['min_lon'], res['max_lon'] = [(v + 180) % 360 - 180 for v in (min(lons360), max(lons360))]
+        else:
+            res['min_lon'], res['max_lon'] = min(lons), max(lons)
+
+    thickness = [track['thickness'][i] for i in inside if not np.isnan(track['thickness'][i])]
+    if thickness:
+        res['mean_thickness'] = np.mean(thickness)
+    return res
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark batch geolocation of segments")
+    parser.add_argument('--segments', type=int, default=100000, help="Number of segments to geolocate")
+    parser.add_argument('--loop_segments', type=int, default=2000, help="Number of segments for the per-segment loop")
+    args = parser.parse_args()
+
+    flight_lines = {dataset: load_flight_lines(d, dataset) for dataset, d in DATASETS.items()}
+    get_track = track_finder(flight_lines)
+
+    # Random segments on random flight lines (some partly or entirely off the end of their track)
+    rng = random.Random(0)
+    keys = [(dataset, flight, year) for dataset in flight_lines for (flight, year) in flight_lines[dataset]]
+    segments = []
+    for _ in range(args.segments):
+        dataset, flight, year = rng.choice(keys)
+        cbd = flight_lines[dataset][(flight, year)]['CBD']
+        first = rng.uniform(cbd.min() - 20, cbd.max() + 20)
+        segments.append((dataset, flight, None if year is None else 1900 + year, round(first),
+                         round(first + rng.choice([-1, 1]) * rng.uniform(0, 60))))
+    columns = list(zip(*segments))
+
+    for dataset, flight, year in keys:
+        get_track(dataset, flight, year)  # Build every track up front, so only the geolocation is timed
+
+    t_start = time.time()
+    geo = segment_geolocation(get_track, *columns)
+    t_vectorized = (time.time() - t_start) / len(segments)
+
+    n = min(args.loop_segments, len(segments))
+    t_start = time.time()
+    expected = [per_segment(get_track(ds, f, d), c1, c2) for ds, f, d, c1, c2 in segments[:n]]
+    t_loop = (time.time() - t_start) / n
+
+    n_mismatches = 0
+    for field in GEOLOCATION_FIELDS:
+        e = np.array([r[field] for r in expected])
+        if not np.allclose(geo[field][:n], e, rtol=1e-9, atol=1e-6, equal_nan=True):
+            n_mismatches += 1
+            print(f"Mismatch in {field}")
+    print(f"Fields that differ from the per-segment loop: {n_mismatches}")
+    print(f"Per-segment loop: {1e6 * t_loop:.1f} us per segment")
+    print(f"      Vectorized: {1e6 * t_vectorized:.2f} us per segment ({len(segments)} segments)")
+
+    positions = segment_positions(get_track, *columns)
+    n_differ = sum(not np.array_equal(p, geo[field], equal_nan=True)
+                   for p, field in zip(positions, ['start_lat', 'start_lon', 'end_lat', 'end_lon']))
+    print(f"Export position fields that differ from the geolocation: {n_differ}")
@@ -0,0 +1,118 @@
+"""
+Benchmark of the hot film_segment query patterns with and without the indexes from migration 5c1f3e9a7b2d.
+
+Seeds a synthetic table, then for each query pattern prints the query plan (EXPLAIN QUERY PLAN on SQLite, EXPLAIN
+ANALYZE on PostgreSQL) and the median latency, first without the indexes and then with them. Run from the
+repository root:
+
+    python -m benchmarks.index_benchmark --segments 100000
+
+Set BENCH_DATABASE_URL to run against PostgreSQL (recommended - production runs on PostgreSQL).
+"""
+import time
+import random
+import argparse
+import statistics
+from types import SimpleNamespace
+
+import sqlalchemy as sa
+
+from explore_app import db
+from benchmarks.synthetic_db import make_app, seed_segments
+
+
+def hot_queries(seg):
+    """ Statements for each hot query pattern, built around an existing segment """
+    from explore_app.film_segment import FilmSegment, neighbor_columns
+
+    src = SimpleNamespace(reel=seg.reel, scope_type=seg.scope_type, flight=seg.flight,
+                          first_frame=seg.first_frame, last_frame=seg.last_frame,
+                          first_cbd=seg.first_cbd, last_cbd=seg.last_cbd)
+    year = 78
+
+    return {
+        'neighbors (add_next_previous)': sa.select(*neighbor_columns(src, FilmSegment.query)),
+        'flight segments (flight page)':
+            FilmSegment.query.filter(FilmSegment.dataset == seg.dataset, FilmSegment.flight == seg.flight).statement,
+        'flight segments by year (make_cbd_plot)':
+            FilmSegment.query.filter(FilmSegment.dataset == 'greenland', FilmSegment.flight == seg.flight,
+                                     FilmSegment.raw_date % 100 == year).statement,
+        'flight progress count (stats)':
+            FilmSegment.query.filter(FilmSegment.dataset == 'greenland', FilmSegment.flight == seg.flight,
+                                     FilmSegment.raw_date == 10000 + year, FilmSegment.is_junk == False)
+            .with_entities(sa.func.count()).statement,
+        'keyset page by CBD (query pages)':
+            FilmSegment.query.filter(sa.tuple_(FilmSegment.first_cbd, FilmSegment.id) > (seg.first_cbd, seg.id))
+            .order_by(FilmSegment.first_cbd, FilmSegment.id).limit(10).statement,
+        'path lookup (importers)': FilmSegment.query.filter(FilmSegment.path == seg.path).statement,
+    }
+
+
+def explain(statement):
+    dialect = db.engine.dialect.name
+    sql = str(statement.compile(db.engine, compile_kwargs={"literal_binds": True}))
+    if dialect == 'postgresql':
+        rows = db.session.execute(sa.text(f"EXPLAIN (ANALYZE, BUFFERS) {sql}")).fetchall()
+        return '\n'.join(r[0] for r in rows)
+    elif dialect == 'sqlite':
+        rows = db.session.execute(sa.text(f"EXPLAIN QUERY PLAN {sql}")).fetchall()
+        return '\n'.join(r[-1] for r in rows)
+    else:
+        return '(EXPLAIN not supported for this database)'
+
+
+def median_latency(statement, repeats):
+    times = []
+    for _ in range(repeats):
+        t_start = time.time()
+        db.session.execute(statement).fetchall()
+        times.append(time.time() - t_start)
+    return statistics.median(times)
+
+
+def run_all(queries, repeats, show_plans):
+    results = {}
+    for name, statement in queries.items():
+        results[name] = median_latency(statement, repeats)
+        if show_plans:
+            print(f"--- {name} ({1000 * results[name]:.2f} ms)")
+            print(explain(statement))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark hot film_segment queries with and without indexes")
+    parser.add_argument('--segments', type=int, default=100000, help="Number of synthetic segments")
+    parser.add_argument('--repeats', type=int, default=20, help="Runs of each query (the median is reported)")
+    parser.add_argument('--no_plans', action='store_true', help="Don't print query plans")
+    args = parser.parse_args()
+
+    app = make_app()
+    with app.app_context():
+        from explore_app.film_segment import FilmSegment
+
+        print(f"Seeding {args.segments} segments...")
+        seed_segments(args.segments)
+        indexes = list(FilmSegment.__table__.indexes)
+
+        seg = db.session.get(FilmSegment, random.Random(2).randint(1, args.segments))
+        queries = hot_queries(seg)
+        db.session.commit()  # So that the session sees the schema changes below
+
+        with db.engine.begin() as conn:
+            for idx in indexes:
+                idx.drop(conn)
+        print("\n===== Without indexes =====")
+        before = run_all(queries, args.repeats, not args.no_plans)
+        db.session.commit()
+
+        with db.engine.begin() as conn:
+            for idx in indexes:
+                idx.create(conn)
+            conn.execute(sa.text("ANALYZE film_segment" if db.engine.dialect.name == 'postgresql' else "ANALYZE"))
+        print("\n===== With indexes =====")
+        after = run_all(queries, args.repeats, not args.no_plans)
+
+        print(f"\n{'query':>42} {'before':>10} {'after':>10}")
+        for name in queries:
+            print(f"{name:>42} {1000 * before[name]:>8.2f}ms {1000 * after[name]:>8.2f}ms")
@@ -0,0 +1,77 @@
+"""
+Benchmark of the flight line simplification used for the maps. For the overview map of each dataset and for a single
+flight's map, compares every positioning point (tolerance 0) with the simplified levels: number of points drawn, size of
+the embedded Bokeh script (plain and gzipped), and the time to build and serialize the map. Also checks that every
+original point is within the tolerance of its simplified line. Run from the repository root:
+
+    python -m benchmarks.map_lod_benchmark
+
+Browser rendering time isn't measured, but it scales with the number of points drawn and the size of the document
+the browser has to parse.
+"""
+import os
+import gzip
+import time
+import argparse
+
+import numpy as np
+from flask import Flask
+from bokeh.embed import components
+
+from explore_app.main.map import load_flight_lines, make_bokeh_map, map_line_data, segment_distances
+
+DATASETS = {
+    'antarctica': os.environ.get('ANTARCTICA_FLIGHT_POSITIONING_DIR', 'antarctica_original_positioning'),
+    'greenland': os.environ.get('GREENLAND_FLIGHT_POSITIONING_DIR', 'greenland_positioning')
+}
+
+
+def max_deviation(df, tolerance):
+    """ Largest distance of a point of flight line df from the line simplified with tolerance """
+    x, y = df['X'].to_numpy(), df['Y'].to_numpy()
+    keep = np.flatnonzero(df['LOD'].to_numpy() >= tolerance)
+    deviation = 0.0
+    for i, j in zip(keep[:-1], keep[1:]):
+        if j - i > 1:
+            deviation = max(deviation, segment_distances(x[i+1:j], y[i+1:j], x[i], y[i], x[j], y[j]).max())
+    return deviation
+
+
+def measure(label, **kwargs):
+    t_start = time.time()
+    m = make_bokeh_map(800, 800, return_components=True, **kwargs)
+    script, _ = components({k: m[k] for k in ['map', 'color_bar', 'tile_select', 'date_select']})
+    t = time.time() - t_start
+    n_points = sum(len(s.data['X']) for s in m['data_sources'])
+    print(f"{label:>24}: {n_points:6d} points, {len(script) / 1e6:6.2f} MB script, "
+          f"{len(gzip.compress(script.encode())) / 1e6:5.2f} MB gzipped, {1000 * t:6.0f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark map flight line simplification")
+    parser.add_argument('--flight', type=int, default=127, help="Antarctic flight to use for the single flight map")
+    parser.add_argument('--tolerances', type=float, nargs='+', default=[50, 500],
+                        help="Tolerances (m) to compare with the full flight lines (defaults are the config defaults)")
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config['COLOR_ACCENT'] = '#b1040e'
+    levels = [0] + args.tolerances
+
+    with app.app_context():
+        for dataset, positioning_dir in DATASETS.items():
+            t_start = time.time()
+            flight_lines = load_flight_lines(positioning_dir, dataset)
+            print(f"{dataset} (loaded and simplified in {time.time() - t_start:.2f} s)")
+            for tolerance in levels:
+                worst = max(max_deviation(df, tolerance) for df in flight_lines.values())
+                if worst > tolerance:
+                    print(f"Deviation of {worst:.1f} m is over the tolerance of {tolerance} m")
+                measure(f"overview, {tolerance:g} m", flight_lines=flight_lines, dataset=dataset, tolerance=tolerance)
+                if dataset == 'antarctica':
+                    measure(f"flight {args.flight}, {tolerance:g} m", flight_lines=flight_lines, dataset=dataset,
+                            flight_id=args.flight, tolerance=tolerance)
+
+            # Every original CBD is still known: the CBDs kept at any level are a subset of the flight line's
+            for df in flight_lines.values():
+                assert set(map_line_data(df, levels[-1])['CBD']) <= set(df['CBD'])
@@ -0,0 +1,73 @@
+"""
+Benchmark of serving the overview map. Compares rendering the map's Bokeh components on every request (what /map used
+to do) with serving the script of a RenderedMap, and reports the time per request and bytes sent for each content
+encoding. Requests go through a minimal Flask app's test client, so the times don't include the network or page
+template. Run from the repository root:
+
+    python -m benchmarks.map_page_benchmark --dataset antarctica
+"""
+import os
+import time
+import argparse
+import statistics
+
+from flask import Flask, Response, request
+from bokeh.embed import components
+
+from explore_app.main.map import load_flight_lines, make_bokeh_map
+from explore_app.main.map_cache import RenderedMap
+
+DATASETS = {
+    'antarctica': os.environ.get('ANTARCTICA_FLIGHT_POSITIONING_DIR', 'antarctica_original_positioning'),
+    'greenland': os.environ.get('GREENLAND_FLIGHT_POSITIONING_DIR', 'greenland_positioning')
+}
+
+
+def time_requests(client, url, n, headers=None):
+    times = []
+    for _ in range(n):
+        t_start = time.perf_counter()
+        r = client.get(url, headers=headers or {})
+        times.append(time.perf_counter() - t_start)
+    return statistics.median(times), len(r.data)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark serving the overview map")
+    parser.add_argument('--dataset', default='antarctica', choices=list(DATASETS))
+    parser.add_argument('--tolerance', type=float, default=500, help="Flight line simplification tolerance (m)")
+    parser.add_argument('--requests', type=int, default=20, help="Requests to time for each case")
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config['COLOR_ACCENT'] = '#b1040e'
+    flight_lines = load_flight_lines(DATASETS[args.dataset], args.dataset)
+
+    with app.app_context():
+        m = make_bokeh_map(800, 800, flight_lines=flight_lines, return_components=True, dataset=args.dataset,
+                           tolerance=args.tolerance)
+        models = {k: m[k] for k in ['map', 'color_bar', 'tile_select', 'date_select']}
+
+        t_start = time.perf_counter()
+        rendered = RenderedMap.render(models)
+        print(f"Rendering once (with compressed copies): {1000 * (time.perf_counter() - t_start):.0f} ms")
+
+    @app.route('/per_request')
+    def per_request():
+        script, divs = components(models)
+        return script + ''.join(divs.values())
+
+    @app.route('/cached.js')
+    def cached():
+        encoding = rendered.script_encoding(request.accept_encodings)
+        response = Response(rendered.scripts[encoding], mimetype='text/javascript')
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+    client = app.test_client()
+    t, size = time_requests(client, '/per_request', args.requests)
+    print(f"   Rendered per request: {1000 * t:8.2f} ms, {size / 1e3:6.0f} kB")
+    for encoding in ['identity', 'gzip', 'br']:
+        t, size = time_requests(client, '/cached.js', 10 * args.requests, {'Accept-Encoding': encoding})
+        print(f"{'Cached, ' + encoding:>23}: {1000 * t:8.2f} ms, {size / 1e3:6.0f} kB")
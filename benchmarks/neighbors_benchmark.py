@@ -0,0 +1,84 @@
+"""
+Benchmark of the next/previous segment lookup done by every GET /api/segments/<id>.
+
+Compares the previous implementation (four separate ordered queries) with the current single query, and checks that
+both find the same neighbors. Run from the repository root:
+
+    python -m benchmarks.neighbors_benchmark --segments 100000 --lookups 500
+
+Set BENCH_DATABASE_URL to run against PostgreSQL, where the difference in round trips matters most.
+"""
+import time
+import random
+import argparse
+from types import SimpleNamespace
+
+from sqlalchemy import select
+
+from explore_app import db
+from benchmarks.synthetic_db import make_app, seed_segments
+
+
+def four_queries(seg):
+    """ The previous add_next_previous(), one round trip per neighbor """
+    from explore_app.film_segment import FilmSegment
+    res = {}
+
+    prev_frame = min(seg.first_frame, seg.last_frame) - 1
+    next_frame = max(seg.first_frame, seg.last_frame) + 1
+    same_reel = (FilmSegment.reel == seg.reel) & (FilmSegment.scope_type == seg.scope_type)
+    res['next_by_frame'] = FilmSegment.query.filter(
+        (FilmSegment.first_frame >= next_frame) & (FilmSegment.last_frame >= next_frame) & same_reel
+    ).order_by(FilmSegment.first_frame.asc(), FilmSegment.id).first()
+    res['prev_by_frame'] = FilmSegment.query.filter(
+        (FilmSegment.first_frame <= prev_frame) & (FilmSegment.last_frame <= prev_frame) & same_reel
+    ).order_by(FilmSegment.first_frame.desc(), FilmSegment.id.desc()).first()
+
+    prev_cbd = min(seg.first_cbd, seg.last_cbd) - 1
+    next_cbd = max(seg.first_cbd, seg.last_cbd) + 1
+    same_flight = (FilmSegment.flight == seg.flight) & (FilmSegment.scope_type == seg.scope_type)
+    res['next_by_cbd'] = FilmSegment.query.filter(
+        (FilmSegment.first_cbd >= next_cbd) & (FilmSegment.last_cbd >= next_cbd) & same_flight
+    ).order_by(FilmSegment.first_cbd.asc(), FilmSegment.id).first()
+    res['prev_by_cbd'] = FilmSegment.query.filter(
+        (FilmSegment.first_cbd <= prev_cbd) & (FilmSegment.last_cbd <= prev_cbd) & same_flight
+    ).order_by(FilmSegment.first_cbd.desc(), FilmSegment.id.desc()).first()
+
+    return {k: v.id for k, v in res.items() if v is not None}
+
+
+def one_query(seg):
+    """ The current add_next_previous() """
+    from explore_app.film_segment import FilmSegment, NEIGHBOR_FIELDS, neighbor_columns
+    src = SimpleNamespace(reel=seg.reel, scope_type=seg.scope_type, flight=seg.flight,
+                          first_frame=seg.first_frame, last_frame=seg.last_frame,
+                          first_cbd=seg.first_cbd, last_cbd=seg.last_cbd)
+    neighbors = db.session.execute(select(*neighbor_columns(src, FilmSegment.query))).one()
+    return {k: v for k, v in zip(NEIGHBOR_FIELDS, neighbors) if v is not None}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the next/previous segment lookup")
+    parser.add_argument('--segments', type=int, default=100000, help="Number of synthetic segments")
+    parser.add_argument('--lookups', type=int, default=500, help="Number of segments to look up neighbors for")
+    args = parser.parse_args()
+
+    app = make_app()
+    with app.app_context():
+        from explore_app.film_segment import FilmSegment
+
+        print(f"Seeding {args.segments} segments...")
+        seed_segments(args.segments)
+
+        ids = random.Random(1).sample(range(1, args.segments + 1), args.lookups)
+        segs = [db.session.get(FilmSegment, i) for i in ids]
+
+        n_mismatches = sum(four_queries(seg) != one_query(seg) for seg in segs)
+        print(f"Neighbor mismatches between implementations: {n_mismatches}")
+
+        for name, f in [('four queries', four_queries), ('one query', one_query)]:
+            t_start = time.time()
+            for seg in segs:
+                f(seg)
+            elapsed = time.time() - t_start
+            print(f"{name:>12}: {1000 * elapsed / len(segs):.2f} ms per request")
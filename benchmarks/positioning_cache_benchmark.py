@@ -0,0 +1,79 @@
+"""
+Benchmark of loading the flight positioning data at process startup, directly from the CSVs (parsing and projecting
+every file) and from the binary positioning cache. Also checks that the cached flight lines are identical to the ones
+loaded from the CSVs. Run from the repository root:
+
+    python -m benchmarks.positioning_cache_benchmark
+
+Positioning directories come from ANTARCTICA_FLIGHT_POSITIONING_DIR and GREENLAND_FLIGHT_POSITIONING_DIR, defaulting
+to the copies in the repository.
+"""
+import os
+import sys
+import time
+import tempfile
+import argparse
+import subprocess
+import statistics
+
+import pandas as pd
+
+from explore_app.main.map import load_flight_lines
+from explore_app.main.positioning_cache import build_positioning_cache, load_cached_flight_lines
+
+DATASETS = {
+    'antarctica': os.environ.get('ANTARCTICA_FLIGHT_POSITIONING_DIR', 'antarctica_original_positioning'),
+    'greenland': os.environ.get('GREENLAND_FLIGHT_POSITIONING_DIR', 'greenland_positioning')
+}
+
+# Time and peak memory of a fresh process loading both datasets, as a worker does when it starts
+STARTUP_SCRIPT = """
+import sys, time, resource
+t_start = time.time()
+from explore_app.main.positioning_cache import load_cached_flight_lines
+t_import = time.time()
+for dataset, positioning_dir in {datasets!r}.items():
+    load_cached_flight_lines(positioning_dir, dataset, sys.argv[1])
+print(t_import - t_start, time.time() - t_import, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def fresh_process(cache_dir):
+    out = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT.format(datasets=DATASETS), cache_dir],
+                         capture_output=True, text=True, check=True).stdout
+    t_import, t_load, maxrss = out.strip().split('\n')[-1].split()
+    return float(t_import), float(t_load), int(maxrss) / 1024
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark loading flight positioning data")
+    parser.add_argument('--repeats', type=int, default=5, help="Number of fresh processes per method")
+    args = parser.parse_args()
+
+    cache_dir = tempfile.mkdtemp(prefix='rfs_positioning_cache_')
+
+    n_mismatches = 0
+    for dataset, positioning_dir in DATASETS.items():
+        t_start = time.time()
+        build_positioning_cache(positioning_dir, dataset, cache_dir)
+        print(f"Built {dataset} cache in {time.time() - t_start:.2f} s")
+
+        direct = load_flight_lines(positioning_dir, dataset)
+        cached = load_cached_flight_lines(positioning_dir, dataset, cache_dir)
+        n_mismatches += (list(direct) != list(cached))
+        for k in direct:
+            try:
+                pd.testing.assert_frame_equal(direct[k], cached[k])
+            except AssertionError as e:
+                print(f"{dataset} {k}: {e}")
+                n_mismatches += 1
+    print(f"Flight line mismatches between CSV and cache: {n_mismatches}")
+
+    cache_size = sum(os.path.getsize(os.path.join(cache_dir, f)) for f in os.listdir(cache_dir))
+    print(f"Cache size: {cache_size / 1e6:.1f} MB")
+
+    for name, d in [('CSV', ''), ('cache', cache_dir)]:
+        runs = [fresh_process(d) for _ in range(args.repeats)]
+        print(f"{name:>6}: imports {statistics.median(r[0] for r in runs):.2f} s, "
+              f"loading {1000 * statistics.median(r[1] for r in runs):.0f} ms, "
+              f"peak RSS {statistics.median(r[2] for r in runs):.0f} MB")
@@ -0,0 +1,133 @@
+"""
+Checks and benchmarks explore_app/main/projection.py, the numpy polar stereographic projection used in place of
+cartopy to project the positioning data.
+
+- Test vectors: the worked example from IOGP Guidance Note 7-2 and points projected with the cartopy CRSs previously
+  used for the maps must agree to better than 0.1 mm, and must round trip through inverse(). With cartopy installed,
+  random points are also compared against it directly.
+- Import time of the projection module and of cartopy.crs, each in a fresh process.
+- Throughput of forward() and inverse() (and of cartopy's transform_points, if installed).
+
+Run from the repository root:
+
+    python -m benchmarks.projection_benchmark
+"""
+import sys
+import time
+import argparse
+import subprocess
+import statistics
+
+import numpy as np
+
+from explore_app.main.projection import PolarStereographic, EPSG_3031, EPSG_3413
+
+TOLERANCE = 1e-4  # metres
+
+# IOGP Guidance Note 7-2, Polar Stereographic (variant B) example: WGS 84, latitude of true scale 71°S, longitude of
+# origin 70°E, false easting and northing 6,000,000 m
+EPSG_EXAMPLE = (PolarStereographic(lat_ts=-71, lon_0=70, false_easting=6000000, false_northing=6000000),
+                120, -75, 7255380.79, 7053389.56)
+
+# (projection, lon, lat, x, y), with x and y from cartopy 0.26 (Stereographic(central_latitude=-90,
+# true_scale_latitude=-71) and Stereographic(central_latitude=90, central_longitude=-45, true_scale_latitude=70))
+PROJECTIONS = {'EPSG_3031': EPSG_3031, 'EPSG_3413': EPSG_3413}
+CARTOPY_VECTORS = [
+    ('EPSG_3031', 0, -90, 0.0, 0.0),
+    ('EPSG_3031', 0, -71, 0.0, 2082760.1085429136),
+    ('EPSG_3031', -115.0904, -86.09959, -383942.5695614982, -179773.40174199568),
+    ('EPSG_3031', 67.7166666666667, -48.81, 4322047.794579161, 1771132.4518968137),
+    ('EPSG_3031', 150, -65.5, 1350831.3807926115, -2339708.5839912244),
+    ('EPSG_3031', -60, -77.25, -1204496.4116696292, 695416.327515399),
+    ('EPSG_3031', 179.999, -60, 58.174163190451154, -3333134.0271226107),
+    ('EPSG_3413', -45, 90, 0.0, 0.0),
+    ('EPSG_3413', -45, 70, 0.0, -2187927.649279021),
+    ('EPSG_3413', -40.5, 72.58, 149162.22588977878, -1895285.7810590684),
+    ('EPSG_3413', -68.7, 76.53, -589116.9172932155, -1342045.7969857876),
+    ('EPSG_3413', -20.1, 61.0, 1350520.055263041, -2909446.4019803572),
+    ('EPSG_3413', 135, 85, 6.637177851507515e-11, 541966.700613481),
+    ('EPSG_3413', 0, 60, 2349829.162339975, -2349829.1623399756),
+]
+
+
+def cartopy_crs():
+    try:
+        from cartopy import crs
+    except ImportError:
+        return None
+    return {
+        'EPSG_3031': crs.Stereographic(central_latitude=-90, true_scale_latitude=-71),
+        'EPSG_3413': crs.Stereographic(central_latitude=90, central_longitude=-45, true_scale_latitude=70),
+        'lonlat': crs.PlateCarree()
+    }
+
+
+def check_vector(proj, lon, lat, x, y, tolerance):
+    px, py = proj.forward(lon, lat)
+    ilon, ilat = proj.inverse(px, py)
+    dlon = 0 if abs(lat) == 90 else abs((ilon - lon + 180) % 360 - 180)  # Longitude is arbitrary at the poles
+    ok = (abs(px - x) < tolerance) and (abs(py - y) < tolerance) and (dlon < 1e-9) and (abs(ilat - lat) < 1e-9)
+    if not ok:
+        print(f"  FAILED: ({lon}, {lat}) -> ({px}, {py}), expected ({x}, {y}); inverse gives ({ilon}, {ilat})")
+    return ok
+
+
+def import_time(module):
+    # explore_app itself (Flask, SQLAlchemy, ...) is imported first, since every process loads it anyway
+    script = f"import time, explore_app; t = time.time(); import {module}; print(time.time() - t)"
+    out = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True)
+    return float(out.stdout) if out.returncode == 0 else None
+
+
+def throughput(f, n_points, repeats=5):
+    times = []
+    for _ in range(repeats):
+        t_start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t_start)
+    return n_points / min(times) / 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check and benchmark the polar stereographic projection")
+    parser.add_argument('--points', type=int, default=1000000, help="Number of points for the throughput benchmark")
+    args = parser.parse_args()
+
+    ref = cartopy_crs()
+
+    print("Test vectors:")
+    n_failed = 0
+    proj, lon, lat, x, y = EPSG_EXAMPLE
+    n_failed += not check_vector(proj, lon, lat, x, y, 0.005)  # The example is given to the centimetre
+    for name, lon, lat, x, y in CARTOPY_VECTORS:
+        n_failed += not check_vector(PROJECTIONS[name], lon, lat, x, y, TOLERANCE)
+    print(f"  {n_failed} of {len(CARTOPY_VECTORS) + 1} failed")
+
+    rng = np.random.default_rng(0)
+    points = {
+        'EPSG_3031': (rng.uniform(-180, 180, args.points), rng.uniform(-90, -40, args.points)),
+        'EPSG_3413': (rng.uniform(-180, 180, args.points), rng.uniform(50, 90, args.points))
+    }
+
+    if ref is not None:
+        print("Random points compared with cartopy (max difference):")
+        for name, (lon, lat) in points.items():
+            expected = ref[name].transform_points(ref['lonlat'], lon, lat)
+            x, y = PROJECTIONS[name].forward(lon, lat)
+            print(f"  {name}: {max(np.max(np.abs(x - expected[:, 0])), np.max(np.abs(y - expected[:, 1]))):.2e} m")
+    else:
+        print("cartopy isn't installed, skipping the comparison of random points")
+
+    print("Import time (fresh process, on top of explore_app):")
+    for module in ['explore_app.main.projection', 'cartopy.crs']:
+        times = [import_time(module) for _ in range(3)]
+        print(f"  {module}: " + ("not installed" if None in times else f"{1000 * statistics.median(times):.0f} ms"))
+
+    print(f"Throughput ({args.points} points, million points per second):")
+    lon, lat = points['EPSG_3031']
+    x, y = EPSG_3031.forward(lon, lat)
+    print(f"  forward: {throughput(lambda: EPSG_3031.forward(lon, lat), args.points):.1f}")
+    print(f"  inverse: {throughput(lambda: EPSG_3031.inverse(x, y), args.points):.1f}")
+    if ref is not None:
+        print(f"  cartopy transform_points: "
+              f"{throughput(lambda: ref['EPSG_3031'].transform_points(ref['lonlat'], lon, lat), args.points):.1f}")
@@ -0,0 +1,53 @@
+"""
+Benchmark recording the full id list of a query, as done on every /query page load.
+
+Compares hydrating a full FilmSegment object per matching row (the old behavior), an id-only projection, and
+recording just the filter spec (the current behavior, where ids are only resolved when a bulk action needs them).
+
+Run from the repository root:
+
+    python -m benchmarks.query_ids_benchmark --segments 100000
+"""
+import time
+import argparse
+
+from explore_app import db
+from benchmarks.synthetic_db import make_app, seed_segments
+
+
+def best_of(f, repeats):
+    times = []
+    for _ in range(repeats):
+        t_start = time.time()
+        f()
+        times.append(time.time() - t_start)
+        db.session.expunge_all()
+    return min(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark recording the full id list of a query")
+    parser.add_argument('--segments', type=int, default=100000, help="Number of synthetic segments")
+    parser.add_argument('--repeats', type=int, default=3, help="Repeats of each measurement (best is reported)")
+    args = parser.parse_args()
+
+    app = make_app()
+    with app.app_context():
+        from explore_app.film_segment import FilmSegment
+
+        print(f"Seeding {args.segments} segments...")
+        seed_segments(args.segments)
+
+        queries = {
+            'unfiltered': FilmSegment.query,
+            'dataset=antarctica': FilmSegment.query.filter(FilmSegment.dataset == 'antarctica'),
+            'flight=37': FilmSegment.query.filter(FilmSegment.flight == 37),
+        }
+
+        print(f"{'query':>20} {'rows':>8} {'ORM objects':>12} {'id only':>10} {'filter spec':>12}")
+        for name, query in queries.items():
+            n_rows = query.count()
+            t_orm = best_of(lambda: [x.id for x in query.all()], args.repeats)
+            t_ids = best_of(lambda: [seg_id for (seg_id,) in query.with_entities(FilmSegment.id).all()], args.repeats)
+            t_spec = best_of(lambda: query.limit(10).all(), args.repeats)  # Only the displayed page is fetched
+            print(f"{name:>20} {n_rows:>8} {t_orm:>11.3f}s {t_ids:>9.3f}s {t_spec:>11.3f}s")
@@ -0,0 +1,143 @@
+"""
+Benchmark of update_flight_progress_stats(), run by the update_stats scheduler job every minute.
+
+Compares the previous implementation (a distinct() query, then two count() queries per flight) with the current single
+GROUP BY query per dataset, checks that both produce the same flight_progress_stats, and reports the number of queries
+issued. Also checks that the progress counters stay equal to a recount when segments are changed through the ORM with
+numpy and pandas values (like the CSV importers assign), which needs Redis. Run from the repository root:
+
+    python -m benchmarks.stats_benchmark --segments 100000
+
+Set BENCH_DATABASE_URL to run against PostgreSQL, where each round trip costs more.
+"""
+import copy
+import time
+import argparse
+
+import numpy as np
+import redis
+
+from sqlalchemy import and_, event
+
+from explore_app import db
+from benchmarks.synthetic_db import make_app, seed_segments
+
+
+def per_flight_queries(session):
+    """ The previous update_flight_progress_stats() """
+    from explore_app.film_segment import FilmSegment
+    from explore_app.main.stats_plots import flight_progress_stats
+
+    for dataset, flight_name_prefix, separate_by_date in [('antarctica', 'Antarctica ', False),
+                                                          ('greenland', 'Greenland ', True)]:
+        q = FilmSegment.query.filter(FilmSegment.dataset == dataset).filter(FilmSegment.is_junk == False).filter(
+            FilmSegment.scope_type != FilmSegment.ESM_SCOPE)
+        if separate_by_date:
+            distinct_flights = q.with_entities(FilmSegment.flight, FilmSegment.raw_date).distinct().all()
+        else:
+            distinct_flights = [(x[0], None) for x in q.with_entities(FilmSegment.flight).distinct().all()]
+
+        verified_list = []
+        total_list = []
+        for fid, fdate in distinct_flights:
+            q = FilmSegment.query.filter(and_(FilmSegment.flight == fid, FilmSegment.raw_date == fdate,
+                                              FilmSegment.dataset == dataset, FilmSegment.is_junk == False))
+            verified_list.append(q.filter(FilmSegment.is_verified == True).count())
+            total_list.append(q.count())
+
+        stats = flight_progress_stats[dataset]
+        stats['flight_ids'] = [x[0] for x in distinct_flights]
+        stats['flight_dates'] = [x[1] for x in distinct_flights]
+        stats['total_segments'] = total_list
+        stats['verified'] = verified_list
+        stats['unverified'] = [t - v for t, v in zip(total_list, verified_list)]
+
+
+def group_by_query(session):
+    """ The current update_flight_progress_stats() """
+    from explore_app.main.stats_plots import update_flight_progress_stats
+    update_flight_progress_stats(session)
+
+
+def stats_by_flight():
+    """ flight_progress_stats as {(dataset, flight, date): (total, verified, unverified)}, independent of order """
+    from explore_app.main.stats_plots import flight_progress_stats
+    res = {}
+    for dataset, stats in flight_progress_stats.items():
+        for i, key in enumerate(zip(stats['flight_ids'], stats['flight_dates'])):
+            res[(dataset,) + key] = (stats['total_segments'][i], stats['verified'][i], stats['unverified'][i])
+    return res
+
+
+def check_numpy_counters(session, n_changed=100):
+    """
+    Number of differences between the progress counters and a recount after changing n_changed segments with numpy
+    values, or None if Redis can't be reached
+    """
+    from explore_app.film_segment import FilmSegment
+    from explore_app.main import progress_counters
+
+    try:
+        progress_counters.conn.ping()
+    except redis.exceptions.RedisError:
+        return None
+
+    datasets = ['antarctica', 'greenland', progress_counters.ALL_SEGMENTS]
+    for dataset in datasets:
+        progress_counters.reconcile_flight_progress(session, dataset)
+
+    for seg in FilmSegment.query.order_by(FilmSegment.id).limit(n_changed).all():
+        seg.is_verified = np.bool_(not seg.is_verified)
+        seg.is_junk = np.False_
+        seg.flight = np.float64(seg.flight or 1)
+        seg.raw_date = np.float64(1974)
+    session.commit()
+
+    n_diff = 0
+    for dataset in datasets:
+        counted = {(g[0], g[1]): g[2:] for g in progress_counters.count_flight_progress(session, dataset) if g[2] > 0}
+        loaded = progress_counters.load_flight_progress(dataset)[0]
+        loaded = {(g[0], g[1]): g[2:] for g in loaded}
+        n_diff += sum(counted.get(k) != loaded.get(k) for k in set(counted) | set(loaded))
+    return n_diff
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the flight progress stats update")
+    parser.add_argument('--segments', type=int, default=100000, help="Number of synthetic segments")
+    parser.add_argument('--repeats', type=int, default=5, help="Number of timed updates per implementation")
+    args = parser.parse_args()
+
+    app = make_app()
+    with app.app_context():
+        print(f"Seeding {args.segments} segments...")
+        seed_segments(args.segments)
+
+        n_queries = 0
+
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def count_query(*_):
+            global n_queries
+            n_queries += 1
+
+        results = {}
+        for name, f in [('per-flight queries', per_flight_queries), ('one GROUP BY', group_by_query)]:
+            f(db.session)
+            results[name] = copy.deepcopy(stats_by_flight())
+
+            n_queries = 0
+            t_start = time.time()
+            for _ in range(args.repeats):
+                f(db.session)
+            elapsed = (time.time() - t_start) / args.repeats
+            print(f"{name:>18}: {1000 * elapsed:.1f} ms per update, {n_queries // args.repeats} queries")
+
+        a, b = results.values()
+        print(f"Flights: {len(a)}, stats mismatches between implementations: "
+              f"{sum(a.get(k) != b.get(k) for k in set(a) | set(b))}")
+
+        n_diff = check_numpy_counters(db.session)
+        if n_diff is None:
+            print("Redis isn't available, so the progress counters weren't checked")
+        else:
+            print(f"Progress counter differences from a recount after numpy-valued changes: {n_diff}")
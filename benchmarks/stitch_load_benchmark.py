@@ -0,0 +1,89 @@
+"""
+Benchmark the parallel load/flip/resize stage of stitch_images.
+
+Reports wall time against the number of segments stitched for several thread pool sizes, using a local directory of
+sample TIFF or JPG files (cycled through if there are fewer files than segments). Use --latency to add a simulated
+per-image storage round trip, which is closer to what the workers see when pulling images from cloud storage.
+
+Also checks that stitch_cache_key() changes when one of the source images is replaced in place, so a stitch made from
+the old image isn't served for the new one.
+
+Run from the repository root:
+
+    python -m benchmarks.stitch_load_benchmark /path/to/sample/images --counts 5 10 25 50 --workers 1 4 8
+"""
+import os
+import time
+import argparse
+import shutil
+import tempfile
+import itertools
+
+from PIL import Image
+
+from explore_app.api import image_processing
+from explore_app.api.stitch_cache import stitch_cache_key
+
+
+def make_paths(image_dir, n):
+    files = sorted(os.path.join(image_dir, f) for f in os.listdir(image_dir)
+                   if f.lower().endswith(('.tif', '.tiff', '.jpg', '.jpeg')))
+    if len(files) == 0:
+        raise ValueError(f"No TIFF or JPG files found in {image_dir}")
+    return list(itertools.islice(itertools.cycle(files), n))
+
+
+def run_load_stage(img_paths, n_workers, scale_x, resample):
+    t_start = time.time()
+    for im in image_processing.iter_loaded_images(img_paths, 'x', scale_x, 1.0, resample=resample,
+                                                  n_workers=n_workers, max_in_flight=2*n_workers):
+        im.close()
+    return time.time() - t_start
+
+
+def check_cache_key(img_paths):
+    """ True if replacing the first of img_paths with a different image gives a different stitch_cache_key() """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        copies = []
+        for idx, path in enumerate(img_paths[:2]):
+            copies.append(os.path.join(tmp_dir, f"{idx}_{os.path.basename(path)}"))
+            shutil.copyfile(path, copies[-1])
+
+        key_before = stitch_cache_key(copies, 'jpg', '', 1.0, 1.0)
+        with Image.open(copies[0]) as im:
+            replaced = im.transpose(Image.FLIP_LEFT_RIGHT)
+        time.sleep(0.01)  # Make sure the mtime moves even if the size doesn't change
+        replaced.save(copies[0], format=im.format)
+        key_after = stitch_cache_key(copies, 'jpg', '', 1.0, 1.0)
+
+    return key_before != key_after
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the parallel image loading stage of stitch_images")
+    parser.add_argument('image_dir', type=str, help="Directory of sample TIFF/JPG files")
+    parser.add_argument('--counts', type=int, nargs='+', default=[5, 10, 25, 50], help="Segment counts to test")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8], help="Thread pool sizes to test")
+    parser.add_argument('--latency', type=float, default=0.0, help="Simulated storage latency per image [seconds]")
+    parser.add_argument('--scale_x', type=float, default=0.2, help="Horizontal scale factor applied to each image")
+    parser.add_argument('--tiff', action="store_true", default=False, help="Use nearest-neighbor resampling like TIFF stitches")
+    args = parser.parse_args()
+
+    if args.latency > 0:
+        load_image = image_processing.worker_load_image
+
+        def slow_load_image(file_path):
+            time.sleep(args.latency)
+            return load_image(file_path)
+
+        image_processing.worker_load_image = slow_load_image
+
+    resample = Image.NEAREST if args.tiff else None
+
+    print(f"Replacing a source image changes the stitch cache key: {check_cache_key(make_paths(args.image_dir, 2))}")
+
+    print(f"{'segments':>10}" + "".join(f"{str(w) + ' workers':>14}" for w in args.workers))
+    for n in args.counts:
+        img_paths = make_paths(args.image_dir, n)
+        times = [run_load_stage(img_paths, w, args.scale_x, resample) for w in args.workers]
+        print(f"{n:>10}" + "".join(f"{t:>13.2f}s" for t in times))
@@ -0,0 +1,85 @@
+"""
+Helpers for benchmarks that need a database of film segments.
+
+The database comes from BENCH_DATABASE_URL (a throwaway PostgreSQL database is the most realistic choice), falling
+back to a temporary SQLite file. Tables are created from the models, and seed_segments() fills film_segment with
+synthetic rows shaped like the real archive (reels of consecutive frames, flights of increasing CBDs).
+"""
+import os
+import random
+import tempfile
+from datetime import datetime
+
+import sqlalchemy as sa
+from flask import Flask
+
+from explore_app import db
+
+
+def make_app(database_url=None):
+    """ A minimal Flask app bound to the benchmark database (without loading positioning data, maps, etc.) """
+    if database_url is None:
+        database_url = os.environ.get('BENCH_DATABASE_URL',
+                                      f"sqlite:///{os.path.join(tempfile.gettempdir(), 'rfs_benchmark.db')}")
+
+    app = Flask('benchmark')
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url.replace("postgres://", "postgresql://")
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+
+    from explore_app.film_segment import FilmSegment
+    from explore_app.user import User
+    sa.orm.configure_mappers()
+
+    return app
+
+
+def seed_segments(n, seed=0, batch_size=10000):
+    """ Replace the contents of film_segment with n synthetic segments. Must be called inside an app context. """
+    from explore_app.film_segment import FilmSegment
+
+    rng = random.Random(seed)
+    db.drop_all()
+    db.create_all()
+
+    table = FilmSegment.__table__
+    rows = []
+    for i in range(n):
+        dataset = 'antarctica' if i % 4 else 'greenland'
+        reel = i // 200
+        first_frame = (i % 200) * 10
+        flight = rng.randint(1, 150)
+        first_cbd = rng.randint(0, 5000)
+        rows.append({
+            'id': i + 1,
+            'dataset': dataset,
+            'path': f"synthetic/{reel}/{reel}_{first_frame:04d}_{first_frame + 9:04d}.tiff",
+            'reel': str(reel),
+            'first_frame': first_frame,
+            'last_frame': first_frame + 9,
+            'first_cbd': first_cbd,
+            'last_cbd': first_cbd + rng.randint(1, 20),
+            'flight': flight,
+            'raw_date': None if dataset == 'antarctica' else 10000 + rng.choice([74, 78, 79]),
+            'raw_time': None,
+            'raw_mode': None,
+            'is_junk': rng.random() < 0.05,
+            'is_verified': rng.random() < 0.5,
+            'needs_review': False,
+            'scope_type': rng.choice(['z', 'z', 'a', 'esm']),
+            'instrument_type': FilmSegment.UNKNOWN,
+            'notes': '',
+            'updated_by': 'benchmark',
+            'last_changed': datetime.now()
+        })
+        if len(rows) == batch_size:
+            db.session.execute(table.insert(), rows)
+            rows = []
+
+    if rows:
+        db.session.execute(table.insert(), rows)
+    db.session.commit()
+
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(sa.text("ANALYZE film_segment"))
+        db.session.commit()
@@ -0,0 +1,37 @@
+import time
+import argparse
+
+from config import Config
+from explore_app.main.positioning_cache import build_positioning_cache, check_cache_dir
+
+
+if __name__ == "__main__":
+    # Parse and project the positioning CSVs into the binary cache loaded at startup, so that the first process to
+    # start doesn't have to. Uses the positioning directories and POSITIONING_CACHE_DIR from the environment (as the
+    # app does) unless they're given. Example:
+    #   python build_positioning_cache.py --dataset antarctica
+
+    datasets = {
+        'antarctica': Config.ANTARCTICA_FLIGHT_POSITIONING_DIR,
+        'greenland': Config.GREENLAND_FLIGHT_POSITIONING_DIR
+    }
+
+    parser = argparse.ArgumentParser(description="Build the binary flight positioning cache")
+    parser.add_argument('--dataset', type=str, default=None, choices=list(datasets), help="Only build this dataset")
+    parser.add_argument('--positioning_dir', type=str, default=None, help="Positioning CSV directory (with --dataset)")
+    parser.add_argument('--cache_dir', type=str, default=Config.POSITIONING_CACHE_DIR, help="Cache directory")
+    args = parser.parse_args()
+
+    check_cache_dir(args.cache_dir)
+
+    if args.positioning_dir:
+        if not args.dataset:
+            raise ValueError("--positioning_dir requires --dataset")
+        datasets[args.dataset] = args.positioning_dir
+
+    for dataset, positioning_dir in datasets.items():
+        if args.dataset and (dataset != args.dataset):
+            continue
+        t_start = time.time()
+        flight_lines = build_positioning_cache(positioning_dir, dataset, args.cache_dir)
+        print(f"Cached {len(flight_lines)} {dataset} flight lines from {positioning_dir} in {time.time() - t_start:.1f} seconds")
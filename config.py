@@ -30,6 +30,16 @@ class Config:
     CACHE_TYPE = 'null'
     CACHE_DEFAULT_TIMEOUT = 300
 
+    # Recorded queries (used for bulk actions on query results)
+    QUERY_STORE_TTL = int(os.environ.get('QUERY_STORE_TTL', 60*60))
+    QUERY_STORE_MAX_ENTRIES = int(os.environ.get('QUERY_STORE_MAX_ENTRIES', 10000))
+    SEGMENT_BATCH_MAX_IDS = int(os.environ.get('SEGMENT_BATCH_MAX_IDS', 500))  # Limit for /api/segments?ids=
+    EXPORT_ROW_GROUP_SIZE = int(os.environ.get('EXPORT_ROW_GROUP_SIZE', 10000))  # Rows per row group for /api/export
+    QUERY_STREAM_BATCH_SIZE = int(os.environ.get('QUERY_STREAM_BATCH_SIZE', 1000))  # Rows per batch for format=ndjson/csv
+
+    # Full recount of the per-flight progress counters (seconds)
+    PROGRESS_STATS_RECONCILE_INTERVAL = int(os.environ.get('PROGRESS_STATS_RECONCILE_INTERVAL', 60*60))
+
     # Stanford brand identity colors
     COLOR_PRIMARY = '#8c1515'  # Cardinal red
     COLOR_ACCENT = '#b1040e'  # Bright red
@@ -50,10 +60,21 @@ class Config:
     GREENLAND_FILM_IMAGES_DIR = os.environ.get('GREENLAND_FILM_IMAGES_DIR')
     GREENLAND_FILM_IMAGES_TIFF_DIR = os.environ.get('GREENLAND_FILM_IMAGES_TIFF_DIR')
     TMP_OUTPUTS_DIR = os.environ.get('TMP_OUTPUTS_DIR')
+    # Must be an absolute path; the cache is disabled without one
+    DERIVED_IMAGE_CACHE_DIR = os.environ.get('DERIVED_IMAGE_CACHE_DIR', os.path.join(TMP_OUTPUTS_DIR, 'derived_images') if TMP_OUTPUTS_DIR else None)
+    DERIVED_IMAGE_CACHE_MAX_BYTES = int(os.environ.get('DERIVED_IMAGE_CACHE_MAX_BYTES', 512*1024*1024))
     ENABLE_TIFF = os.environ.get('ENABLE_TIFF')
+    # Parsed and projected positioning data (set to an empty string to always load the CSVs). Must be an absolute path;
+    # the app won't start with a relative one
+    POSITIONING_CACHE_DIR = os.environ.get('POSITIONING_CACHE_DIR', os.path.join(TMP_OUTPUTS_DIR, 'positioning_cache') if TMP_OUTPUTS_DIR else '')
+    # Flight line simplification tolerance (metres) for the overview maps and for the map on each flight's page
+    MAP_OVERVIEW_TOLERANCE = float(os.environ.get('MAP_OVERVIEW_TOLERANCE', 500))
+    MAP_FLIGHT_TOLERANCE = float(os.environ.get('MAP_FLIGHT_TOLERANCE', 50))
 
     # APScheduler
     SCHEDULER_API_ENABLED = True
+    # Run each periodic job in only one process (holding a Redis lease) instead of in every web process
+    SCHEDULER_LEADER_ELECTION = (True if os.environ.get('SCHEDULER_LEADER_ELECTION', "1") == "1" else False)
 
     # Airbrake
     PYBRAKE = dict(
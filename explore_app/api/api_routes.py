@@ -2,34 +2,66 @@ import os
 from io import BytesIO
 from PIL import Image
 from datetime import datetime
-import requests
 import time
 import uuid
+import json
+import hashlib
+from types import SimpleNamespace
 
-from flask import Blueprint, request, send_file, send_from_directory, redirect, render_template
+import numpy as np
+import pandas as pd
+
+from flask import Blueprint, Response, request, send_file, send_from_directory, redirect, render_template, url_for
 from flask_restful import Api, Resource
 from flask_login import current_user
+from sqlalchemy import select
+from sqlalchemy.orm import aliased
 from sqlalchemy_continuum.utils import count_versions
 
 from flask import current_app as app
-from .. import db, ma, scheduler
-
-from ..main.map import load_flight_lines
-
-from explore_app.film_segment import FilmSegment
+from .. import db, ma, scheduler, queue
+
+from ..main.positioning_cache import load_cached_flight_lines
+from ..main.positioning import positioning_version, find_flight_line, sorted_track, cbd_range, TRACK_FIELDS
+from .image_cache import DerivedImageCache
+from .remote_fetch import open_image, source_version
+from .query_store import QueryStore
+from .streaming import STREAM_FORMATS, stream_query, encode_value
+from .artifact_store import get_artifact_store, ARTIFACT_TTL
+from .stitch_cache import enqueue_once
+from .bulk_update import bulk_update_segments
+from .export import EXPORT_FORMATS, EXPORT_CACHE_TTL, EXPORT_JOB_TIMEOUT, segments_data_version, export_cache_key, \
+    cached_export, export_job
+from .geolocation import GEOLOCATION_COLUMNS, TooManySegments, geolocation_cache_key, geolocate_segments, cached_geolocation
+from .segment_query import FILTER_SPEC_ARGS, filtered_query, ordered_query
+from .pagination import SORT_COLUMNS, decode_cursor, keyset_page, sort_order, page_cursors, count_results
+from .. import metrics
+
+from explore_app.film_segment import FilmSegment, NEIGHBOR_FIELDS, neighbor_columns
+from worker import conn
 
 api_bp = Blueprint('api_bp', __name__,
                    template_folder='templates',
                    static_folder='static')
 seg_api = Api(api_bp)
 
+# Loaded once per process (main_routes uses these too), from the binary positioning cache when it is up to date
 flight_lines = {
-    'antarctica': load_flight_lines(app.config['ANTARCTICA_FLIGHT_POSITIONING_DIR'], 'antarctica'),
-    'greenland': load_flight_lines(app.config['GREENLAND_FLIGHT_POSITIONING_DIR'], 'greenland')
+    'antarctica': load_cached_flight_lines(app.config['ANTARCTICA_FLIGHT_POSITIONING_DIR'], 'antarctica',
+                                           app.config['POSITIONING_CACHE_DIR']),
+    'greenland': load_cached_flight_lines(app.config['GREENLAND_FLIGHT_POSITIONING_DIR'], 'greenland',
+                                          app.config['POSITIONING_CACHE_DIR'])
 }
+positioning_versions = {
+    'antarctica': positioning_version(app.config['ANTARCTICA_FLIGHT_POSITIONING_DIR']),
+    'greenland': positioning_version(app.config['GREENLAND_FLIGHT_POSITIONING_DIR'])
+}
+
+query_store = QueryStore(conn, app.config['QUERY_STORE_TTL'], app.config['QUERY_STORE_MAX_ENTRIES'])
 
-query_cache = {}
-images_cache = {}
+derived_image_cache = DerivedImageCache(app.config['DERIVED_IMAGE_CACHE_DIR'], app.config['DERIVED_IMAGE_CACHE_MAX_BYTES'])
+
+artifact_store = get_artifact_store()
 
 # Database GET/POST
 
@@ -51,41 +83,68 @@ def has_write_permission(current_user):
 
 
 def add_next_previous(seg_dict, seg):
-    # Add next/prev by frame order
-    prev_frame = min(seg_dict['first_frame'], seg_dict['last_frame']) - 1
-    next_frame = max(seg_dict['first_frame'], seg_dict['last_frame']) + 1
-
-    next_by_frame = FilmSegment.query_visible_to_user(current_user).filter(
-        (FilmSegment.first_frame >= next_frame) & (FilmSegment.last_frame >= next_frame) & (
-                FilmSegment.reel == seg.reel) & (FilmSegment.scope_type == seg.scope_type)
-    ).order_by(FilmSegment.first_frame.asc()).first()
-    prev_by_frame = FilmSegment.query_visible_to_user(current_user).filter(
-        (FilmSegment.first_frame <= prev_frame) & (FilmSegment.last_frame <= prev_frame) & (
-                FilmSegment.reel == seg.reel) & (FilmSegment.scope_type == seg.scope_type)
-    ).order_by(FilmSegment.first_frame.desc()).first()
-
-    if prev_by_frame:
-        seg_dict['prev_by_frame'] = prev_by_frame.id
-    if next_by_frame:
-        seg_dict['next_by_frame'] = next_by_frame.id
-
-    # Add next/prev by CBD order
-    prev_cbd = min(seg_dict['first_cbd'], seg_dict['last_cbd']) - 1
-    next_cbd = max(seg_dict['first_cbd'], seg_dict['last_cbd']) + 1
-
-    next_by_cbd = FilmSegment.query_visible_to_user(current_user).filter(
-        (FilmSegment.first_cbd >= next_cbd) & (FilmSegment.last_cbd >= next_cbd) & (
-                FilmSegment.flight == seg.flight) & (FilmSegment.scope_type == seg.scope_type)
-    ).order_by(FilmSegment.first_cbd.asc()).first()
-    prev_by_cbd = FilmSegment.query_visible_to_user(current_user).filter(
-        (FilmSegment.first_cbd <= prev_cbd) & (FilmSegment.last_cbd <= prev_cbd) & (
-                FilmSegment.flight == seg.flight) & (FilmSegment.scope_type == seg.scope_type)
-    ).order_by(FilmSegment.first_cbd.desc()).first()
-
-    if prev_by_cbd:
-        seg_dict['prev_by_cbd'] = prev_by_cbd.id
-    if next_by_cbd:
-        seg_dict['next_by_cbd'] = next_by_cbd.id
+    # Next/prev by frame order (within the reel) and by CBD order (within the flight), all in one query
+    src = SimpleNamespace(reel=seg.reel, scope_type=seg.scope_type, flight=seg.flight,
+                          first_frame=seg_dict['first_frame'], last_frame=seg_dict['last_frame'],
+                          first_cbd=seg_dict['first_cbd'], last_cbd=seg_dict['last_cbd'])
+    visible = FilmSegment.query_visible_to_user(current_user)
+    neighbors = db.session.execute(select(*neighbor_columns(src, visible))).one()
+
+    for field, neighbor_id in zip(NEIGHBOR_FIELDS, neighbors):
+        if neighbor_id is not None:
+            seg_dict[field] = neighbor_id
+
+# Editable fields and how the values sent to PATCH /api/segments are interpreted (the same meanings as
+# POST /api/segments/<id>, but checked before anything is written)
+SEGMENT_INT_FIELDS = ['flight', 'first_cbd', 'last_cbd', 'instrument_type', 'raw_date']
+SEGMENT_FLAG_FIELDS = {'is_junk': 'junk', 'is_verified': 'verified', 'needs_review': 'review'}  # Value meaning True
+SEGMENT_SCOPE_TYPES = [FilmSegment.Z_SCOPE, FilmSegment.A_SCOPE, FilmSegment.ESM_SCOPE]
+SEGMENT_INSTRUMENT_TYPES = [FilmSegment.UNKNOWN, FilmSegment.RADAR_60MHZ, FilmSegment.RADAR_300MHZ]
+
+def parse_segment_update(data):
+    """
+    Column values to set for an update request, and a list of problems with it (empty if it's valid). Fields that
+    exist but can't be edited (like path or first_frame) are ignored.
+    """
+    values = {}
+    errors = []
+    for field, v in data.items():
+        if field in SEGMENT_FLAG_FIELDS:
+            if isinstance(v, bool):
+                values[field] = v
+            elif isinstance(v, str):
+                values[field] = (v == SEGMENT_FLAG_FIELDS[field])
+            else:
+                errors.append(f"{field} must be a string or boolean")
+        elif field == 'raw_date' and v == '':
+            values[field] = None
+        elif field in SEGMENT_INT_FIELDS:
+            if v is None:
+                values[field] = None
+            elif isinstance(v, bool) or (isinstance(v, float) and not v.is_integer()):
+                errors.append(f"{field} must be an integer")
+            else:
+                try:
+                    values[field] = int(v)
+                except (TypeError, ValueError):
+                    errors.append(f"{field} must be an integer")
+        elif field == 'scope_type':
+            if v in SEGMENT_SCOPE_TYPES:
+                values[field] = v
+            else:
+                errors.append(f"scope_type must be one of {SEGMENT_SCOPE_TYPES}")
+        elif field == 'notes':
+            if (v is None) or isinstance(v, str):
+                values[field] = v
+            else:
+                errors.append("notes must be a string")
+        elif not ((field in FilmSegmentSchema.Meta.fields) or (field in NEIGHBOR_FIELDS) or (field == 'csrf_token')):
+            errors.append(f"Unknown field {field}")
+
+    if values.get('instrument_type', FilmSegment.UNKNOWN) not in SEGMENT_INSTRUMENT_TYPES:
+        errors.append(f"instrument_type must be one of {SEGMENT_INSTRUMENT_TYPES}")
+
+    return values, errors
 
 class FilmSegmentResource(Resource):
 
@@ -139,6 +198,101 @@ class FilmSegmentResource(Resource):
 
 seg_api.add_resource(FilmSegmentResource, '/api/segments/<int:id>')
 
+def parse_segment_ids(arg):
+    """ List of ids from a comma-separated string, or None if it isn't one """
+    try:
+        return [int(x) for x in arg.split(',') if x.strip()]
+    except ValueError:
+        return None
+
+@api_bp.route('/api/segments')
+def film_segments_batch():
+    """ Metadata (and optionally next/previous segments) for a comma-separated list of ids, all in one query """
+    ids = parse_segment_ids(request.args.get('ids', ''))
+    if ids is None:
+        return "ids must be a comma-separated list of segment ids", 400
+    if len(ids) > app.config['SEGMENT_BATCH_MAX_IDS']:
+        return f"At most {app.config['SEGMENT_BATCH_MAX_IDS']} ids can be requested at once", 400
+
+    fields = list(FilmSegmentSchema.Meta.fields)
+    visible = FilmSegment.query_visible_to_user(current_user)
+
+    # Select from an alias of the matching rows, so that the neighbor subqueries (on the table itself) correlate to it
+    seg = aliased(FilmSegment, visible.filter(FilmSegment.id.in_(ids)).subquery())
+    columns = [getattr(seg, f) for f in fields]
+    if request.args.get('neighbors'):
+        columns += neighbor_columns(seg, visible)
+
+    found = {}
+    for row in db.session.query(*columns):
+        seg_dict = dict(zip(fields, map(encode_value, row[:len(fields)])))
+        for field, neighbor_id in zip(NEIGHBOR_FIELDS, row[len(fields):]):
+            if neighbor_id is not None:
+                seg_dict[field] = neighbor_id
+        found[seg_dict['id']] = seg_dict
+
+    return {
+        'segments': [found[i] for i in ids if i in found],
+        'missing': [i for i in ids if i not in found]
+    }
+
+@api_bp.route('/api/segments', methods=['PATCH'])
+def film_segments_bulk_update():
+    """
+    Update many segments at once, from a JSON list of partial updates that each include the segment's id and use the
+    same fields as POST /api/segments/<id>. Every update is checked before anything is changed, and then all of them
+    are applied together in one transaction.
+    """
+    if not has_write_permission(current_user):
+        return "Not authorized", 401
+
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        return "Request body must be a JSON list of updates", 400
+    if len(items) > app.config['SEGMENT_BATCH_MAX_IDS']:
+        return f"At most {app.config['SEGMENT_BATCH_MAX_IDS']} segments can be updated at once", 400
+
+    # Validate everything first
+
+    ids = [item.get('id') if isinstance(item, dict) else None for item in items]
+    valid_ids = [i for i in ids if isinstance(i, int) and not isinstance(i, bool)]
+    visible = FilmSegment.query_visible_to_user(current_user)
+    existing = {seg_id for (seg_id,) in visible.filter(FilmSegment.id.in_(valid_ids)).with_entities(FilmSegment.id)}
+
+    results = []
+    changes = []
+    for idx, (item, seg_id) in enumerate(zip(items, ids)):
+        if not isinstance(item, dict):
+            results.append({'index': idx, 'id': None, 'status': 'error', 'errors': ["Update must be a JSON object"]})
+            continue
+
+        values, errors = parse_segment_update({k: v for k, v in item.items() if k != 'id'})
+        if seg_id not in valid_ids:
+            errors.insert(0, "id must be an integer segment id")
+        elif seg_id not in existing:
+            errors.insert(0, f"No segment with id {seg_id}")
+        elif ids.index(seg_id) != idx:
+            errors.insert(0, f"Segment {seg_id} appears more than once")
+
+        if errors:
+            results.append({'index': idx, 'id': seg_id, 'status': 'error', 'errors': errors})
+        else:
+            results.append({'index': idx, 'id': seg_id, 'status': 'updated'})
+            changes.append((seg_id, dict(values, updated_by=current_user.email, last_changed=datetime.now())))
+
+    if any(r['status'] == 'error' for r in results):
+        for r in results:
+            if r['status'] == 'updated':
+                r['status'] = 'not_applied'
+        return {'updated': 0, 'results': results}, 400
+
+    # Then apply them all at once
+
+    bulk_update_segments(db.session, changes)
+    db.session.commit()
+
+    return {'updated': len(changes), 'results': results}
+
 @api_bp.route('/api/segments/<int:id>/version/<int:version>')
 def film_segment_version(id, version):
     seg = FilmSegment.query_visible_to_user(current_user).filter(FilmSegment.id == id).first_or_404(id)
@@ -161,30 +315,85 @@ def film_segment_history(id):
 
 # Positioning data
 
-# @api_bp.route('/api/positioning/<dataset>/<int:flight_id>', methods=['GET'])
-# @api_bp.route('/api/positioning/<dataset>/<int:flight_id>/<int:flight_date>', methods=['GET'])
-# def positioning_data(dataset, flight_id, flight_date=None):
-#     if not (dataset in flight_lines):
-#         return "Unknown dataset"
-    
-#     first_cbd = request.args.get("first_cbd", default=None)
-#     last_cbd = request.args.get("last_cbd", default=None)
+POSITIONING_FORMATS = {
+    'json': 'application/json',
+    'csv': 'text/csv',
+    'f32': 'application/octet-stream'
+}
+
+positioning_tracks = {}  # id() of a flight line DataFrame -> its sorted_track(), built on first use
+
+def get_positioning_track(df):
+    if id(df) not in positioning_tracks:
+        positioning_tracks[id(df)] = sorted_track(df)
+    return positioning_tracks[id(df)]
+
+def find_positioning_track(dataset, flight, raw_date):
+    df = find_flight_line(flight_lines.get(dataset, {}), flight, raw_date)
+    return None if df is None else get_positioning_track(df)
 
-#     if flight_date is None:
-#         flight_ident = (flight_id, None)
-#     else:
-#         flight_ident = (flight_id, flight_date % 100)
+@api_bp.route('/api/positioning/<dataset>/<int:flight_id>', methods=['GET'])
+@api_bp.route('/api/positioning/<dataset>/<int:flight_id>/<int:flight_date>', methods=['GET'])
+def positioning_data(dataset, flight_id, flight_date=None):
+    """ Positioning along a flight line (optionally only from first_cbd to last_cbd) as JSON, CSV, or float32 """
+    if not (dataset in flight_lines):
+        return "Unknown dataset", 404
+
+    if flight_date is None:
+        flight_ident = (flight_id, None)
+    else:
+        flight_ident = (flight_id, flight_date % 100)
+
+    if not (flight_ident in flight_lines[dataset]):
+        return "No positioning data for this flight", 404
+
+    fmt = request.args.get('format', 'json')
+    if fmt not in POSITIONING_FORMATS:
+        return f"Unsupported format {fmt}", 400
+    try:
+        first_cbd, last_cbd = [float(request.args[k]) if request.args.get(k) else None for k in ['first_cbd', 'last_cbd']]
+    except ValueError:
+        return "first_cbd and last_cbd must be numbers", 400
+
+    # The response only changes when the positioning files do
+    etag = hashlib.sha1(repr((positioning_versions[dataset], dataset, flight_ident, first_cbd, last_cbd, fmt)
+                             ).encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        track = get_positioning_track(flight_lines[dataset][flight_ident])
+        idx = cbd_range(track['cbd'], first_cbd, last_cbd)
+        columns = {field: track[field][idx] for field in TRACK_FIELDS}
+
+        if fmt == 'json':
+            body = json.dumps({field: np.where(np.isnan(values), None, values).tolist()
+                               for field, values in columns.items()})
+        elif fmt == 'csv':
+            body = pd.DataFrame(columns).to_csv(index=False)
+        else:
+            body = np.column_stack(list(columns.values())).astype('<f4').tobytes()
 
-#     if not (flight_ident in flight_lines[dataset]):
-#         return ""
+        response = Response(body, mimetype=POSITIONING_FORMATS[fmt])
+        response.headers['X-Positioning-Fields'] = ','.join(columns)
+        response.headers['X-Positioning-Rows'] = str(idx.stop - idx.start)
+
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.no_cache = True  # Cacheable, but revalidated with If-None-Match (cheap 304s)
+    return response
 
 # Image Loading
 
-def serve_pil_image(pil_img):
+def encode_pil_image(pil_img):
     img_io = BytesIO()
     pil_img.save(img_io, 'JPEG', quality=70)
-    img_io.seek(0)
-    return send_file(img_io, mimetype='image/jpeg')
+    return img_io.getvalue()
+
+def serve_pil_image(pil_img):
+    return serve_jpg_bytes(encode_pil_image(pil_img))
+
+def serve_jpg_bytes(img_bytes):
+    return send_file(BytesIO(img_bytes), mimetype='image/jpeg')
 
 def serve_unmodified_image(p):
     if "https://" in p:
@@ -193,11 +402,7 @@ def serve_unmodified_image(p):
         send_from_directory(p)
 
 def load_image(p):
-    if "https://" in p:
-        response = requests.get(p)
-        return Image.open(BytesIO(response.content))
-    else:
-        return Image.open(p)
+    return open_image(p)
 
 @api_bp.route('/api/radargram/jpg/<int:id>')
 @api_bp.route('/api/radargram/jpg/<int:id>.jpg')
@@ -209,70 +414,82 @@ def radargram_jpg(id, max_height = None, crop_w_start = None, crop_w_end = None)
     filename = seg.get_path(format='jpg')
 
     if max_height:
-        im = load_image(filename)
-        if max_height >= im.height:
-            return serve_unmodified_image(filename)
-        else:
-            scale = max_height / im.height
-            return serve_pil_image(im.resize((int(im.width*scale), int(im.height*scale))))
+        operation, param = 'h', max_height
     elif crop_w_start:
-        im = load_image(filename)
-        return serve_pil_image(im.crop(box=(0, 0, crop_w_start, im.size[1])))
+        operation, param = 'crop_first', crop_w_start
     elif crop_w_end:
-        im = load_image(filename)
-        return serve_pil_image(im.crop(box=(im.size[0]-crop_w_end, 0, im.size[0], im.size[1])))
+        operation, param = 'crop_last', crop_w_end
     else:
         return serve_unmodified_image(filename)
 
-@api_bp.route('/api/radargram/tiff/<int:id>')
-@api_bp.route('/api/radargram/tiff/<int:id>.tiff')
-def radargram_tiff(id):
-    seg = FilmSegment.query_visible_to_user(current_user).filter(FilmSegment.id == id).first()
-    return serve_unmodified_image(seg.get_path(format='tiff'))
+    # Keyed by the source image's current version, so an image replaced at the same path isn't served stale
+    version = source_version(filename) if derived_image_cache.enabled else None
+    cache_key = derived_image_cache.make_key(id, operation, param, f"{filename}|{version}") if version else None
+    img_bytes = derived_image_cache.get(cache_key) if cache_key else None
 
+    if img_bytes is None:
+        im = load_image(filename)
+        t_render = time.time()
+        if operation == 'h':
+            if max_height >= im.height:
+                img_bytes = b''  # Cached as empty to remember that the unmodified image should be served
+            else:
+                scale = max_height / im.height
+                img_bytes = encode_pil_image(im.resize((int(im.width*scale), int(im.height*scale))))
+        elif operation == 'crop_first':
+            img_bytes = encode_pil_image(im.crop(box=(0, 0, crop_w_start, im.size[1])))
+        else:
+            img_bytes = encode_pil_image(im.crop(box=(im.size[0]-crop_w_end, 0, im.size[0], im.size[1])))
+        metrics.observe('derived_image.render', time.time() - t_render)
+        if cache_key:
+            derived_image_cache.put(cache_key, img_bytes)
 
-def query_results_from_database(request):
-    query = FilmSegment.query_visible_to_user(current_user)
+    if len(img_bytes) == 0:
+        return serve_unmodified_image(filename)
+    else:
+        return serve_jpg_bytes(img_bytes)
 
-    # Filters
+@api_bp.route('/api/radargram/cache/stats')
+def radargram_cache_stats():
+    if not has_write_permission(current_user):
+        return "Not authorized", 401
 
-    if request.args.get('flight'):
-        query = query.filter(FilmSegment.flight == int(request.args.get('flight')))
+    return derived_image_cache.stats()
 
-    if request.args.get('reel'):
-        query = query.filter(FilmSegment.reel == request.args.get('reel'))
+@api_bp.route('/api/metrics')
+def metrics_summary():
+    if not has_write_permission(current_user):
+        return "Not authorized", 401
 
-    if request.args.get('verified'):
-        if int(request.args.get('verified')) == 0:
-            query = query.filter(FilmSegment.is_verified == False)
-        elif int(request.args.get('verified')) == 1:
-            query = query.filter(FilmSegment.is_verified == True)
+    return metrics.get_metrics(prefix=request.args.get('prefix', ''))
 
-    if request.args.get('scope'):
-        query = query.filter(FilmSegment.scope_type == request.args.get('scope'))
+@api_bp.route('/api/radargram/tiff/<int:id>')
+@api_bp.route('/api/radargram/tiff/<int:id>.tiff')
+def radargram_tiff(id):
+    seg = FilmSegment.query_visible_to_user(current_user).filter(FilmSegment.id == id).first()
+    return serve_unmodified_image(seg.get_path(format='tiff'))
 
-    if request.args.get('dataset'):
-        query = query.filter(FilmSegment.dataset == request.args.get('dataset'))
 
-    if request.args.get('mincbd'):
-        query = query.filter(FilmSegment.first_cbd >= int(request.args.get('mincbd')))
+def resolve_query_ids(query_log, scope):
+    """ Segment ids for a recorded query, for either the page that was shown or the whole query """
+    if scope == 'page':
+        return query_log['page_query']
 
-    if request.args.get('maxcbd'):
-        query = query.filter(FilmSegment.first_cbd <= int(request.args.get('maxcbd')))
+    if 'full_query' in query_log:  # Explicit list of ids
+        return query_log['full_query']
 
-    if request.args.get('minframe'):
-        query = query.filter(FilmSegment.first_frame >= int(request.args.get('minframe')))
+    # Only the filters are recorded, so the ids are looked up now (as a light-weight id-only query)
+    query = ordered_query(query_log['filter_spec'], current_user).with_entities(FilmSegment.id)
+    return [seg_id for (seg_id,) in query.all()]
 
-    if request.args.get('maxframe'):
-        query = query.filter(FilmSegment.first_frame <= int(request.args.get('maxframe')))
+def query_results_from_database(request, keyset=False):
+    query = filtered_query(request.args, current_user)
 
-    # Sorting
+    # Sorting (always ends with id, so that the order is stable and pages can be addressed with cursors)
 
-    if request.args.get('sort'):
-        if request.args.get('sort') == 'cbd':
-            query = query.order_by(FilmSegment.first_cbd)
-        elif request.args.get('sort') == 'frame':
-            query = query.order_by(FilmSegment.first_frame)
+    sort_key = request.args.get('sort')
+    if not (sort_key in SORT_COLUMNS):
+        sort_key = 'id'
 
     # Number and page of results
 
@@ -281,38 +498,160 @@ def query_results_from_database(request):
     else:
         n = 10
 
-    if request.args.get('skip'):
-        query.offset(int(request.args.get('skip')))
-
     if request.args.get('page'):
         current_page = int(request.args.get('page'))
-        query = query.offset((current_page-1) * n)
     else:
         current_page = 1
 
-    query_page = query.limit(n)  # Just this page
+    if ('cursor' in request.args) or (keyset and current_page == 1):
+        # Keyset pagination: the cursor identifies where the page starts, so there's no OFFSET to scan through
+        # (and skip is ignored)
+        skip = 0
+        cursor = decode_cursor(request.args.get('cursor'), sort_key)
+        if cursor is None:
+            current_page = 1
+        page_segments, next_cursor, prev_cursor = keyset_page(query, sort_key, cursor, n)
+        query = query.order_by(*sort_order(sort_key))
+    else:
+        query = query.order_by(*sort_order(sort_key))
+
+        skip = int(request.args.get('skip')) if request.args.get('skip') else 0
+        if skip:
+            query = query.offset(skip)
+
+        page_segments = query.limit(n + 1).offset(skip + (current_page-1) * n).all()
+        next_cursor, prev_cursor = page_cursors(sort_key, page_segments[:n], len(page_segments) > n,
+                                                skip + (current_page-1) * n > 0)
+        page_segments = page_segments[:n]
+
+    cursors = {'next': next_cursor, 'prev': prev_cursor, 'sort': sort_key}
 
     # Record this query (temporarily)
 
-    query_log = {'full_query': [x.id for x in query.all()],
-                 'page_query': [x.id for x in query_page.all()],
+    # Only the filters are recorded rather than every matching id, so the cost of this doesn't depend on how many
+    # segments match. The full list of ids is resolved only if a bulk action is run on the whole query.
+    filter_spec = {k: request.args[k] for k in FILTER_SPEC_ARGS if request.args.get(k)}
+    filter_spec['skip'] = skip
+    query_log = {'filter_spec': filter_spec,
+                 'page_query': [x.id for x in page_segments],
                  'timestamp': time.time()}
 
     qid = str(uuid.uuid4())
-    query_cache[qid] = query_log
+    query_store.put(qid, query_log)
 
-    return query, query_page, current_page, qid, n
+    return query, page_segments, current_page, qid, n, cursors
 
 """ The API version of the query path, which returns a JSON-formatted list of segment IDs or the actual segment metadata """
 @api_bp.route('/api/query')
 def query_json_results():
-    query, _, _, qid, n = query_results_from_database(request)
+    if request.args.get('format') in STREAM_FORMATS:
+        return query_stream_results()
+
+    query, page_segments, _, qid, n, cursors = query_results_from_database(request)
+
+    res = {}
+    if 'cursor' in request.args:  # One page at a time
+        segments = page_segments
+        res['next_cursor'] = cursors['next']
+        res['prev_cursor'] = cursors['prev']
+        res['count'] = count_results(query.order_by(None), request.args.get('count', 'none'))
+    else:
+        segments = None  # Everything matching the query
+
+    if request.args.get('ids_only'):
+        if segments is None:
+            res['ids'] = [seg_id for (seg_id,) in query.with_entities(FilmSegment.id).all()]
+        else:
+            res['ids'] = [seg.id for seg in segments]
+    else:
+        res['segments'] = segments_schema.dump(query.all() if segments is None else segments)
+    return res
+
+def query_stream_results():
+    """ Every result of the query, streamed as NDJSON or CSV (pagination arguments other than skip are ignored) """
+    query = ordered_query(request.args, current_user)
+
     if request.args.get('ids_only'):
-        segment_ids = [seg.id for seg in query.all()]
-        return {'ids': segment_ids}
+        fields = ['id']
+    else:
+        fields = list(FilmSegmentSchema.Meta.fields)
+    columns = [getattr(FilmSegment, f) for f in fields]
+
+    return stream_query(query, columns, fields, request.args.get('format'), app.config['QUERY_STREAM_BATCH_SIZE'])
+
+@api_bp.route('/api/export')
+def query_export():
+    """
+    Every result of the query (with start/end positions) as a Parquet or Arrow IPC file. Exports are built by the
+    worker, so until the file is ready this returns 202, with URLs to poll the job and to download the result.
+    """
+    fmt = request.args.get('format', 'parquet')
+    if fmt not in EXPORT_FORMATS:
+        return f"Unsupported export format {fmt}", 400
+
+    filter_spec = {k: request.args[k] for k in FILTER_SPEC_ARGS if request.args.get(k)}
+    dataset = filter_spec.get('dataset')
+    datasets = [dataset] if dataset in flight_lines else list(flight_lines)
+    key = export_cache_key(filter_spec, fmt, segments_data_version(dataset),
+                           {ds: positioning_versions[ds] for ds in datasets}, FilmSegment.visibility_key(current_user))
+
+    filename = f"segments_{dataset or 'all'}.{fmt}"
+    handle = cached_export(key)
+    if handle is not None:
+        return artifact_store.serve(handle, EXPORT_FORMATS[fmt], filename)
+
+    user_id = current_user.id if current_user.is_authenticated else None
+    job_id = enqueue_once(queue, artifact_store, key + ':job', EXPORT_CACHE_TTL, 'export_job', export_job,
+                          failure_ttl=60, result_ttl=ARTIFACT_TTL, job_timeout=EXPORT_JOB_TIMEOUT,
+                          args=(key, filter_spec, fmt, filename, user_id, app.config['EXPORT_ROW_GROUP_SIZE']))
+    status_url = url_for('main_bp.get_job_status', job_id=job_id)
+    return {'job_id': job_id, 'status_url': status_url,
+            'result_url': url_for('main_bp.get_output_image', job_id=job_id)}, 202, {'Location': status_url}
+
+@api_bp.route('/api/geolocation')
+def segments_geolocation():
+    """
+    Start/end positions, along-track length, bounding box, and mean thickness of the segments listed in ids, or of
+    every segment matching the query filters (either way, at most SEGMENT_BATCH_MAX_IDS segments)
+    """
+    max_segments = app.config['SEGMENT_BATCH_MAX_IDS']
+    visible = FilmSegment.query_visible_to_user(current_user)
+    if request.args.get('ids') is not None:
+        ids = parse_segment_ids(request.args['ids'])
+        if ids is None:
+            return "ids must be a comma-separated list of segment ids", 400
+        if len(ids) > max_segments:
+            return f"At most {max_segments} ids can be requested at once", 400
+        spec = {'ids': ids}
+        dataset = None
+        query = visible.filter(FilmSegment.id.in_(ids))
     else:
-        #segments = [segment_schema.dump(seg) for seg in query.all()]
-        return {'segments': segments_schema.dump(query.all())}
+        spec = {k: request.args[k] for k in FILTER_SPEC_ARGS if request.args.get(k)}
+        dataset = spec.get('dataset')
+        query = ordered_query(spec, current_user)
+
+    datasets = [dataset] if dataset in flight_lines else list(flight_lines)
+    key = geolocation_cache_key(spec, segments_data_version(dataset), {ds: positioning_versions[ds] for ds in datasets},
+                                FilmSegment.visibility_key(current_user))
+
+    def build():
+        rows = query.with_entities(*GEOLOCATION_COLUMNS).limit(max_segments + 1).all()
+        if len(rows) > max_segments:
+            raise TooManySegments()
+        segments = geolocate_segments(rows, find_positioning_track)
+        if 'ids' not in spec:
+            return json.dumps({'segments': segments})
+        found = {seg['id']: seg for seg in segments}
+        return json.dumps({
+            'segments': [found[i] for i in ids if i in found],
+            'missing': [i for i in ids if i not in found]
+        })
+
+    try:
+        body = cached_geolocation(key, build)
+    except TooManySegments:
+        return f"The query matches more than {max_segments} segments. Add filters, or request them by id.", 400
+    return Response(body, mimetype='application/json')
 
 @api_bp.route('/api/test')
 def api_test_page():
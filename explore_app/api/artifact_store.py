@@ -0,0 +1,216 @@
+"""
+Storage for large job outputs (stitched images), so that RQ job results only need to hold a small handle.
+
+Workers write an output to a staging file, then move it into the store with put_file(). Web processes serve it with
+serve(). Artifacts are deleted by sweep() once they are older than ARTIFACT_TTL seconds, and abandoned staging files
+once they are older than STAGING_TTL. Workers sweep after each output they store, since that's where the files are.
+get_artifact_store() picks the backend from ARTIFACT_STORE_URL:
+
+- file:///some/dir: LocalArtifactStore, a directory. Without a URL, a directory under TMP_OUTPUTS_DIR is used.
+- s3://bucket/prefix: S3ArtifactStore, an S3 (or S3-compatible, with ARTIFACT_STORE_ENDPOINT_URL) bucket. Credentials
+  come from the usual AWS environment variables. Requires boto3.
+
+When web and worker processes run on separate machines (Heroku dynos, or SPLIT_DEPLOYMENT=1), an output written by a
+worker must be readable by the web process serving it, so ARTIFACT_STORE_URL has to be set to an object store or a
+shared volume, and the store refuses to start otherwise.
+
+Like worker.py, settings come straight from environment variables because the worker doesn't load the Flask config.
+"""
+import os
+import time
+import uuid
+import shutil
+import tempfile
+from urllib.parse import urlparse
+
+from flask import send_file, redirect
+
+try:
+    import boto3
+    import botocore.exceptions
+except ImportError:
+    boto3 = None
+
+
+ARTIFACT_TTL = int(os.getenv('ARTIFACT_TTL', 60*60))
+STAGING_TTL = int(os.getenv('ARTIFACT_STAGING_TTL', 6*60*60))  # Outputs still being written (see STITCH_JOB_TIMEOUT)
+PRESIGNED_URL_TTL = 10*60  # Seconds a download link from an object store stays valid
+
+
+class LocalArtifactStore:
+    """ Artifacts stored as <root_dir>/<artifact id>/<filename> """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.staging_dir = os.path.join(root_dir, '.staging')
+        os.makedirs(self.staging_dir, exist_ok=True)
+
+    def staging_path(self, filename):
+        """ A fresh local path to write an output to before it's added with put_file() """
+        return os.path.join(tempfile.mkdtemp(dir=self.staging_dir), filename)
+
+    def put_file(self, local_path, filename):
+        handle = f"{uuid.uuid4().hex}/{filename}"
+        dest = self.local_path(handle)
+        os.makedirs(os.path.dirname(dest))
+        os.replace(local_path, dest)
+
+        staging_subdir = os.path.dirname(local_path)
+        if os.path.dirname(staging_subdir) == self.staging_dir:
+            shutil.rmtree(staging_subdir, ignore_errors=True)
+
+        return handle
+
+    def local_path(self, handle):
+        artifact_id, filename = handle.split('/')
+        return os.path.join(self.root_dir, os.path.basename(artifact_id), os.path.basename(filename))
+
+    def exists(self, handle):
+        return os.path.exists(self.local_path(handle))
+
+    def size(self, handle):
+        return os.path.getsize(self.local_path(handle))
+
+    def delete(self, handle):
+        shutil.rmtree(os.path.dirname(self.local_path(handle)), ignore_errors=True)
+
+    def serve(self, handle, mimetype, download_name):
+        # conditional=True lets werkzeug answer Range requests, so large downloads can be resumed
+        return send_file(self.local_path(handle), mimetype=mimetype, as_attachment=True,
+                         download_name=download_name, conditional=True)
+
+    def sweep(self, ttl=ARTIFACT_TTL, staging_ttl=STAGING_TTL):
+        n_deleted = 0
+        for parent, max_age in [(self.root_dir, ttl), (self.staging_dir, staging_ttl)]:
+            if max_age is None:
+                continue
+            for entry in os.scandir(parent):
+                if (not entry.is_dir()) or (entry.path == self.staging_dir):
+                    continue
+                try:
+                    age = time.time() - entry.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+                if age > max_age:
+                    print(f"Deleting expired artifact {entry.path}")
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    n_deleted += 1
+        return n_deleted
+
+
+class S3ArtifactStore:
+    """ Artifacts stored as s3://<bucket>/<prefix><artifact id>/<filename>, staged in a local directory first """
+
+    def __init__(self, bucket, prefix, staging_root, endpoint_url=None):
+        if boto3 is None:
+            raise RuntimeError("An s3:// ARTIFACT_STORE_URL requires the boto3 package")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.local_store = LocalArtifactStore(staging_root)  # Only its staging directory is used
+
+    def staging_path(self, filename):
+        return self.local_store.staging_path(filename)
+
+    def key(self, handle):
+        artifact_id, filename = handle.split('/')
+        return f"{self.prefix}{os.path.basename(artifact_id)}/{os.path.basename(filename)}"
+
+    def put_file(self, local_path, filename):
+        handle = f"{uuid.uuid4().hex}/{filename}"
+        self.client.upload_file(local_path, self.bucket, self.key(handle))  # Multipart upload, straight from the file
+
+        staging_subdir = os.path.dirname(local_path)
+        if os.path.dirname(staging_subdir) == self.local_store.staging_dir:
+            shutil.rmtree(staging_subdir, ignore_errors=True)
+        else:
+            os.remove(local_path)
+
+        return handle
+
+    def head(self, handle):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(handle))
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def exists(self, handle, ttl=ARTIFACT_TTL):
+        # Bucket lifecycle rules only expire objects after whole days, so age is checked here too
+        head = self.head(handle)
+        return (head is not None) and (time.time() - head['LastModified'].timestamp() <= ttl)
+
+    def size(self, handle):
+        return self.head(handle)['ContentLength']
+
+    def delete(self, handle):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(handle))
+
+    def serve(self, handle, mimetype, download_name):
+        # The client downloads straight from the bucket, which handles Range requests, so large downloads can be
+        # resumed and never pass through this process
+        url = self.client.generate_presigned_url('get_object', ExpiresIn=PRESIGNED_URL_TTL, Params={
+            'Bucket': self.bucket,
+            'Key': self.key(handle),
+            'ResponseContentType': mimetype,
+            'ResponseContentDisposition': f'attachment; filename="{download_name}"'
+        })
+        return redirect(url)
+
+    def sweep(self, ttl=ARTIFACT_TTL, staging_ttl=STAGING_TTL):
+        n_deleted = self.local_store.sweep(ttl=None, staging_ttl=staging_ttl)
+        expired = []
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get('Contents', []):
+                if time.time() - obj['LastModified'].timestamp() > ttl:
+                    expired.append({'Key': obj['Key']})
+        for start in range(0, len(expired), 1000):  # delete_objects takes at most 1000 keys
+            print(f"Deleting {len(expired[start:start + 1000])} expired artifacts from s3://{self.bucket}/{self.prefix}")
+            self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': expired[start:start + 1000]})
+        return n_deleted + len(expired)
+
+
+last_sweep = 0
+
+
+def sweep_after_write(store, interval=60):
+    """
+    Called by workers after storing an output. Web and worker processes may be on separate machines, so files have to
+    be swept where they're written, not only by the web scheduler.
+    """
+    global last_sweep
+    if time.time() - last_sweep < interval:
+        return
+    last_sweep = time.time()
+    try:
+        store.sweep()
+    except Exception as e:  # Never fail the job that stored the output
+        print(f"Sweeping artifacts failed: {e}")
+
+
+def split_deployment():
+    """ True if web and worker processes run on separate machines (Heroku dynos, or SPLIT_DEPLOYMENT=1) """
+    return bool(os.getenv('DYNO')) or (os.getenv('SPLIT_DEPLOYMENT', "0") == "1")
+
+
+def get_artifact_store():
+    local_root = os.path.join(os.getenv('TMP_OUTPUTS_DIR') or tempfile.gettempdir(), 'artifacts')
+    url = os.getenv('ARTIFACT_STORE_URL')
+    if not url:
+        if split_deployment():
+            # A local directory would only be visible to the process that wrote to it
+            raise RuntimeError("Web and worker processes run on separate machines, so ARTIFACT_STORE_URL must be set "
+                               "to storage they share (s3://bucket/prefix, or file:// on a shared volume)")
+        return LocalArtifactStore(local_root)
+
+    parsed = urlparse(url)
+    if parsed.scheme == 'file':
+        return LocalArtifactStore(parsed.path)
+    elif parsed.scheme == 's3':
+        prefix = parsed.path.lstrip('/')
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        return S3ArtifactStore(parsed.netloc, prefix, local_root, os.getenv('ARTIFACT_STORE_ENDPOINT_URL'))
+    else:
+        raise ValueError(f"Unsupported artifact store {url}")
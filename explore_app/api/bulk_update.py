@@ -0,0 +1,173 @@
+"""
+Set-based bulk updates of film segments that keep the sqlalchemy-continuum version history.
+
+Changes are applied in chunks of segment ids. For each chunk, the current version rows of the segments are closed
+(end_transaction_id), the segments are updated with UPDATE ... WHERE id IN (...), and their new version rows are
+copied from the updated rows with a single INSERT ... SELECT. All chunks belong to one continuum transaction, created
+the same way as for ORM changes, so the history looks exactly as if each segment had been edited individually. Changes
+to the per-flight progress counters are worked out from the same chunks and applied when the transaction commits.
+
+Large updates are run on the RQ worker by bulk_update_job(). Like worker.py, the worker side reads its settings
+straight from environment variables because it doesn't load the Flask config.
+"""
+import os
+from collections import defaultdict, Counter
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+from sqlalchemy_continuum import versioning_manager, version_class, Operation
+from rq import get_current_job
+
+from .. import metrics
+from ..film_segment import FilmSegment
+from ..main.progress_counters import COUNTED_COLUMNS, segment_delta, add_deltas
+
+
+BULK_UPDATE_CHUNK_SIZE = int(os.getenv('BULK_UPDATE_CHUNK_SIZE', 1000))
+BULK_UPDATE_JOB_THRESHOLD = int(os.getenv('BULK_UPDATE_JOB_THRESHOLD', 2000))  # Larger updates run as an RQ job
+
+engine = None
+engine_pid = None
+
+
+def merge_changes(changes):
+    """ Combine a list of (segment id, {column: value}) into one dict per segment (later changes take precedence) """
+    merged = {}
+    for seg_id, values in changes:
+        merged.setdefault(seg_id, {}).update(values)
+    return merged
+
+
+def update_chunk(session, chunk):
+    """ Issue the UPDATEs for one chunk of {segment id: {column: value}} """
+    table = FilmSegment.__table__
+
+    # Segments getting exactly the same values are updated together with WHERE id IN (...)
+    same_values = defaultdict(list)
+    for seg_id, values in chunk.items():
+        same_values[tuple(sorted(values.items()))].append(seg_id)
+
+    # Everything else is sent as one executemany() per set of columns
+    by_columns = defaultdict(list)
+    for values, ids in same_values.items():
+        if len(ids) > 1:
+            session.execute(table.update().where(table.c.id.in_(ids)).values(dict(values)))
+        else:
+            by_columns[tuple(k for k, _ in values)].append({'_id': ids[0], **dict(values)})
+
+    for columns, params in by_columns.items():
+        stmt = table.update().where(table.c.id == sa.bindparam('_id')).values(
+            {c: sa.bindparam(c) for c in columns})
+        session.execute(stmt, params)
+
+
+def progress_delta(session, chunk):
+    """ Change in the progress counters from applying chunk, {segment id: {column: value}}, before it is applied """
+    if not any(c in COUNTED_COLUMNS for values in chunk.values() for c in values):
+        return Counter()
+
+    table = FilmSegment.__table__
+    rows = session.execute(sa.select(table.c.id, *[table.c[c] for c in COUNTED_COLUMNS]).where(
+        table.c.id.in_(list(chunk)))).all()
+
+    delta = Counter()
+    for seg_id, *values in rows:
+        before = dict(zip(COUNTED_COLUMNS, values))
+        after = dict(before, **{c: v for c, v in chunk[seg_id].items() if c in COUNTED_COLUMNS})
+        delta.update(segment_delta(before, after))
+    return delta
+
+
+def bulk_update_segments(session, changes, chunk_size=BULK_UPDATE_CHUNK_SIZE, progress=None, user_id=None,
+                         remote_addr=None):
+    """
+    Apply changes, a list of (segment id, {column name: new value}), as set-based UPDATEs while writing continuum
+    version rows in bulk. Runs within session's current transaction (the caller commits). progress, if given, is
+    called as progress(n_done, n_total) after each chunk. Returns the number of segments updated.
+
+    Continuum's FlaskPlugin fills in the user and address of the transaction from the current request. Outside of a
+    request (in bulk_update_job()), pass user_id and remote_addr to record them instead.
+    """
+    merged = merge_changes(changes)
+    ids = list(merged)
+    if not ids:
+        return 0
+
+    seg_table = FilmSegment.__table__
+    version_table = version_class(FilmSegment).__table__
+
+    # One continuum transaction for the whole update (or the one already open in this session)
+    uow = versioning_manager.unit_of_work(session)
+    transaction = uow.current_transaction or uow.create_transaction(session)
+    transaction_id = transaction.id
+    if user_id is not None:
+        transaction.user_id = user_id
+    if remote_addr is not None:
+        transaction.remote_addr = remote_addr
+
+    copied_columns = [c.name for c in seg_table.columns]
+
+    n_updated = 0
+    delta = Counter()
+    for start in range(0, len(ids), chunk_size):
+        chunk_ids = ids[start:start + chunk_size]
+
+        # Close the versions that are being replaced
+        session.execute(version_table.update().where(
+            version_table.c.id.in_(chunk_ids) & version_table.c.end_transaction_id.is_(None) &
+            (version_table.c.transaction_id != transaction_id)
+        ).values(end_transaction_id=transaction_id))
+
+        chunk = {seg_id: merged[seg_id] for seg_id in chunk_ids}
+        delta.update(progress_delta(session, chunk))
+        update_chunk(session, chunk)
+
+        # Copy the updated rows into new versions
+        session.execute(version_table.insert().from_select(
+            copied_columns + ['transaction_id', 'end_transaction_id', 'operation_type'],
+            sa.select(*[seg_table.c[c] for c in copied_columns],
+                      sa.literal(transaction_id, sa.BigInteger), sa.null(),
+                      sa.literal(Operation.UPDATE, sa.SmallInteger)
+                      ).where(seg_table.c.id.in_(chunk_ids))
+        ))
+
+        n_updated += len(chunk_ids)
+        if progress is not None:
+            progress(n_updated, len(ids))
+
+    add_deltas(session, delta)
+    metrics.incr('bulk_update.segments', n_updated)
+    return n_updated
+
+
+def get_engine():
+    global engine, engine_pid
+
+    # Never reuse connections opened by another process
+    if (engine is None) or (engine_pid != os.getpid()):
+        engine = sa.create_engine(os.getenv('DATABASE_URL').replace("postgres://", "postgresql://"))
+        engine_pid = os.getpid()
+    return engine
+
+
+def bulk_update_job(changes, user_id=None, remote_addr=None):
+    """
+    RQ job version of bulk_update_segments(), with progress reported in job.meta['progress'] (percent). user_id and
+    remote_addr are those of the request that started the job.
+    """
+    job = get_current_job()
+
+    def report_progress(n_done, n_total):
+        if job is not None:
+            job.meta['progress'] = int(100 * n_done / n_total)
+            job.save_meta()
+
+    sa.orm.configure_mappers()  # Creates the continuum version classes (the worker doesn't run the Flask app)
+
+    with Session(get_engine()) as session:
+        with metrics.timed('bulk_update.job'):
+            n_updated = bulk_update_segments(session, changes, progress=report_progress, user_id=user_id,
+                                             remote_addr=remote_addr)
+            session.commit()
+
+    return {'job_type': 'bulk_update', 'updated': n_updated}
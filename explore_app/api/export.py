@@ -0,0 +1,212 @@
+"""
+Columnar bulk export (Parquet or Arrow IPC) of film segment metadata, joined with the start and end position of each
+segment interpolated (by CBD) along the loaded flight lines.
+
+Exports are built by export_job() on the RQ worker, since a large one takes longer than a web request may. Rows are
+read from the database and written out one row group at a time, so memory use doesn't depend on the size of the
+export. Finished exports are kept in the artifact store, keyed by the filter spec, the caller's visibility, and the
+current version of the segment metadata and positioning data, so downloading the same snapshot again just serves the
+existing file. Like worker.py, the worker side reads its settings straight from environment variables.
+"""
+import os
+import json
+import time
+import hashlib
+
+import pyarrow as pa
+import pyarrow.ipc
+import pyarrow.parquet as pq
+import redis
+import sqlalchemy as sa
+from flask_login import AnonymousUserMixin
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from sqlalchemy_continuum import version_class
+
+from worker import conn
+from .. import db, metrics
+from ..film_segment import FilmSegment
+from ..user import User
+from ..main.positioning import segment_positions, track_finder
+from ..main.positioning_cache import load_cached_flight_lines
+from .artifact_store import get_artifact_store, sweep_after_write, ARTIFACT_TTL
+from .bulk_update import get_engine
+from .segment_query import ordered_query
+from .streaming import iter_row_batches
+
+
+EXPORT_FORMAT_VERSION = 2  # Bump this whenever a change would change the contents of an export
+EXPORT_CACHE_TTL = min(int(os.getenv('EXPORT_CACHE_TTL', ARTIFACT_TTL)), ARTIFACT_TTL)
+EXPORT_JOB_TIMEOUT = int(os.getenv('EXPORT_JOB_TIMEOUT', 30*60))
+DATA_VERSION_TTL = int(os.getenv('SEGMENTS_DATA_VERSION_TTL', 30))  # Seconds each process reuses a data version for
+
+artifact_store = get_artifact_store()
+data_versions = {}  # dataset -> (time, version), see segments_data_version()
+worker_flight_lines = None
+
+EXPORT_FORMATS = {
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.file'
+}
+
+SEGMENT_FIELDS = [
+    ('id', pa.int32()),
+    ('dataset', pa.string()),
+    ('path', pa.string()),
+    ('reel', pa.string()),
+    ('first_frame', pa.int32()),
+    ('last_frame', pa.int32()),
+    ('first_cbd', pa.int32()),
+    ('last_cbd', pa.int32()),
+    ('flight', pa.int32()),
+    ('raw_date', pa.int32()),
+    ('is_junk', pa.bool_()),
+    ('is_verified', pa.bool_()),
+    ('needs_review', pa.bool_()),
+    ('scope_type', pa.string()),
+    ('instrument_type', pa.int32()),
+    ('notes', pa.string()),
+    ('updated_by', pa.string()),
+    ('last_changed', pa.timestamp('us')),
+]
+POSITION_FIELDS = ['start_lat', 'start_lon', 'end_lat', 'end_lon']
+
+EXPORT_SCHEMA = pa.schema(SEGMENT_FIELDS + [(name, pa.float64()) for name in POSITION_FIELDS])
+
+
+def segments_data_version(dataset=None):
+    """
+    Changes whenever a segment (in dataset, if given) is added, modified, or deleted. The value is reused for
+    DATA_VERSION_TTL seconds, so cached results can lag behind an edit by that long.
+    """
+    cached = data_versions.get(dataset)
+    if (cached is not None) and (time.time() - cached[0] < DATA_VERSION_TTL):
+        return cached[1]
+
+    FilmSegmentVersion = version_class(FilmSegment)
+    q = db.session.query(func.max(FilmSegmentVersion.transaction_id))
+    n = FilmSegment.query
+    if dataset:
+        q = q.filter(FilmSegmentVersion.dataset == dataset)
+        n = n.filter(FilmSegment.dataset == dataset)
+    version = f"{q.scalar()}:{n.count()}"
+
+    data_versions[dataset] = (time.time(), version)
+    return version
+
+
+def export_cache_key(filter_spec, fmt, data_version, positioning_versions, visibility):
+    spec = {
+        'version': EXPORT_FORMAT_VERSION,
+        'filter_spec': filter_spec,
+        'format': fmt,
+        'data_version': data_version,
+        'positioning_versions': positioning_versions,
+        'visibility': visibility
+    }
+    return 'rfs:export:' + hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+
+def make_record_batch(rows, get_track):
+    columns = list(zip(*rows))
+    fields = dict(zip([name for name, _ in SEGMENT_FIELDS], columns))
+
+    arrays = [pa.array(col, type=t) for col, (_, t) in zip(columns, SEGMENT_FIELDS)]
+    positions = segment_positions(get_track, fields['dataset'], fields['flight'], fields['raw_date'],
+                                  fields['first_cbd'], fields['last_cbd'])
+    arrays += [pa.array(p, from_pandas=True) for p in positions]  # NaN (unknown position) becomes null
+
+    return pa.RecordBatch.from_arrays(arrays, schema=EXPORT_SCHEMA)
+
+
+def write_export(query, flight_lines, path, fmt, row_group_size):
+    """
+    Write every segment in query, with positions from flight_lines (dataset name -> loaded flight lines), to path in
+    format fmt ('parquet' or 'arrow'). Returns the number of rows written.
+    """
+    columns = [getattr(FilmSegment, name) for name, _ in SEGMENT_FIELDS]
+    get_track = track_finder(flight_lines)  # Positions come from the same tracks as /api/geolocation uses
+
+    if fmt == 'parquet':
+        writer = pq.ParquetWriter(path, EXPORT_SCHEMA, compression='zstd')
+    else:
+        writer = pa.ipc.new_file(path, EXPORT_SCHEMA)
+
+    n_rows = 0
+    try:
+        for rows in iter_row_batches(query, columns, row_group_size):
+            batch = make_record_batch(rows, get_track)
+            if fmt == 'parquet':
+                writer.write_batch(batch, row_group_size=row_group_size)
+            else:
+                writer.write_batch(batch)
+            n_rows += len(rows)
+    finally:
+        writer.close()
+
+    return n_rows
+
+
+def cached_export(key):
+    """ Artifact handle of the finished export identified by key, or None if it hasn't been built (or has expired) """
+    try:
+        handle = conn.get(key)
+    except redis.exceptions.RedisError:
+        handle = None
+
+    if (handle is not None) and artifact_store.exists(handle.decode()):
+        metrics.incr('export_cache.hit')
+        return handle.decode()
+
+    metrics.incr('export_cache.miss')
+    return None
+
+
+def load_worker_flight_lines():
+    """ The flight lines of every dataset, loaded once per worker process (from the positioning cache, like the app) """
+    global worker_flight_lines
+    if worker_flight_lines is None:
+        tmp_outputs_dir = os.getenv('TMP_OUTPUTS_DIR')
+        cache_dir = os.getenv('POSITIONING_CACHE_DIR',
+                              os.path.join(tmp_outputs_dir, 'positioning_cache') if tmp_outputs_dir else '')
+        worker_flight_lines = {
+            dataset: load_cached_flight_lines(os.getenv(f"{dataset.upper()}_FLIGHT_POSITIONING_DIR"), dataset,
+                                              cache_dir)
+            for dataset in ['antarctica', 'greenland']
+        }
+    return worker_flight_lines
+
+
+def export_job(key, filter_spec, fmt, filename, user_id, row_group_size):
+    """
+    RQ job that writes the export of the segments matching filter_spec (as seen by the user with id user_id, or an
+    anonymous user) to the artifact store, and remembers it under key for cached_export()
+    """
+    sa.orm.configure_mappers()  # Creates the continuum version classes (the worker doesn't run the Flask app)
+    flight_lines = load_worker_flight_lines()
+
+    output_path = artifact_store.staging_path(filename)
+    with Session(get_engine()) as session:
+        user = session.get(User, user_id) if user_id is not None else None
+        query = ordered_query(filter_spec, user or AnonymousUserMixin(), session=session)
+        with metrics.timed('export.build'):
+            n_rows = write_export(query, flight_lines, output_path, fmt, row_group_size)
+
+    size = os.path.getsize(output_path)
+    handle = artifact_store.put_file(output_path, filename)
+    sweep_after_write(artifact_store)
+
+    try:
+        conn.set(key, handle, ex=EXPORT_CACHE_TTL)
+    except redis.exceptions.RedisError:
+        pass
+
+    return {
+        'job_type': 'export',
+        'filename': filename,
+        'format': fmt,
+        'artifact': handle,
+        'rows': n_rows,
+        'size': size,
+        'timestamp': time.time()
+    }
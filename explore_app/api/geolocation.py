@@ -0,0 +1,85 @@
+"""
+Batch geolocation of film segments for /api/geolocation: where each segment starts and ends, how long it is along the
+flight line, its bounding box, and the mean ice thickness under it, all worked out from its CBD range with
+segment_geolocation().
+
+Responses are cached in Redis as finished JSON, keyed by the request, which segments the caller can see, and the
+current version of the segment metadata and positioning data, so repeating a request for the same snapshot skips both
+the database and the computation.
+"""
+import os
+import json
+import hashlib
+
+import numpy as np
+import redis
+
+from worker import conn
+from .. import metrics
+from ..film_segment import FilmSegment
+from ..main.positioning import segment_geolocation
+
+GEOLOCATION_FORMAT_VERSION = 1  # Bump this whenever a change would change the contents of a response
+GEOLOCATION_CACHE_TTL = int(os.getenv('GEOLOCATION_CACHE_TTL', 60*60))
+
+GEOLOCATION_COLUMNS = [FilmSegment.id, FilmSegment.dataset, FilmSegment.flight, FilmSegment.raw_date,
+                       FilmSegment.first_cbd, FilmSegment.last_cbd]
+
+
+class TooManySegments(Exception):
+    """ Raised by a build() passed to cached_geolocation() when a request matches more segments than allowed """
+
+
+def geolocation_cache_key(spec, data_version, positioning_versions, visibility):
+    spec = {
+        'version': GEOLOCATION_FORMAT_VERSION,
+        'spec': spec,
+        'data_version': data_version,
+        'positioning_versions': positioning_versions,
+        'visibility': visibility
+    }
+    return 'rfs:geolocation:' + hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+
+def geolocate_segments(rows, get_track):
+    """ One dict per row of GEOLOCATION_COLUMNS, with the segment's id and geolocation (None where unknown) """
+    if not rows:
+        return []
+    ids, datasets, flights, raw_dates, first_cbds, last_cbds = zip(*rows)
+    geo = segment_geolocation(get_track, datasets, flights, raw_dates, first_cbds, last_cbds)
+    geo = {k: np.where(np.isnan(v), None, v).tolist() for k, v in geo.items()}
+
+    return [{
+        'id': seg_id,
+        'start_lat': geo['start_lat'][i],
+        'start_lon': geo['start_lon'][i],
+        'end_lat': geo['end_lat'][i],
+        'end_lon': geo['end_lon'][i],
+        'length_m': geo['length_m'][i],
+        'bbox': [geo['min_lon'][i], geo['min_lat'][i], geo['max_lon'][i], geo['max_lat'][i]],
+        'bbox_xy': [geo['min_x'][i], geo['min_y'][i], geo['max_x'][i], geo['max_y'][i]],
+        'mean_thickness': geo['mean_thickness'][i]
+    } for i, seg_id in enumerate(ids)]
+
+
+def cached_geolocation(key, build):
+    """ JSON response body for key, from the cache or from build() (which is then cached, unless it raises) """
+    try:
+        body = conn.get(key)
+    except redis.exceptions.RedisError:
+        body = None
+
+    if body is not None:
+        metrics.incr('geolocation_cache.hit')
+        return body.decode()
+
+    metrics.incr('geolocation_cache.miss')
+    with metrics.timed('geolocation.build'):
+        body = build()
+
+    try:
+        conn.set(key, body, ex=GEOLOCATION_CACHE_TTL)
+    except redis.exceptions.RedisError:
+        pass
+
+    return body
@@ -0,0 +1,136 @@
+import os
+import time
+import fcntl
+import hashlib
+import tempfile
+
+from .. import metrics
+
+
+CACHE_FORMAT_VERSION = 1  # Bump this if the way derived images are produced or encoded changes
+EVICT_TARGET = 0.9  # When over budget, evict down to this fraction of max_bytes
+STALE_TMP_AGE = 60*60  # Partially written files older than this are assumed to be left over from a crashed process
+
+
+class DerivedImageCache:
+    """
+    Disk-backed LRU cache of derived (resized, cropped, ...) images.
+
+    Each entry is a single file named by a hash of (segment id, operation, parameters, source version). Files are
+    written atomically (to a temporary file and then renamed into place), so any number of gunicorn workers can share
+    the same directory. The modification time of each file is used as its last access time, and the least recently
+    used files are removed whenever the total size of the cache grows beyond max_bytes.
+
+    Without an absolute cache_dir the cache is disabled: nothing is stored and every lookup misses.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.enabled = bool(cache_dir) and os.path.isabs(cache_dir)
+        if cache_dir and not self.enabled:
+            print(f"Derived image cache directory {cache_dir} is not an absolute path, disabling the cache")
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.bytes_since_evict = None  # Forces a size check on the first write from this process
+        if self.enabled:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def make_key(self, segment_id, operation, params, source_version):
+        raw = f"{CACHE_FORMAT_VERSION}|{segment_id}|{operation}|{params}|{source_version}"
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.bin")
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        p = self.entry_path(key)
+        try:
+            with open(p, 'rb') as f:
+                data = f.read()
+            os.utime(p)  # Mark as recently used
+        except FileNotFoundError:  # Never cached or already evicted
+            metrics.incr('derived_image_cache.miss')
+            return None
+
+        metrics.incr('derived_image_cache.hit')
+        return data
+
+    def put(self, key, data):
+        if not self.enabled:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.entry_path(key))
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        if self.bytes_since_evict is None:
+            self.bytes_since_evict = self.max_bytes
+        else:
+            self.bytes_since_evict += len(data)
+
+        # Only scan the cache directory once this process alone could have pushed it meaningfully over budget
+        if self.bytes_since_evict >= self.max_bytes * (1 - EVICT_TARGET) / 2:
+            self.evict()
+
+    def evict(self):
+        self.bytes_since_evict = 0
+
+        with open(os.path.join(self.cache_dir, '.lock'), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:  # Someone else is already evicting
+                return
+
+            entries = []
+            total_bytes = 0
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith('.tmp'):
+                    try:
+                        if time.time() - entry.stat().st_mtime > STALE_TMP_AGE:
+                            os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+                    continue
+                if not entry.name.endswith('.bin'):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total_bytes += st.st_size
+
+            if total_bytes <= self.max_bytes:
+                return
+
+            entries.sort()  # Oldest access first
+            for _, size, path in entries:
+                if total_bytes <= self.max_bytes * EVICT_TARGET:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_bytes -= size
+                metrics.incr('derived_image_cache.evicted')
+
+    def stats(self):
+        n_entries = 0
+        total_bytes = 0
+        for entry in (os.scandir(self.cache_dir) if self.enabled else []):
+            if entry.name.endswith('.bin'):
+                try:
+                    total_bytes += entry.stat().st_size
+                    n_entries += 1
+                except FileNotFoundError:
+                    pass
+
+        stats = {'enabled': self.enabled, 'entries': n_entries, 'bytes': total_bytes, 'max_bytes': self.max_bytes}
+        stats.update(metrics.get_metrics(prefix='derived_image_cache.'))
+        return stats
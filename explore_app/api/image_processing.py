@@ -1,48 +1,96 @@
 import os
 import time
-from io import BytesIO
-import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 from PIL import Image, ImageOps
 
+from .remote_fetch import open_image
+from .artifact_store import get_artifact_store, sweep_after_write, STAGING_TTL
+from .tiff_writer import TiledTiffWriter, writable_mode
+from .. import metrics
+
 
 OVERLAP_FACTOR = 88 / 11362  # Overlap between adjacent radargram images as a percentage of the width of the image
 
+STITCH_LOAD_WORKERS = int(os.getenv('STITCH_LOAD_WORKERS', 4))  # Threads downloading and decoding images
+STITCH_MAX_IN_FLIGHT = int(os.getenv('STITCH_MAX_IN_FLIGHT', 8))  # Max decoded images not yet handed to the stitcher
+STITCH_STREAMING_IN_FLIGHT = int(os.getenv('STITCH_STREAMING_IN_FLIGHT', 2))  # The same for the streaming stitcher
+# Must finish well before its staging files can be swept
+STITCH_JOB_TIMEOUT = min(int(os.getenv('STITCH_JOB_TIMEOUT', 60*60)), STAGING_TTL // 2)
 
-def worker_load_image(file_path):
-    if "https://" in file_path:
-        response = requests.get(file_path)
-        return Image.open(BytesIO(response.content))
-    else:
-        return Image.open(file_path)
+artifact_store = get_artifact_store()
 
 
-def stitch_images(img_paths, image_type, flip, scale_x, scale_y, qid):
-    print(f'Starting stitch with qid {qid}')
-    t_start = time.time()
+def worker_load_image(file_path):
+    return open_image(file_path)
 
-    if image_type == 'jpg' or image_type == 'JPG':
-        image_output_type = 'PNG'
-    else:
-        image_output_type = 'TIFF'
 
-    images = []
-    sum_x = 0
-    for img_path in img_paths:
-        if image_output_type == 'PNG':
-            filename_out = f"stitch-{qid}.png"
-        else:  # otherwise assume TIFF
-            filename_out = f"stitch-{qid}.tiff"
-
-        im = worker_load_image(img_path)
+def load_and_resize_image(img_path, flip, scale_x, scale_y, resample=None):
+    im = worker_load_image(img_path)
+    with metrics.timed('stitch_images.image_ops'):
         if flip == 'x':
             im = ImageOps.mirror(im)
 
-        if image_output_type == 'PNG':
-            im = im.resize((round(im.size[0] * scale_x), round(im.size[1] * scale_y)))
+        size = (round(im.size[0] * scale_x), round(im.size[1] * scale_y))
+        if resample is None:
+            im = im.resize(size)
         else:
-            im = im.resize((round(im.size[0] * scale_x), round(im.size[1] * scale_y)), resample=Image.NEAREST)
+            im = im.resize(size, resample=resample)
+
+    return im
+
+
+def iter_loaded_images(img_paths, flip, scale_x, scale_y, resample=None,
+                       n_workers=STITCH_LOAD_WORKERS, max_in_flight=STITCH_MAX_IN_FLIGHT):
+    """
+    Load, mirror and resize each of img_paths on a pool of n_workers threads, yielding the images in the same order
+    as img_paths. No more than max_in_flight images are loading or waiting to be consumed at any time (plus the one
+    most recently yielded), which bounds peak memory regardless of how many images there are.
+    """
+    max_in_flight = max(max_in_flight, n_workers, 1)
+    paths = iter(img_paths)
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        def submit_next():
+            p = next(paths, None)
+            if p is not None:
+                pending.append(executor.submit(load_and_resize_image, p, flip, scale_x, scale_y, resample))
+
+        try:
+            for _ in range(max_in_flight):
+                submit_next()
+
+            while pending:
+                im = pending.popleft().result()
+                submit_next()
+                yield im
+        finally:
+            for f in pending:
+                f.cancel()
+
+
+def stitch_output_format(image_type, qid):
+    if image_type == 'jpg' or image_type == 'JPG':
+        return 'PNG', f"stitch-{qid}.png", None
+    else:  # otherwise assume TIFF
+        return 'TIFF', f"stitch-{qid}.tiff", Image.NEAREST
+
+
+def stitch_images(img_paths, image_type, flip, scale_x, scale_y, qid, n_workers=STITCH_LOAD_WORKERS, streaming=False):
+    if streaming:
+        return stitch_images_streaming(img_paths, image_type, flip, scale_x, scale_y, qid, n_workers=n_workers)
+
+    print(f'Starting stitch with qid {qid}')
+    t_start = time.time()
 
+    image_output_type, filename_out, resample = stitch_output_format(image_type, qid)
+
+    images = []
+    sum_x = 0
+    for im in iter_loaded_images(img_paths, flip, scale_x, scale_y, resample=resample, n_workers=n_workers):
         images.append(im)
         sum_x += im.width
 
@@ -58,18 +106,94 @@ def stitch_images(img_paths, image_type, flip, scale_x, scale_y, qid):
 
     if flip == 'x':
         im_output = ImageOps.mirror(im_output)
-    
-    img_io = BytesIO()
-    im_output.save(img_io, image_output_type)
-    img_io.seek(0)
 
+    output_path = artifact_store.staging_path(filename_out)
+    im_output.save(output_path, image_output_type)
+    im_output.close()
 
     print(f"Completed stitch in {time.time() - t_start} seconds")
 
+    return stitch_result(output_path, filename_out, image_output_type)
+
+
+def stitch_result(output_path, filename_out, image_output_type):
+    """ Move a finished output into the artifact store and describe it. Only this small dict goes back to Redis. """
+    size = os.path.getsize(output_path)
+    handle = artifact_store.put_file(output_path, filename_out)
+    sweep_after_write(artifact_store)
     return {
         'job_type': 'stitch_images',
         'filename': filename_out,
         'image_type': image_output_type,
-        'image': img_io,
+        'artifact': handle,
+        'size': size,
         'timestamp': time.time()
-    }
\ No newline at end of file
+    }
+
+
+def stitch_images_streaming(img_paths, image_type, flip, scale_x, scale_y, qid, n_workers=STITCH_LOAD_WORKERS):
+    """
+    Constant-memory version of stitch_images.
+
+    The output is always a tiled TIFF, written left to right as the images are loaded, so only the images being loaded
+    (at most STITCH_STREAMING_IN_FLIGHT) and the one being written are in memory, and the output file is the only thing
+    written to disk. With flip == 'x' the output is the mirror image of the unflipped stitch of the mirrored images,
+    which puts the last image on the left, so images are loaded last to first (after the first, which sets the
+    height and overlap and is kept until it's written at the right edge).
+    """
+    print(f'Starting streaming stitch with qid {qid}')
+    t_start = time.time()
+
+    _, _, resample = stitch_output_format(image_type, qid)
+    image_output_type, filename_out, _ = stitch_output_format('tiff', qid)
+    output_path = artifact_store.staging_path(filename_out)
+
+    n_images = len(img_paths)
+    order = list(range(n_images)) if flip != 'x' else [0] + list(range(n_images - 1, 0, -1))
+    n_workers = max(1, min(n_workers, STITCH_STREAMING_IN_FLIGHT))
+
+    writer = None
+    first_columns = None
+    try:
+        loaded = iter_loaded_images([img_paths[i] for i in order], flip, scale_x, scale_y, resample=resample,
+                                    n_workers=n_workers, max_in_flight=n_workers)
+        for idx, im in zip(order, loaded):
+            if writer is None:
+                mode, height = writable_mode(im.mode), im.height
+                overlap_px = int(im.width * OVERLAP_FACTOR)
+                half_overlap = int(overlap_px / 2)
+                writer = TiledTiffWriter(output_path, mode, height)
+                if flip != 'x':
+                    writer.write(np.zeros((height, half_overlap) + writer.tile.shape[2:], dtype=writer.dtype))
+            if im.mode != mode:
+                im = im.convert(mode)
+
+            # Matches the in-memory stitcher: every image has the left half of the overlap cropped off, and the right
+            # half of its overlap is covered by the next image (except for the last image)
+            visible_width = im.width - (half_overlap if idx == n_images - 1 else overlap_px)
+            columns = np.asarray(im.crop((half_overlap, 0, half_overlap + visible_width, height)))
+            im.close()
+            if flip == 'x':
+                columns = columns[:, ::-1]
+
+            if (flip == 'x') and (idx == 0) and (n_images > 1):
+                first_columns = columns  # Goes on the right, after all the others
+            else:
+                writer.write(columns)
+            del columns
+
+        if first_columns is not None:
+            writer.write(first_columns)
+        if flip == 'x':
+            writer.write(np.zeros((height, half_overlap) + writer.tile.shape[2:], dtype=writer.dtype))
+        writer.close()
+    except BaseException:
+        if writer is not None:
+            writer.f.close()
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+
+    print(f"Completed streaming stitch in {time.time() - t_start} seconds")
+
+    return stitch_result(output_path, filename_out, image_output_type)
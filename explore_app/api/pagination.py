@@ -0,0 +1,177 @@
+"""
+Keyset (seek) pagination for film segment queries.
+
+Instead of OFFSET, each page starts right after (or ends right before) the last row of the page the user came from,
+identified by an opaque cursor holding that row's sort value and id. With an index on (sort column, id), fetching
+page 1000 costs the same as fetching page 1.
+
+Rows are ordered by the sort column with NULLs last, then by id. Rows with a NULL sort value can't be compared with
+a row comparison, so they are fetched by a second query once the non-NULL rows run out. Each query can be answered
+directly from the index.
+"""
+import json
+import math
+import base64
+import binascii
+
+from sqlalchemy import tuple_, text, true
+
+from explore_app.film_segment import FilmSegment
+
+
+SORT_COLUMNS = {
+    'cbd': FilmSegment.first_cbd,
+    'frame': FilmSegment.first_frame,
+    'id': FilmSegment.id
+}
+
+# Cursor directions
+NEXT = 'next'  # Rows after the cursor
+PREV = 'prev'  # Rows before the cursor
+LAST = 'last'  # The final page (no position needed, but it may say how many rows the final page has)
+
+EXACT_COUNT_BELOW = 10000  # Planner estimates below this are replaced with an exact count, which is cheap at this size
+
+
+def encode_cursor(sort_key, direction, seg=None, page_size=None):
+    c = {'s': sort_key, 'd': direction}
+    if seg is not None:
+        c['v'] = getattr(seg, SORT_COLUMNS[sort_key].key)
+        c['id'] = seg.id
+    if page_size is not None:
+        c['n'] = page_size
+    return base64.urlsafe_b64encode(json.dumps(c).encode()).decode()
+
+
+def last_page_cursor(sort_key, n_total, n, exact=True):
+    """
+    Cursor for the final page of n_total results, n per page. If n_total is exact, the final page only holds the rows
+    left over after the full pages before it, so that stepping back from it lands on the same pages as counting
+    forward from the start. If it's an estimate, the final page is the last n rows, read with a reverse keyset query,
+    so it never depends on the estimate.
+    """
+    if not exact:
+        return encode_cursor(sort_key, LAST)
+    n_rows = n_total - (max(math.ceil(n_total / n), 1) - 1) * n
+    return encode_cursor(sort_key, LAST, page_size=n_rows if n_rows > 0 else None)
+
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def decode_cursor(cursor, sort_key):
+    """ Returns the decoded cursor, or None if it is empty, malformed, or was made for a different sort order """
+    if not cursor:
+        return None
+    try:
+        c = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, binascii.Error):
+        return None
+    if (not isinstance(c, dict)) or (c.get('s') != sort_key) or (c.get('d') not in (NEXT, PREV, LAST)):
+        return None
+    if (c['d'] != LAST) and not is_int(c.get('id')):
+        return None
+    # Every sort column is an integer column. Anything else would make the row comparison fail in the database.
+    if (c.get('v') is not None) and not is_int(c['v']):
+        return None
+    if ('n' in c) and not (is_int(c['n']) and c['n'] > 0):
+        return None
+    return c
+
+
+def keyset_parts(sort_key, cursor):
+    """ List of (filter, ordering) to query in turn, in the order the rows should be read """
+    col = SORT_COLUMNS[sort_key]
+    seg_id = FilmSegment.id
+    backwards = (cursor is not None) and (cursor['d'] in (PREV, LAST))
+
+    if sort_key == 'id':
+        if (cursor is None) or (cursor['d'] == LAST):
+            f = true()
+        else:
+            f = (seg_id < cursor['id']) if backwards else (seg_id > cursor['id'])
+        return [(f, [seg_id.desc() if backwards else seg_id.asc()])]
+
+    forward_values = [col.asc(), seg_id.asc()]
+    forward_nulls = [seg_id.asc()]
+    backward_values = [col.desc(), seg_id.desc()]
+    backward_nulls = [seg_id.desc()]
+
+    if cursor is None:
+        return [(col.isnot(None), forward_values), (col.is_(None), forward_nulls)]
+    elif cursor['d'] == LAST:
+        return [(col.is_(None), backward_nulls), (col.isnot(None), backward_values)]
+    elif cursor['d'] == NEXT:
+        if cursor.get('v') is None:
+            return [(col.is_(None) & (seg_id > cursor['id']), forward_nulls)]
+        else:
+            return [(tuple_(col, seg_id) > tuple_(cursor['v'], cursor['id']), forward_values),
+                    (col.is_(None), forward_nulls)]
+    else:  # PREV
+        if cursor.get('v') is None:
+            return [(col.is_(None) & (seg_id < cursor['id']), backward_nulls), (col.isnot(None), backward_values)]
+        else:
+            return [(tuple_(col, seg_id) < tuple_(cursor['v'], cursor['id']), backward_values)]
+
+
+def sort_order(sort_key):
+    """ Ordering used by keyset_page(), for use with OFFSET pagination so that the same cursors can be used """
+    if sort_key == 'id':
+        return [FilmSegment.id.asc()]
+    else:
+        return [SORT_COLUMNS[sort_key].asc().nulls_last(), FilmSegment.id.asc()]
+
+
+def page_cursors(sort_key, rows, has_next, has_prev):
+    next_cursor = encode_cursor(sort_key, NEXT, rows[-1]) if (has_next and rows) else None
+    prev_cursor = encode_cursor(sort_key, PREV, rows[0]) if (has_prev and rows) else None
+    return next_cursor, prev_cursor
+
+
+def keyset_page(query, sort_key, cursor, n):
+    """
+    Fetch one page of (at most n) segments from query, positioned by cursor (a decoded cursor, or None for the first
+    page). Returns the page in display order, plus cursors for the next and previous pages (None if there are none).
+    """
+    if (cursor is not None) and (cursor['d'] == LAST) and ('n' in cursor):
+        n = min(cursor['n'], n)
+
+    rows = []
+    for f, ordering in keyset_parts(sort_key, cursor):
+        rows += query.filter(f).order_by(*ordering).limit(n + 1 - len(rows)).all()
+        if len(rows) > n:
+            break
+
+    has_more = len(rows) > n  # More rows in the direction we were reading
+    rows = rows[:n]
+
+    if (cursor is not None) and (cursor['d'] in (PREV, LAST)):
+        rows.reverse()
+        has_next = (cursor['d'] == PREV)
+        has_prev = has_more
+    else:
+        has_next = has_more
+        has_prev = (cursor is not None)
+
+    return (rows,) + page_cursors(sort_key, rows, has_next, has_prev)
+
+
+def count_results(query, mode):
+    """
+    Number of results in query: 'exact' runs a COUNT, 'approx' uses the PostgreSQL planner's row estimate (which
+    doesn't scan the table), and anything else skips counting and returns None.
+    """
+    if mode == 'exact':
+        return query.count()
+    elif mode == 'approx':
+        bind = query.session.get_bind()
+        if bind.dialect.name != 'postgresql':
+            return query.count()
+        statement = query.statement.compile(bind, compile_kwargs={"literal_binds": True})
+        plan = query.session.execute(text(f"EXPLAIN (FORMAT JSON) {statement}")).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+    else:
+        return None
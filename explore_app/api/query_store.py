@@ -0,0 +1,105 @@
+"""
+Store for recorded queries (the query_id used by the query pages to refer back to a set of results).
+
+Entries are kept in Redis so that a query_id created by one gunicorn worker can be used by any other. Lists of
+segment ids are stored as packed int32 arrays rather than Python lists. Every entry expires after ttl seconds, and
+the oldest entries are dropped once there are more than max_entries. If Redis can't be reached, entries are kept in a
+per-process dict with the same limits.
+"""
+import json
+import time
+from collections import OrderedDict
+
+import numpy as np
+import redis
+
+from .. import metrics
+
+
+KEY_PREFIX = 'rfs:query:'
+INDEX_KEY = 'rfs:query_index'  # Sorted set of query ids by creation time, used to enforce max_entries
+
+
+def pack_query_log(query_log):
+    packed = {}
+    for k, v in query_log.items():
+        if isinstance(v, (list, tuple, np.ndarray)):
+            packed[f"ids:{k}"] = np.asarray(v, dtype='<i4').tobytes()
+        else:
+            packed[f"json:{k}"] = json.dumps(v)
+    return packed
+
+
+def unpack_query_log(packed):
+    query_log = {}
+    for k, v in packed.items():
+        if isinstance(k, bytes):
+            k = k.decode()
+        kind, name = k.split(':', 1)
+        if kind == 'ids':
+            query_log[name] = np.frombuffer(v, dtype='<i4').tolist()
+        else:
+            query_log[name] = json.loads(v)
+    return query_log
+
+
+class QueryStore:
+
+    def __init__(self, conn, ttl, max_entries):
+        self.conn = conn
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.local_entries = OrderedDict()  # qid -> packed query log, only used if Redis is unavailable
+
+    def put(self, qid, query_log):
+        packed = pack_query_log(query_log)
+        metrics.incr('query_store.put')
+        metrics.incr('query_store.bytes', sum(len(v) for v in packed.values()))
+
+        try:
+            now = time.time()
+            pipe = self.conn.pipeline()
+            pipe.hset(KEY_PREFIX + qid, mapping=packed)
+            pipe.expire(KEY_PREFIX + qid, self.ttl)
+            pipe.zadd(INDEX_KEY, {qid: now})
+            pipe.zremrangebyscore(INDEX_KEY, '-inf', now - self.ttl)  # Already expired by Redis
+            pipe.zcard(INDEX_KEY)
+            n_entries = pipe.execute()[-1]
+
+            if n_entries > self.max_entries:
+                oldest = self.conn.zpopmin(INDEX_KEY, n_entries - self.max_entries)
+                if oldest:
+                    self.conn.delete(*[KEY_PREFIX + old_qid.decode() for old_qid, _ in oldest])
+                    metrics.incr('query_store.evicted', len(oldest))
+        except redis.exceptions.RedisError:
+            metrics.incr('query_store.local_fallback')
+            self.local_entries[qid] = (time.time(), packed)
+            self.sweep()
+
+    def get(self, qid):
+        packed = None
+        try:
+            packed = self.conn.hgetall(KEY_PREFIX + qid)
+        except redis.exceptions.RedisError:
+            pass
+
+        if not packed:
+            timestamp, packed = self.local_entries.get(qid, (None, None))
+            if (timestamp is not None) and (time.time() - timestamp > self.ttl):
+                packed = None
+
+        if not packed:
+            metrics.incr('query_store.miss')
+            return None
+
+        metrics.incr('query_store.hit')
+        return unpack_query_log(packed)
+
+    def sweep(self):
+        """ Expire entries in the local fallback store (Redis expires its own entries) """
+        for qid in list(self.local_entries):
+            if time.time() - self.local_entries[qid][0] > self.ttl:
+                self.local_entries.pop(qid, None)
+        while len(self.local_entries) > self.max_entries:
+            self.local_entries.popitem(last=False)
+            metrics.incr('query_store.evicted')
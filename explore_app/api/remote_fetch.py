@@ -0,0 +1,204 @@
+"""
+Shared HTTP fetch layer for loading film images from cloud storage.
+
+Used by both the web processes (load_image) and the RQ workers (worker_load_image). Each process keeps one
+requests.Session with a pool of keep-alive connections, so repeated fetches from the same bucket skip the TCP and
+TLS handshakes. Like worker.py, settings come straight from environment variables because the worker doesn't load
+the Flask config.
+"""
+import os
+import time
+import logging
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from PIL import Image
+
+from .. import metrics
+
+
+CONNECT_TIMEOUT = float(os.getenv('IMAGE_FETCH_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.getenv('IMAGE_FETCH_READ_TIMEOUT', 60))
+MAX_RETRIES = int(os.getenv('IMAGE_FETCH_MAX_RETRIES', 3))
+BACKOFF_SECONDS = float(os.getenv('IMAGE_FETCH_BACKOFF_SECONDS', 0.5))
+POOL_SIZE = int(os.getenv('IMAGE_FETCH_POOL_SIZE', 16))
+CHUNK_SIZE = 1024*1024  # Bytes read at a time
+SOURCE_VERSION_TTL = float(os.getenv('SOURCE_VERSION_TTL', 5*60))
+SOURCE_VERSION_MAX_ENTRIES = 100000
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+logger = logging.getLogger(__name__)
+
+session = None
+session_pid = None
+session_lock = threading.Lock()
+
+source_versions = OrderedDict()  # url -> (time checked, version), least recently checked first
+source_versions_lock = threading.Lock()
+
+
+class RetryableStatus(Exception):
+    pass
+
+
+def get_session():
+    global session, session_pid
+
+    # gunicorn --preload forks after import, so never reuse sockets opened by another process
+    if (session is None) or (session_pid != os.getpid()):
+        with session_lock:
+            if (session is None) or (session_pid != os.getpid()):
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+                s.mount('https://', adapter)
+                s.mount('http://', adapter)
+                session = s
+                session_pid = os.getpid()
+
+    return session
+
+
+def read_response(response):
+    """
+    Read the body of response into a BytesIO, without copying it again afterwards.
+
+    When the server gives the size of an unencoded body in Content-Length, the BytesIO is allocated at that size up front
+    and the raw bytes are read straight into it. Otherwise (or if the body turns out to be longer), the rest is read in
+    chunks and appended.
+    """
+    raw = response.raw
+    encoding = response.headers.get('Content-Encoding', 'identity').lower()
+    try:
+        length = int(response.headers['Content-Length']) if encoding == 'identity' else None
+    except (KeyError, ValueError):
+        length = None
+
+    body = BytesIO()
+    n = 0
+    if length:
+        raw.decode_content = False  # Content-Length counts the bytes as sent
+        body.seek(length - 1)
+        body.write(b'\0')  # Grow the buffer to its full size once
+        with body.getbuffer() as buf:
+            while n < length:
+                # In chunks, since urllib3 reads each readinto() into a temporary bytes object first
+                with buf[n:min(n + CHUNK_SIZE, length)] as view:
+                    n_read = raw.readinto(view)
+                if not n_read:
+                    break
+                n += n_read
+        body.seek(n)
+    else:
+        raw.decode_content = True
+
+    # No (or a wrong) Content-Length: read whatever is left in chunks
+    while True:
+        chunk = raw.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        body.write(chunk)
+        n += len(chunk)
+
+    body.truncate(n)
+    body.seek(0)
+    return body
+
+
+def fetch_file(url):
+    """ The contents of url as a BytesIO, retrying connection errors and retryable statuses with backoff """
+    t_start = time.time()
+
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            with get_session().get(url, stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)) as response:
+                if response.status_code in RETRY_STATUS_CODES:
+                    raise RetryableStatus(f"HTTP {response.status_code} fetching {url}")
+                response.raise_for_status()
+                data = read_response(response)
+            break
+        except (RetryableStatus, requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError, urllib3.exceptions.ProtocolError,
+                urllib3.exceptions.ReadTimeoutError) as e:
+            if attempt == MAX_RETRIES:
+                metrics.incr('image_fetch.failed')
+                raise
+            metrics.incr('image_fetch.retried')
+            logger.warning(f"Retrying fetch of {url} after error: {e}")
+            time.sleep(BACKOFF_SECONDS * (2 ** attempt))
+
+    elapsed = time.time() - t_start
+    size = data.seek(0, os.SEEK_END)
+    data.seek(0)
+    metrics.observe('image_fetch', elapsed, size=size)
+    logger.debug(f"Fetched {size} bytes from {url} in {elapsed:.3f} seconds")
+
+    return data
+
+
+def source_version(path):
+    """
+    Identifies the current contents of an image: its size and mtime for a local file, or the ETag (or Last-Modified
+    and Content-Length) from a HEAD request for a remote one. None if that can't be determined.
+
+    Remote versions are remembered for SOURCE_VERSION_TTL seconds, so a warm cache doesn't cost a round trip per
+    request (and an image replaced in place is picked up within that time).
+    """
+    if "https://" in path:
+        with source_versions_lock:
+            cached = source_versions.get(path)
+        if (cached is not None) and (time.time() - cached[0] < SOURCE_VERSION_TTL):
+            metrics.incr('source_version.hit')
+            return cached[1]
+
+        metrics.incr('source_version.miss')
+        version = remote_source_version(path)
+        if version is not None:
+            with source_versions_lock:
+                source_versions[path] = (time.time(), version)
+                source_versions.move_to_end(path)
+                while len(source_versions) > SOURCE_VERSION_MAX_ENTRIES:
+                    source_versions.popitem(last=False)
+        return version
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return f"stat:{st.st_size}|{st.st_mtime_ns}"
+
+
+def source_versions_of(paths):
+    """ source_version() of each of paths, in order. Remote images not checked recently are checked in parallel. """
+    paths = list(paths)
+    if len(paths) <= 1:
+        return [source_version(p) for p in paths]
+    with ThreadPoolExecutor(max_workers=min(POOL_SIZE, len(paths))) as executor:
+        return list(executor.map(source_version, paths))
+
+
+def remote_source_version(path):
+    """ Version of a remote image from a HEAD request (see source_version()) """
+    try:
+        with get_session().head(path, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), allow_redirects=True) as response:
+            response.raise_for_status()
+            headers = response.headers
+    except requests.exceptions.RequestException:
+        return None
+    if headers.get('ETag'):
+        return f"etag:{headers['ETag']}"
+    if headers.get('Last-Modified'):
+        return f"modified:{headers['Last-Modified']}|{headers.get('Content-Length')}"
+    return None
+
+
+def open_image(path):
+    if "https://" in path:
+        return Image.open(fetch_file(path))
+    else:
+        return Image.open(path)
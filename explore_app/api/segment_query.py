@@ -0,0 +1,61 @@
+"""
+Filtering of film segment queries by the query page's arguments, shared by the web routes and the RQ jobs that run a
+recorded query (which pass their own user and session, since they have no request).
+"""
+from explore_app.film_segment import FilmSegment
+from .pagination import SORT_COLUMNS, sort_order
+
+
+# Query arguments that determine which segments (and in what order) a query returns
+FILTER_SPEC_ARGS = ['flight', 'reel', 'verified', 'scope', 'dataset', 'mincbd', 'maxcbd', 'minframe', 'maxframe', 'sort', 'skip']
+
+
+def filtered_query(args, user, session=None):
+    """
+    Query for the segments visible to user that match args (request.args, or a filter spec recorded from them),
+    without ordering
+    """
+    query = FilmSegment.query_visible_to_user(user, session=session)
+
+    # Filters
+
+    if args.get('flight'):
+        query = query.filter(FilmSegment.flight == int(args.get('flight')))
+
+    if args.get('reel'):
+        query = query.filter(FilmSegment.reel == args.get('reel'))
+
+    if args.get('verified'):
+        if int(args.get('verified')) == 0:
+            query = query.filter(FilmSegment.is_verified == False)
+        elif int(args.get('verified')) == 1:
+            query = query.filter(FilmSegment.is_verified == True)
+
+    if args.get('scope'):
+        query = query.filter(FilmSegment.scope_type == args.get('scope'))
+
+    if args.get('dataset'):
+        query = query.filter(FilmSegment.dataset == args.get('dataset'))
+
+    if args.get('mincbd'):
+        query = query.filter(FilmSegment.first_cbd >= int(args.get('mincbd')))
+
+    if args.get('maxcbd'):
+        query = query.filter(FilmSegment.first_cbd <= int(args.get('maxcbd')))
+
+    if args.get('minframe'):
+        query = query.filter(FilmSegment.first_frame >= int(args.get('minframe')))
+
+    if args.get('maxframe'):
+        query = query.filter(FilmSegment.first_frame <= int(args.get('maxframe')))
+
+    return query
+
+
+def ordered_query(args, user, session=None):
+    """ Every segment matching args, in the order they'd be shown on the query pages (ignoring pagination) """
+    sort_key = args.get('sort') if args.get('sort') in SORT_COLUMNS else 'id'
+    query = filtered_query(args, user, session=session).order_by(*sort_order(sort_key))
+    if args.get('skip'):
+        query = query.offset(int(args.get('skip')))
+    return query
@@ -0,0 +1,91 @@
+"""
+De-duplication of stitch jobs.
+
+Stitch requests are keyed by a hash of the ordered image paths, the current version of each image (see
+remote_fetch.source_version()) and the stitch parameters. The key maps (in Redis) to the id of the job that produces
+that output, so pressing "stitch" again on the same query attaches to the job that is already running, or serves its
+finished artifact, instead of decoding every image again. Export jobs are
+de-duplicated the same way with enqueue_once().
+"""
+import os
+import json
+import uuid
+import hashlib
+
+from rq.job import Job
+from rq.exceptions import NoSuchJobError
+
+from worker import conn
+from .. import metrics
+from .artifact_store import ARTIFACT_TTL
+from .remote_fetch import source_versions_of
+
+
+STITCH_FORMAT_VERSION = 1  # Bump this whenever a change to the stitcher would change its output
+STITCH_CACHE_TTL = min(int(os.getenv('STITCH_CACHE_TTL', ARTIFACT_TTL)), ARTIFACT_TTL)
+
+IN_FLIGHT_STATUSES = ('queued', 'started', 'deferred', 'scheduled')
+
+
+def stitch_cache_key(img_paths, image_type, flip, scale_x, scale_y):
+    # A source replaced in place changes its version, so it gets a new key instead of the stale stitch
+    img_paths = list(img_paths)
+    spec = {
+        'version': STITCH_FORMAT_VERSION,
+        'img_paths': img_paths,
+        'source_versions': source_versions_of(img_paths),
+        'image_type': image_type,
+        'flip': flip,
+        'scale_x': scale_x,
+        'scale_y': scale_y
+    }
+    return 'rfs:stitch:' + hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+
+def reusable_job_status(job_id, artifact_store):
+    """ Returns 'finished' or 'in_flight' if the job's output can be reused, otherwise None """
+    try:
+        job = Job.fetch(job_id, connection=conn)
+    except NoSuchJobError:
+        return None
+
+    status = job.get_status()
+    if status == 'finished':
+        if job.result and artifact_store.exists(job.result['artifact']):
+            return 'finished'
+    elif status in IN_FLIGHT_STATUSES:
+        return 'in_flight'
+
+    return None
+
+
+def enqueue_stitch(queue, artifact_store, key, *args, **kwargs):
+    """
+    Return the id of a job producing the stitch identified by key, enqueueing queue.enqueue(*args, **kwargs) only
+    if there is no finished or in-flight job to reuse.
+    """
+    return enqueue_once(queue, artifact_store, key, STITCH_CACHE_TTL, 'stitch_cache', *args, **kwargs)
+
+
+def enqueue_once(queue, artifact_store, key, cache_ttl, metric, *args, **kwargs):
+    """
+    Same as enqueue_stitch() for any job whose result holds an 'artifact' handle. key is remembered for cache_ttl
+    seconds, and hits and misses are counted as <metric>.hit_<status> and <metric>.miss.
+    """
+    for _ in range(2):  # Second attempt only if a concurrent request replaced the key at the same time
+        job_id = conn.get(key)
+        if job_id is not None:
+            job_id = job_id.decode()
+            status = reusable_job_status(job_id, artifact_store)
+            if status is not None:
+                metrics.incr(f'{metric}.hit_{status}')
+                return job_id
+            conn.delete(key)  # Failed or expired - forget it
+
+        job_id = str(uuid.uuid4())
+        if conn.set(key, job_id, nx=True, ex=cache_ttl):
+            metrics.incr(f'{metric}.miss')
+            return queue.enqueue(*args, job_id=job_id, **kwargs).get_id()
+
+    metrics.incr(f'{metric}.miss')
+    return queue.enqueue(*args, **kwargs).get_id()
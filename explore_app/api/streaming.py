@@ -0,0 +1,83 @@
+"""
+Streaming output of query results (NDJSON or CSV) for large downloads through /api/query.
+
+Rows are read as plain tuples of the requested columns through a server-side cursor (stream_results), batch_size at
+a time, and each batch is encoded and sent before the next one is read. Memory use doesn't grow with the size of the
+result, and the first rows go out as soon as the database returns them.
+"""
+import io
+import csv
+import json
+import time
+from datetime import date, datetime
+
+from flask import Response, stream_with_context
+
+from .. import metrics
+
+
+STREAM_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+
+def encode_value(v):
+    # Same representation as the marshmallow schema used for the JSON responses
+    if isinstance(v, (datetime, date)):
+        return v.isoformat()
+    return v
+
+
+def iter_row_batches(query, columns, batch_size):
+    result = query.with_entities(*columns).execution_options(stream_results=True, yield_per=batch_size)
+    batch = []
+    for row in result:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_ndjson(query, columns, fields, batch_size):
+    for batch in iter_row_batches(query, columns, batch_size):
+        yield ''.join(json.dumps(dict(zip(fields, map(encode_value, row)))) + '\n' for row in batch)
+
+
+def iter_csv(query, columns, fields, batch_size):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+
+    writer.writerow(fields)
+    for batch in iter_row_batches(query, columns, batch_size):
+        writer.writerows(['' if v is None else encode_value(v) for v in row] for row in batch)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+    if buf.tell():  # Header only (no results)
+        yield buf.getvalue()
+
+
+def stream_query(query, columns, fields, fmt, batch_size, filename='query'):
+    """ Streaming response with the given columns (named fields) of every row of query, in format fmt """
+    if fmt == 'csv':
+        chunks = iter_csv(query, columns, fields, batch_size)
+    else:
+        chunks = iter_ndjson(query, columns, fields, batch_size)
+
+    def generate():
+        t_start = time.time()
+        n_bytes = 0
+        for chunk in chunks:
+            n_bytes += len(chunk)
+            yield chunk
+        metrics.observe('query_stream', time.time() - t_start, size=n_bytes)
+
+    response = Response(stream_with_context(generate()), mimetype=STREAM_FORMATS[fmt])
+    if fmt == 'csv':
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
+    response.headers['X-Accel-Buffering'] = 'no'  # Don't let a proxy buffer the whole response
+    return response
@@ -0,0 +1,144 @@
+"""
+Incremental writer for uncompressed tiled TIFFs whose width isn't known until the end, used by the streaming stitcher.
+
+Columns of pixels are appended left to right. Every TILE_WIDTH columns are written out as one tile spanning the full
+height of the image (padded to a multiple of 16 rows, as TIFF requires), so only the current partial tile is held in
+memory. The directory with the final width and the tile offsets is written after the last tile, and the header is
+then pointed at it, switching to BigTIFF if the file has grown past what classic TIFF offsets can address.
+"""
+import struct
+
+import numpy as np
+
+TILE_WIDTH = 256
+
+# TIFF field types
+SHORT, LONG, LONG8 = 3, 4, 16
+FIELD_SIZES = {SHORT: 2, LONG: 4, LONG8: 8}
+FIELD_FORMATS = {SHORT: 'H', LONG: 'I', LONG8: 'Q'}
+
+BLACK_IS_ZERO, RGB = 1, 2
+UINT, INT, FLOAT = 1, 2, 3
+
+# PIL mode -> (little endian dtype, samples per pixel, photometric interpretation, sample format)
+MODES = {
+    'L': ('<u1', 1, BLACK_IS_ZERO, UINT),
+    'I;16': ('<u2', 1, BLACK_IS_ZERO, UINT),
+    'I': ('<i4', 1, BLACK_IS_ZERO, INT),
+    'F': ('<f4', 1, BLACK_IS_ZERO, FLOAT),
+    'RGB': ('<u1', 3, RGB, UINT),
+    'RGBA': ('<u1', 4, RGB, UINT),
+}
+
+HEADER_SIZE = 16  # Room for a BigTIFF header; a classic header leaves the rest unused
+CLASSIC_MAX_OFFSET = 2**32 - 1
+
+
+def writable_mode(mode):
+    """ The mode an image needs to be converted to (if it isn't one of MODES already) before writing it """
+    if mode in MODES:
+        return mode
+    return 'L' if mode in ('1', 'LA', 'P;L') else 'RGB'
+
+
+class TiledTiffWriter:
+    def __init__(self, path, mode, height, tile_width=TILE_WIDTH):
+        self.dtype, self.samples, self.photometric, self.sample_format = MODES[mode]
+        self.dtype = np.dtype(self.dtype)
+        self.height = height
+        self.tile_height = -(-height // 16) * 16
+        self.tile_width = tile_width
+        self.width = 0
+        self.tile_offsets = []
+        self.tile_byte_counts = []
+
+        shape = (self.tile_height, tile_width) + ((self.samples,) if self.samples > 1 else ())
+        self.tile = np.zeros(shape, dtype=self.dtype)
+        self.tile_fill = 0  # Columns of self.tile in use
+
+        self.f = open(path, 'wb')
+        self.f.write(b'\0' * HEADER_SIZE)
+
+    def write(self, columns):
+        """ Append columns (an array of shape (height, n) or (height, n, samples)) on the right of the image """
+        columns = np.asarray(columns)
+        if columns.shape[0] != self.height:
+            raise ValueError(f"Expected {self.height} rows, got {columns.shape[0]}")
+
+        i = 0
+        while i < columns.shape[1]:
+            n = min(self.tile_width - self.tile_fill, columns.shape[1] - i)
+            self.tile[:self.height, self.tile_fill:self.tile_fill + n] = columns[:, i:i + n]
+            self.tile_fill += n
+            self.width += n
+            i += n
+            if self.tile_fill == self.tile_width:
+                self.flush_tile()
+
+    def flush_tile(self):
+        self.tile_offsets.append(self.f.tell())
+        self.tile_byte_counts.append(self.tile.nbytes)
+        self.f.write(self.tile.tobytes())
+        self.tile[...] = 0
+        self.tile_fill = 0
+
+    def close(self):
+        if self.tile_fill > 0:
+            self.flush_tile()  # Padded with zeros, which readers ignore beyond the image width
+
+        ifd_offset = self.f.tell()
+        ifd_offset += ifd_offset % 2  # Word aligned
+        bigtiff = ifd_offset + 4096 + 16 * len(self.tile_offsets) > CLASSIC_MAX_OFFSET
+        offset_type = LONG8 if bigtiff else LONG
+
+        tags = [
+            (256, LONG, [self.width]),  # ImageWidth
+            (257, LONG, [self.height]),  # ImageLength
+            (258, SHORT, [8 * self.dtype.itemsize] * self.samples),  # BitsPerSample
+            (259, SHORT, [1]),  # Compression: none
+            (262, SHORT, [self.photometric]),  # PhotometricInterpretation
+            (277, SHORT, [self.samples]),  # SamplesPerPixel
+            (284, SHORT, [1]),  # PlanarConfiguration: contiguous
+            (322, LONG, [self.tile_width]),  # TileWidth
+            (323, LONG, [self.tile_height]),  # TileLength
+            (324, offset_type, self.tile_offsets),  # TileOffsets
+            (325, offset_type, self.tile_byte_counts),  # TileByteCounts
+        ]
+        if self.samples == 4:
+            tags.append((338, SHORT, [2]))  # ExtraSamples: unassociated alpha
+        if self.sample_format != UINT:
+            tags.append((339, SHORT, [self.sample_format] * self.samples))  # SampleFormat
+
+        self.f.seek(ifd_offset)
+        self.f.write(self.ifd(tags, ifd_offset, bigtiff))
+
+        self.f.seek(0)
+        if bigtiff:
+            self.f.write(struct.pack('<2sHHHQ', b'II', 43, 8, 0, ifd_offset))
+        else:
+            self.f.write(struct.pack('<2sHI', b'II', 42, ifd_offset))
+        self.f.close()
+
+    @staticmethod
+    def ifd(tags, ifd_offset, bigtiff):
+        """ Bytes of an image file directory at ifd_offset, followed by the values that don't fit in its entries """
+        count_format, entry_format, inline_size = ('<Q', '<HHQ', 8) if bigtiff else ('<H', '<HHI', 4)
+        entries_size = struct.calcsize(count_format) + len(tags) * (struct.calcsize(entry_format) + inline_size) + \
+            inline_size
+        extra_offset = ifd_offset + entries_size
+
+        entries = [struct.pack(count_format, len(tags))]
+        extra = []
+        for tag, field_type, values in sorted(tags):
+            data = struct.pack(f"<{len(values)}{FIELD_FORMATS[field_type]}", *values)
+            entries.append(struct.pack(entry_format, tag, field_type, len(values)))
+            if len(data) <= inline_size:
+                entries.append(data.ljust(inline_size, b'\0'))
+            else:
+                entries.append(struct.pack('<Q' if bigtiff else '<I', extra_offset))
+                data += b'\0' * (len(data) % 2)
+                extra.append(data)
+                extra_offset += len(data)
+        entries.append(b'\0' * inline_size)  # No next directory
+
+        return b''.join(entries + extra)
@@ -7,6 +7,9 @@ from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy_continuum.plugins import FlaskPlugin
 from sqlalchemy_continuum import make_versioned
 
+from sqlalchemy import case, literal, text, event, DDL, Integer
+from sqlalchemy.sql.expression import ColumnElement
+
 from . import db
 
 from explore_app.user import User
@@ -16,6 +19,19 @@ make_versioned(plugins=[FlaskPlugin()])
 class FilmSegment(db.Model):
     __versioned__ = {}
 
+    # Indexes matching the hot query patterns (see migration 5c1f3e9a7b2d)
+    __table_args__ = (
+        db.Index('ix_film_segment_reel_scope_frame', 'reel', 'scope_type', 'first_frame'),  # Neighbors by frame
+        db.Index('ix_film_segment_flight_scope_cbd', 'flight', 'scope_type', 'first_cbd'),  # Neighbors by CBD
+        db.Index('ix_film_segment_dataset_flight_date', 'dataset', 'flight', 'raw_date'),  # Stats, flight pages
+        db.Index('ix_film_segment_dataset_flight_year', 'dataset', 'flight', text('(raw_date % 100)')),  # CBD plots
+        db.Index('ix_film_segment_cbd_id', 'first_cbd', 'id'),  # Keyset pagination by CBD
+        db.Index('ix_film_segment_frame_id', 'first_frame', 'id'),  # Keyset pagination by frame
+        # Substring matches on path (LIKE '%...%'). Trigram indexes only exist in PostgreSQL.
+        db.Index('ix_film_segment_path_trgm', 'path', postgresql_using='gin',
+                 postgresql_ops={'path': 'gin_trgm_ops'}).ddl_if(dialect='postgresql'),
+    )
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
 
     dataset = db.Column(db.String(100))
@@ -67,6 +83,12 @@ class FilmSegment(db.Model):
         
         return q
 
+    def visibility_key(user):
+        """ Identifies which segments query_visible_to_user(user) can return, for caches shared between users """
+        if user.is_authenticated and user.view_greenland:
+            return 'greenland'
+        return 'public'
+
     def get_path(self, format='jpg'):
         """
         Mapping from "path" column of database to a URL where we can actually locate the data.
@@ -101,4 +123,57 @@ class FilmSegment(db.Model):
         return res
 
     def __repr__(self):
-        return f'<FilmSegment {self.id} [{self.dataset}]: Reel {self.reel} frames {self.first_frame} to {self.last_frame} [{self.path}]>'
\ No newline at end of file
+        return f'<FilmSegment {self.id} [{self.dataset}]: Reel {self.reel} frames {self.first_frame} to {self.last_frame} [{self.path}]>'
+
+
+# ix_film_segment_path_trgm needs the pg_trgm extension when the table is created with create_all() (migrations create
+# it themselves)
+event.listen(FilmSegment.__table__, 'before_create',
+             DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect='postgresql'))
+
+NEIGHBOR_FIELDS = ['prev_by_frame', 'next_by_frame', 'prev_by_cbd', 'next_by_cbd']
+
+def as_sql_int(v):
+    """ v as a SQL expression: columns and attributes (including those of an alias of FilmSegment) pass through """
+    if isinstance(v, ColumnElement) or hasattr(v, '__clause_element__'):
+        return v
+    return literal(v, Integer)
+
+def smaller(a, b):
+    a, b = as_sql_int(a), as_sql_int(b)
+    return case((a <= b, a), else_=b)
+
+def larger(a, b):
+    a, b = as_sql_int(a), as_sql_int(b)
+    return case((a >= b, a), else_=b)
+
+def neighbor_columns(src, query):
+    """
+    Scalar subqueries for the ids of the segments before and after src by frame (within the same reel) and by CBD
+    (within the same flight), in the order of NEIGHBOR_FIELDS. src can be anything with FilmSegment's attributes: plain
+    values to look up one segment, or an alias of FilmSegment to look up the neighbors of every row of an outer query.
+    Neighbors are only taken from the segments in query.
+    """
+    visible = query.with_entities(FilmSegment.id)
+
+    def first(f, *ordering):
+        return visible.filter(f).order_by(*ordering).limit(1).scalar_subquery()
+
+    same_reel = (FilmSegment.reel == src.reel) & (FilmSegment.scope_type == src.scope_type)
+    prev_frame = smaller(src.first_frame, src.last_frame) - 1
+    next_frame = larger(src.first_frame, src.last_frame) + 1
+
+    same_flight = (FilmSegment.flight == src.flight) & (FilmSegment.scope_type == src.scope_type)
+    prev_cbd = smaller(src.first_cbd, src.last_cbd) - 1
+    next_cbd = larger(src.first_cbd, src.last_cbd) + 1
+
+    return [
+        first(same_reel & (FilmSegment.first_frame <= prev_frame) & (FilmSegment.last_frame <= prev_frame),
+              FilmSegment.first_frame.desc(), FilmSegment.id.desc()),
+        first(same_reel & (FilmSegment.first_frame >= next_frame) & (FilmSegment.last_frame >= next_frame),
+              FilmSegment.first_frame.asc(), FilmSegment.id.asc()),
+        first(same_flight & (FilmSegment.first_cbd <= prev_cbd) & (FilmSegment.last_cbd <= prev_cbd),
+              FilmSegment.first_cbd.desc(), FilmSegment.id.desc()),
+        first(same_flight & (FilmSegment.first_cbd >= next_cbd) & (FilmSegment.last_cbd >= next_cbd),
+              FilmSegment.first_cbd.asc(), FilmSegment.id.asc())
+    ]
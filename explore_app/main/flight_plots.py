@@ -160,7 +160,8 @@ def make_linked_flight_plots(session, current_user, flight_id, flight_lines=None
     cbd_controls.sizing_mode = 'stretch_both'
 
     map_dict = make_bokeh_map(None, None, flight_id=flight_id, flight_date=flight_date, title=f"Flight {flight_id}",
-                                         flight_lines=flight_lines, return_components=True, dataset=dataset)
+                                         flight_lines=flight_lines, return_components=True, dataset=dataset,
+                                         tolerance=app.config['MAP_FLIGHT_TOLERANCE'])
     
 
     # Selecting data updates list of film segments
@@ -198,12 +199,24 @@ def make_linked_flight_plots(session, current_user, flight_id, flight_lines=None
                         last_cbd = temp;
                     }
                     
+                    // The map is simplified, so interpolate along each of its segments that overlaps the CBD range
                     for (var i=0; i < map_source.data['CBD'].length; i++) {
-                        if ((map_source.data['CBD'][i] >= first_cbd) && (map_source.data['CBD'][i] <= last_cbd)) {
-                            highlight_source.data['X'].push(map_source.data['X'][i]);
-                            highlight_source.data['Y'].push(map_source.data['Y'][i]);
+                        var cbd0 = map_source.data['CBD'][i];
+                        var cbd1 = map_source.data['CBD1'][i];
+                        var lo = Math.max(Math.min(cbd0, cbd1), first_cbd);
+                        var hi = Math.min(Math.max(cbd0, cbd1), last_cbd);
+                        if (lo > hi) {
+                            continue;
+                        }
+                        var ends = (cbd0 <= cbd1) ? [lo, hi] : [hi, lo];
+                        for (var k=0; k < 2; k++) {
+                            var t = (cbd1 == cbd0) ? 0 : (ends[k] - cbd0) / (cbd1 - cbd0);
+                            highlight_source.data['X'].push(map_source.data['X'][i] + t * (map_source.data['X1'][i] - map_source.data['X'][i]));
+                            highlight_source.data['Y'].push(map_source.data['Y'][i] + t * (map_source.data['Y1'][i] - map_source.data['Y'][i]));
                         }
                     }
+                    highlight_source.data['X'].push(NaN); // Break the line between film segments
+                    highlight_source.data['Y'].push(NaN);
                 }
 
                 highlight_source.change.emit();
@@ -214,7 +227,8 @@ def make_linked_flight_plots(session, current_user, flight_id, flight_lines=None
                 cbd_source.selected.indices = [];
 
                 for (var j=0; j < cb_obj.indices.length; j++) {
-                    var cbd = map_source.data['CBD'][cb_obj.indices[j]];
+                    var cbd0 = Math.min(map_source.data['CBD'][cb_obj.indices[j]], map_source.data['CBD1'][cb_obj.indices[j]]);
+                    var cbd1 = Math.max(map_source.data['CBD'][cb_obj.indices[j]], map_source.data['CBD1'][cb_obj.indices[j]]);
 
                     for (var i=0; i < cbd_source.data['first_cbd'].length; i++) {
                         var first_cbd = cbd_source.data['first_cbd'][i];
@@ -225,7 +239,7 @@ def make_linked_flight_plots(session, current_user, flight_id, flight_lines=None
                             last_cbd = temp;
                         }
 
-                        if ((cbd >= first_cbd) && (cbd <= last_cbd)) {
+                        if ((cbd1 >= first_cbd) && (cbd0 <= last_cbd)) { // The film segment overlaps the tapped map segment
                             cbd_source.selected.indices.push(i);
                         }
                     }
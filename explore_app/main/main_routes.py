@@ -1,27 +1,33 @@
-from flask import Blueprint, render_template, url_for, g, redirect, request, send_from_directory, abort, send_file
+from flask import Blueprint, render_template, url_for, g, redirect, request, send_from_directory, abort, send_file, Response
 from rq.job import Job
 
 from flask import current_app as app
 from .. import db, scheduler, queue
+from ..scheduler_lease import leader_only
 from worker import conn
 
 from flask_login import current_user
 
-from .map import make_bokeh_map, load_flight_lines
+from .map import make_bokeh_map
+from .map_cache import load_rendered_map
 from .flight_plots import make_linked_flight_plots
 from .stats_plots import make_flight_progress_bar_plot
 from explore_app.film_segment import FilmSegment
-from .stats_plots import update_flight_progress_stats
-
-from ..api.api_routes import has_write_permission, load_image, query_results_from_database
-from ..api.api_routes import query_cache, images_cache
-from ..api.image_processing import stitch_images
+from .stats_plots import update_flight_progress_stats, load_flight_progress_stats, load_overall_progress
+
+from ..api.api_routes import has_write_permission, load_image, query_results_from_database, resolve_query_ids
+from ..api.api_routes import query_store, flight_lines, positioning_versions
+from ..api.pagination import count_results, last_page_cursor, EXACT_COUNT_BELOW
+from ..api.image_processing import stitch_images, STITCH_JOB_TIMEOUT
+from ..api.artifact_store import get_artifact_store, ARTIFACT_TTL
+from ..api.stitch_cache import stitch_cache_key, enqueue_stitch
+from ..api.export import EXPORT_FORMATS
+from ..api.bulk_update import bulk_update_segments, bulk_update_job, BULK_UPDATE_JOB_THRESHOLD
 from ..api.metadata_helper import worker_dummy_serve_metadata_dict
 
 from sqlalchemy import and_, or_
 from sqlalchemy.sql import func
 
-from bokeh.embed import components
 
 import time
 import math
@@ -38,17 +44,25 @@ main_bp = Blueprint('main_bp', __name__,
                     template_folder='templates',
                     static_folder='static')
 
-flight_lines = {
-    'antarctica': load_flight_lines(app.config['ANTARCTICA_FLIGHT_POSITIONING_DIR'], 'antarctica'),
-    'greenland': load_flight_lines(app.config['GREENLAND_FLIGHT_POSITIONING_DIR'], 'greenland')
-}
+def make_all_flights_map(dataset):
+    map_dict = make_bokeh_map(800, 800, flight_lines=flight_lines[dataset], return_components=True, dataset=dataset,
+                              tolerance=app.config['MAP_OVERVIEW_TOLERANCE'])
+    return {k:map_dict[k] for k in map_dict if k in ['map', 'color_bar', 'tile_select', 'date_select']}
 
+# Rendered once (or loaded from a render made by another process) rather than on every request
 all_flights_maps = {}
 for dataset in flight_lines:
-    all_flights_maps[dataset] = make_bokeh_map(800, 800, flight_lines=flight_lines[dataset], return_components=True, dataset=dataset)
-    all_flights_maps[dataset] = {k:all_flights_maps[dataset][k] for k in all_flights_maps[dataset] if k in ['map', 'color_bar', 'tile_select', 'date_select']}
+    all_flights_maps[dataset] = load_rendered_map(dataset, positioning_versions[dataset], app.config['MAP_OVERVIEW_TOLERANCE'],
+                                                  lambda: make_all_flights_map(dataset))
 
-flight_progress_stats_updated = None
+artifact_store = get_artifact_store()
+
+# Values set by each of the bulk update actions (along with updated_by and last_changed)
+BULK_UPDATE_ACTIONS = {
+    'mark_verified': {'is_verified': True},
+    'set_60mhz': {'instrument_type': FilmSegment.RADAR_60MHZ},
+    'set_300mhz': {'instrument_type': FilmSegment.RADAR_300MHZ}
+}
 
 def make_contributors_df():
     contributors_df = pd.read_csv('contributors.csv', sep=' - ', comment='#', engine='python')
@@ -59,8 +73,7 @@ def make_contributors_df():
 contributors_df = make_contributors_df()
 
 with app.app_context():
-    update_flight_progress_stats(db.session)
-    flight_progress_stats_updated = time.time()
+    load_flight_progress_stats(db.session)
 
 
 @main_bp.route('/')
@@ -82,13 +95,37 @@ def docs_contact_page():
 @main_bp.route('/map/')
 @main_bp.route('/map/<dataset>/')
 def map_page(dataset='antarctica'):
-    script, divs = components(all_flights_maps[dataset])
-    
+    if dataset not in all_flights_maps:
+        abort(404)
+    rendered = all_flights_maps[dataset]
+    divs = rendered.divs
+
     return render_template("map.html",
-                            bokeh_script=script, map=divs['map'], color_bar=divs['color_bar'],
+                            bokeh_script_url=url_for('main_bp.map_script', dataset=dataset, render_id=rendered.render_id),
+                            map=divs['map'], color_bar=divs['color_bar'],
                             tile_select=divs['tile_select'],
                             date_select=divs["date_select"], show_date_select=(dataset=='greenland'))
 
+@main_bp.route('/map/<dataset>/<render_id>.js')
+def map_script(dataset, render_id):
+    """ Script of a rendered overview map, precompressed to suit the request's Accept-Encoding """
+    rendered = all_flights_maps.get(dataset)
+    if (rendered is None) or (render_id != rendered.render_id):
+        abort(404)
+
+    encoding = rendered.script_encoding(request.accept_encodings)
+    etag = f"{rendered.render_id}-{encoding or 'identity'}"
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(rendered.scripts[encoding], mimetype='text/javascript')
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'  # The URL changes with every render
+    return response
+
 @main_bp.route('/flight/<int:flight_id>/')
 @main_bp.route('/flight/<dataset>/<int:flight_id>/')
 @main_bp.route('/flight/<dataset>/<int:flight_id>/<int:flight_date>')
@@ -129,7 +166,8 @@ def query_bulk_action():
     if not (has_write_permission(current_user) or (action_type == 'stitch')):
         return "You're not logged in or don't have the appropriate permissions."
 
-    if not qid or (not (qid in query_cache)):
+    query_log = query_store.get(qid) if qid else None
+    if query_log is None:
         return "No query id specified or query id invalid. If you've had this page open more than an hour, your query "\
                "may have expired. "
     if not action_type:
@@ -137,34 +175,25 @@ def query_bulk_action():
     if not scope:
         return "No scope specified"
 
-    query_log = query_cache[qid]
-
-    if scope == 'page':
-        query_ids = query_log['page_query']
-    elif scope == 'query':
-        query_ids = query_log['full_query']
+    if scope in ['page', 'query']:
+        query_ids = resolve_query_ids(query_log, scope)
     else:
         return "Invalid scope specified"
 
     query = FilmSegment.query_visible_to_user(current_user).filter(FilmSegment.id.in_(query_ids))
 
-    if action_type == 'mark_verified':
-        for f in query.all():
-            f.is_verified = True
-            f.updated_by = current_user.email
-            f.last_changed = datetime.now()
-        db.session.commit()
-    elif action_type == 'set_60mhz':
-        for f in query.all():
-            f.instrument_type = 10
-            f.updated_by = current_user.email
-            f.last_changed = datetime.now()
-        db.session.commit()
-    elif action_type == 'set_300mhz':
-        for f in query.all():
-            f.instrument_type = 20
-            f.updated_by = current_user.email
-            f.last_changed = datetime.now()
+    if action_type in BULK_UPDATE_ACTIONS:
+        values = dict(BULK_UPDATE_ACTIONS[action_type], updated_by=current_user.email, last_changed=datetime.now())
+        changes = [(seg_id, values) for (seg_id,) in query.with_entities(FilmSegment.id).all()]
+
+        if len(changes) > BULK_UPDATE_JOB_THRESHOLD:
+            # The job runs outside of this request, so it's told who made the change for the version history
+            user_id = current_user.id if current_user.is_authenticated else None
+            job = queue.enqueue(bulk_update_job, failure_ttl=60*60, result_ttl=60*60, job_timeout=60*60,
+                                args=(changes,), kwargs={'user_id': user_id, 'remote_addr': request.remote_addr})
+            return f"started:{job.get_id()}"
+
+        bulk_update_segments(db.session, changes)
         db.session.commit()
     elif action_type == 'stitch':
         image_type = request.form.get('format', 'jpg')
@@ -175,14 +204,18 @@ def query_bulk_action():
         if ((query.count() > 10) or image_type != 'jpg') and not has_write_permission(current_user):
             return "Must be logged in with appropriate permissions to stitch more than 10 images."
 
-        if query.count() > 10 and image_type != 'jpg':
-            return "Sorry, merging more than 10 images into TIFF format is not yet supported due to the absurd size of the original TIFF images."
-
         query = query.order_by(FilmSegment.first_cbd)
         img_paths = [f.get_path(format=image_type) for f in query.all()]
 
-        job = queue.enqueue(stitch_images, failure_ttl=60, args=(img_paths, image_type, flip, scale_x, scale_y, qid))
-        return f"started:{job.get_id()}"
+        # Repeated requests for the same stitch reuse the finished output or the job that's already running
+        stitch_key = stitch_cache_key(img_paths, image_type, flip, scale_x, scale_y)
+
+        # Original TIFFs are far too large to hold a whole flight in memory, so they are always stitched incrementally
+        job_id = enqueue_stitch(queue, artifact_store, stitch_key, stitch_images, failure_ttl=60, result_ttl=ARTIFACT_TTL,
+                                job_timeout=(STITCH_JOB_TIMEOUT if image_type != 'jpg' else None),
+                                args=(img_paths, image_type, flip, scale_x, scale_y, qid),
+                                kwargs={'streaming': (image_type != 'jpg')})
+        return f"started:{job_id}"
     elif action_type == 'download_metadata':
         query = query.order_by(FilmSegment.first_cbd)
         metadata_dict = {}
@@ -202,6 +235,10 @@ def get_job_status(job_id):
 
     if job.is_finished:
         return 'done'
+    elif job.is_failed:
+        return 'failed'
+    elif 'progress' in job.meta:
+        return f"running:{job.meta['progress']}"
     else:
         return 'running'
 
@@ -211,10 +248,17 @@ def get_output_image(job_id):
 
     if job.is_finished:
         if job.result['job_type'] == 'stitch_images':
-            img_io = job.result['image']
+            if not artifact_store.exists(job.result['artifact']):
+                return "This output has expired. Please run the stitch again.", 404
 
-            return send_file(img_io, mimetype=f'image/{job.result["image_type"]}',
-                            as_attachment=True, download_name=job.result['filename'])
+            return artifact_store.serve(job.result['artifact'], mimetype=f'image/{job.result["image_type"].lower()}',
+                                        download_name=job.result['filename'])
+        elif job.result['job_type'] == 'export':
+            if not artifact_store.exists(job.result['artifact']):
+                return "This output has expired. Please request the export again.", 404
+
+            return artifact_store.serve(job.result['artifact'], mimetype=EXPORT_FORMATS[job.result['format']],
+                                        download_name=job.result['filename'])
         elif job.result['job_type'] == 'metadata_to_dict':
             return job.result['metadata']
         else:
@@ -225,11 +269,17 @@ def get_output_image(job_id):
 
 @main_bp.route('/query')
 def query_results():
-    query, query_page, current_page, qid, n = query_results_from_database(request)
-
-    # Pagination counts
-    n_total_results = query.count()
-    n_pages = math.ceil(n_total_results / n)
+    query, segs, current_page, qid, n, cursors = query_results_from_database(request, keyset=True)
+
+    # Pagination counts (the planner's estimate, unless the results are few enough to count quickly)
+    n_total_results = count_results(query.order_by(None), 'approx')
+    exact_count = n_total_results < EXACT_COUNT_BELOW
+    if exact_count:
+        n_total_results = count_results(query.order_by(None), 'exact')
+    n_pages = max(math.ceil(n_total_results / n), 1)
+    if not exact_count:
+        # Page numbers are only estimates, so never let the estimate hide a page that exists
+        n_pages = max(n_pages, current_page + (1 if cursors['next'] else 0))
 
     # Display options
 
@@ -240,27 +290,36 @@ def query_results():
 
     # Figure out pagination
 
-    # All the page links should repeat all the GET arguments except the page
-    base_args = {k: v for k,v in request.args.items() if k != 'page'}
+    # All the page links should repeat all the GET arguments except the page and cursor
+    base_args = {k: v for k,v in request.args.items() if not (k in ['page', 'cursor'])}
+
+    # Links to neighboring pages (and the last page) use cursors, so that deep pages are as fast as the first one
+    page_links = [(1, url_for('main_bp.query_results', page=1, cursor='', **base_args)),
+                  (current_page-1, url_for('main_bp.query_results', page=current_page-1, cursor=cursors['prev'], **base_args) if cursors['prev'] else None),
+                  (current_page, url_for('main_bp.query_results', page=current_page, cursor=request.args.get('cursor', ''), **base_args)),
+                  (current_page+1, url_for('main_bp.query_results', page=current_page+1, cursor=cursors['next'], **base_args) if cursors['next'] else None),
+                  (n_pages, url_for('main_bp.query_results', page=n_pages, cursor=last_page_cursor(cursors['sort'], n_total_results, n, exact=exact_count), **base_args))]
 
     # Create an ordered dictionary of page numbers to links to the appropriate query
     pages = OrderedDict()
     # Our convention here is to display links to the first page, the the last page, and the pages before/after the current
-    for pg in [1, current_page-1, current_page, current_page+1, n_pages]:
-        if (pg > 0) and (pg <= n_pages) and (not (pg in pages)):  # Sometimes this list may overlap - don't repeat any pages
-            pages[pg] = url_for('main_bp.query_results', page=pg, **base_args)
+    for pg, link in page_links:
+        if link and (pg > 0) and (pg <= n_pages) and (not (pg in pages)):  # Sometimes this list may overlap - don't repeat any pages
+            pages[pg] = link
 
-    prev_page = current_page - 1 # A value of 0 indicates no previous page
-    if current_page < n_pages:
+    if cursors['prev'] and (current_page - 1) in pages:
+        prev_page = current_page - 1
+    else:
+        prev_page = 0 # A value of 0 indicates no previous page
+    if cursors['next'] and (current_page + 1) in pages:
         next_page = current_page + 1
     else:
         next_page = 0
 
     # Return results
 
-    segs = query_page.all()
     return render_template("queryresults.html", segments=segs, show_view_toggle=True, show_history=show_history,
-                           n_total_results=n_total_results, n_pages=n_pages, current_page=current_page, paginate=True,
+                           n_total_results=n_total_results, exact_count=exact_count, n_pages=n_pages, current_page=current_page, paginate=True,
                            next_page=next_page, prev_page=prev_page, page_map=pages, query_id=qid,
                            enable_tiff=app.config['ENABLE_TIFF'],
                            breadcrumbs=[('Explorer', '/'), ('Query Results', url_for('main_bp.query_results'))])
@@ -284,7 +343,7 @@ def query_id_results():
     query_log = {'full_query': [x.id for x in segs],
                  'timestamp': time.time()}
     qid = str(uuid.uuid4())
-    query_cache[qid] = query_log
+    query_store.put(qid, query_log)
 
     return render_template("queryresultslist.html", segments=segs, show_view_toggle=True, show_history=True,
                             n_total_results=len(segs), stitch_preview=(len(segs) <= 10),
@@ -304,48 +363,40 @@ def stats_page_refresh():
 
 @main_bp.route('/stats/')
 def stats_page():
-    global flight_progress_stats_updated
-
-    total_verified = FilmSegment.query_visible_to_user(current_user).filter(FilmSegment.is_verified == True).count()
-    total = FilmSegment.query_visible_to_user(current_user).count()
+    # Kept current by the progress counters, so this doesn't need to query the segment table
+    load_flight_progress_stats(db.session)
+    total_verified, total = load_overall_progress(db.session)
 
     flightprogress_html = make_flight_progress_bar_plot(include_greenland=True)
 
-    elapsed_time = time.time() - flight_progress_stats_updated
-    if elapsed_time < 5:
-        update_string = "just now"
-    elif elapsed_time < 60:
-        update_string = "less than a minute ago"
-    else:
-        update_string = f"about {int(elapsed_time / 60)} minutes ago"
-
     return render_template("stats.html", flightprogress=flightprogress_html,
-                           total_verified=total_verified, total=total, percent=int(100*total_verified/total),
-                           update_string=update_string,
+                           total_verified=total_verified, total=total, percent=(int(100*total_verified/total) if total else 0),
                            breadcrumbs=[('Explorer', '/'), ('Stats', url_for('main_bp.stats_page'))])
 
 
 # Periodic background updating
+# Jobs that work on shared state only run in the process holding their lease (see scheduler_lease.py)
 
-@scheduler.task('interval', id='update_stats', seconds=(60*1))
-def update_stats():
+@scheduler.task('interval', id='reconcile_stats', seconds=app.config['PROGRESS_STATS_RECONCILE_INTERVAL'])
+@leader_only('reconcile_stats', app.config['PROGRESS_STATS_RECONCILE_INTERVAL'])
+def reconcile_stats():
+    # The progress counters are updated as segments change; this only fixes anything they missed. The results are
+    # in Redis, so every process sees them.
     with scheduler.app.app_context():
         update_flight_progress_stats(db.session)
-        global flight_progress_stats_updated
-        flight_progress_stats_updated = time.time()
 
 @scheduler.task('interval', id='clear_main_query_cache', seconds=(60*1))
 def clear_query_cache():
+    # Only expires this process's local fallback entries, so it runs everywhere
+    with scheduler.app.app_context():
+        query_store.sweep()
+
+@scheduler.task('interval', id='sweep_artifacts', seconds=(60*1))
+@leader_only('sweep_artifacts', 60*1, per_host=True)
+def sweep_artifacts():
+    # Catches outputs stored by this machine's processes (exports). Workers sweep the outputs they store themselves.
     with scheduler.app.app_context():
-        for k in list(query_cache):
-            if time.time() - query_cache[k]['timestamp'] > (60*60):
-                query_cache.pop(k, None)
-        for k in list(images_cache):
-            if time.time() - images_cache[k]['timestamp'] > (2*60):
-                old_file = os.path.join(app.config['TMP_OUTPUTS_DIR'], images_cache[k]['filename'])
-                print(f"Deleting {old_file}")
-                os.remove(old_file)
-                images_cache.pop(k, None)
+        artifact_store.sweep(ARTIFACT_TTL)
 
 # Page load time logic
 
@@ -9,7 +9,7 @@ from bokeh.embed import components
 from bokeh.models.callbacks import CustomJS
 from bokeh.layouts import column, row
 
-from cartopy import crs
+from .projection import DATASET_PROJECTIONS
 
 import pandas as pd
 
@@ -56,10 +56,10 @@ map_tile_sources_all['greenland'] = [
 def load_flight_lines(positioning_dir, dataset):
     flight_lines = {}
 
-    crs_3031 = crs.Stereographic(central_latitude=-90, true_scale_latitude=-71)
-    crs_3413 = crs.Stereographic(central_latitude=90, central_longitude=-45, true_scale_latitude=70)
-    #crs_3413 = crs.epsg(3413)
-    crs_lonlat = crs.PlateCarree()
+    if dataset not in DATASET_PROJECTIONS:
+        raise(Exception(f"Unexpected dataset {dataset} - should be antarctica or greenland"))
+    # Project to CRS 3031 (South Polar Stereographic) or 3413 (Polar Stereographic North)
+    projection = DATASET_PROJECTIONS[dataset]
 
     for filename in os.listdir(positioning_dir):
         if filename.endswith(".csv"):
@@ -92,17 +92,8 @@ def load_flight_lines(positioning_dir, dataset):
                 df['Date'] = None
                 df['url'] = f"/flight/{dataset}/{id}"
 
-            if dataset == 'antarctica':
-                # Project to CRS 3031 (South Polar Stereographic)
-                projected_coords = crs_3031.transform_points(crs_lonlat, np.array(df['Longitude']), np.array(df['Latitude']))
-            elif dataset == 'greenland':
-                # Project to CRS 3413 (Polar Stereographic North)
-                projected_coords = crs_3413.transform_points(crs_lonlat, np.array(df['Longitude']), np.array(df['Latitude']))
-            else:
-                raise(Exception(f"Unexpected dataset {dataset} - should be antarctica or greenland"))
-            
-            df['X'] = projected_coords[:, 0]
-            df['Y'] = projected_coords[:, 1]
+            df['X'], df['Y'] = projection.forward(np.array(df['Longitude']), np.array(df['Latitude']))
+            df['LOD'] = douglas_peucker_tolerances(df['X'].to_numpy(), df['Y'].to_numpy())
 
             flight_lines[(id,fdate)] = df
             if not ((id, None) in flight_lines):
@@ -111,7 +102,72 @@ def load_flight_lines(positioning_dir, dataset):
     return flight_lines
 
 
-def make_bokeh_map(width, height, flight_id=None, dataset='antarctica', title="", flight_lines = None, flight_date=None, return_plot=False, return_components=False):
+def segment_distances(x, y, x0, y0, x1, y1):
+    """ Distance of each point x, y from the line segment (x0, y0) - (x1, y1) """
+    dx, dy = x1 - x0, y1 - y0
+    length2 = dx * dx + dy * dy
+    t = np.clip(((x - x0) * dx + (y - y0) * dy) / length2, 0, 1) if length2 > 0 else 0
+    return np.hypot(x - (x0 + t * dx), y - (y0 + t * dy))
+
+
+def douglas_peucker_tolerances(x, y):
+    """
+    Douglas-Peucker simplification of the line x, y at every tolerance at once: for each point, the largest tolerance
+    (in the units of x and y) at which it is kept. Simplifying with tolerance tol keeps the points whose value is at
+    least tol (the end points are always kept), and every point is within tol of the simplified line. Levels are nested:
+    points kept at a coarse tolerance are also kept at every finer one.
+    """
+    n = len(x)
+    tolerances = np.zeros(n)
+    if n == 0:
+        return tolerances
+    tolerances[[0, -1]] = np.inf
+
+    stack = [(0, n - 1, np.inf)]
+    while stack:
+        i, j, parent = stack.pop()
+        if j - i < 2:
+            continue
+        d = segment_distances(x[i+1:j], y[i+1:j], x[i], y[i], x[j], y[j])
+        k = i + 1 + int(np.argmax(d))
+        tolerances[k] = min(d[k - i - 1], parent)  # Never above its parent's, so that the levels stay nested
+        stack.append((i, k, tolerances[k]))
+        stack.append((k, j, tolerances[k]))
+    return tolerances
+
+
+def map_line_data(df, tolerance=None):
+    """
+    Data for drawing the flight line df as segments between the points kept when simplifying with tolerance (metres in
+    map coordinates; None or 0 keeps every point). Each row is one kept point (with its original CBD, position, track,
+    and year, for tooltips) and the segment from it to the next kept point (X1, Y1, CBD1), coloured by the mean
+    thickness of the original points along that segment.
+    """
+    keep = np.flatnonzero(df['LOD'].to_numpy() >= (tolerance or 0))
+
+    thickness = df['Thickness'].to_numpy(dtype=float) if 'Thickness' in df.columns else np.full(len(df), np.nan)
+    has_thickness = ~np.isnan(thickness)
+    with np.errstate(invalid='ignore'):
+        mean_thickness = np.add.reduceat(np.where(has_thickness, thickness, 0), keep) / \
+            np.add.reduceat(has_thickness, keep) if len(keep) else np.array([])
+
+    following = np.append(keep[1:], keep[-1:])  # The last point is a segment of zero length
+    return {
+        'X': df['X'].to_numpy()[keep],
+        'Y': df['Y'].to_numpy()[keep],
+        'X1': df['X'].to_numpy()[following],
+        'Y1': df['Y'].to_numpy()[following],
+        'CBD': df['CBD'].to_numpy()[keep],
+        'CBD1': df['CBD'].to_numpy()[following],
+        'Latitude': df['Latitude'].to_numpy()[keep],
+        'Longitude': df['Longitude'].to_numpy()[keep],
+        'Thickness': mean_thickness,
+        'Track': df['Track'].to_numpy()[keep],
+        'Date': df['Date'].to_numpy()[keep]
+    }
+
+
+def make_bokeh_map(width, height, flight_id=None, dataset='antarctica', title="", flight_lines = None, flight_date=None, return_plot=False, return_components=False, tolerance=None):
     if flight_lines is None:
         raise(Exception("Providing flight lines is now required."))
         # print("Warning: Recommend pre-loading positioning files to speedup page load.")
@@ -156,15 +212,15 @@ def make_bokeh_map(width, height, flight_id=None, dataset='antarctica', title=""
     color_bar_plot.add_layout(color_bar, 'right')
     color_bar_plot.title.align="center"
 
+    # Flight lines are simplified to the level of detail given by tolerance (see douglas_peucker_tolerances)
     for flight_identifier, df in flight_lines.items():
-        data_source = ColumnDataSource(data=df)
+        data_source = ColumnDataSource(data=map_line_data(df, tolerance))
         data_sources.append(data_source)
-        #l = p.line(x='X', y='Y', source=data_source, color=app.config["COLOR_PRIMARY"], line_width=1)
-        l = p.scatter(x='X', y='Y', source=data_source, color={'field': 'Thickness', 'transform': thickness_color_mapper}, size=2)
+        l = p.segment(x0='X', y0='Y', x1='X1', y1='Y1', source=data_source, color={'field': 'Thickness', 'transform': thickness_color_mapper}, line_width=2)
         flight_glyphs[flight_identifier] = l
 
     highlight_source = ColumnDataSource(data={'X': [], 'Y': []})
-    p.scatter(x='X', y='Y', source=highlight_source, line_width=3, color=app.config["COLOR_ACCENT"])
+    p.line(x='X', y='Y', source=highlight_source, line_width=4, color=app.config["COLOR_ACCENT"])
 
     if dataset == 'antarctica':
         p.xaxis.axis_label = "ESPG:3031 X"
@@ -254,7 +310,7 @@ def make_bokeh_map(width, height, flight_id=None, dataset='antarctica', title=""
 
 
     if len(flight_lines) > 1:
-        url = f"@url"
+        url = f"/flight/{dataset}/@Track" + ("/@Date" if dataset == 'greenland' else "")
         taptool = p.select(type=TapTool)
         taptool.callback = OpenURL(url=url, same_tab=True)
 
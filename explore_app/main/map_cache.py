@@ -0,0 +1,150 @@
+"""
+Pre-rendered overview maps for /map.
+
+The Bokeh components of each dataset's overview map are rendered once, and the script is kept as bytes together with
+gzip (and, if the brotli package is installed, brotli) compressed copies. The map page only includes the small divs,
+and loads the script from a URL containing a hash of it, so the script can be served as-is and cached by browsers
+indefinitely.
+
+Bokeh gives the models of each render their own ids, and the divs only work with the script they were rendered with,
+so every process has to serve the same render. The first process to render a map stores it in Redis, and every other
+process (other gunicorn workers without --preload, other dynos) loads that copy instead of rendering its own. Renders
+are keyed by the positioning version and simplification tolerance of the map and by the revision of the code that
+rendered it, so a new render is made (and older ones are removed) whenever the positioning data changes or a new
+version is deployed. Stored renders expire MAP_CACHE_TTL seconds after the last process loaded them, so the renders of
+processes that no longer run don't stay in Redis forever. If Redis can't be reached, each process renders its own maps.
+"""
+import os
+import gzip
+import glob
+import json
+import hashlib
+
+import bokeh
+import redis
+from bokeh.embed import components
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from worker import conn
+
+MAP_CACHE_FORMAT_VERSION = 1  # Bump this whenever a change would change the rendered maps
+KEY_PREFIX = 'rfs:map:'
+BROTLI_QUALITY = 11  # Slow (about a second per map), but maps are only compressed once per positioning version
+# Longer than any process runs (Heroku restarts dynos daily), since every process serves the render it loaded at startup
+MAP_CACHE_TTL = int(os.getenv('MAP_CACHE_TTL', 7*24*60*60))
+
+# Compressed variants in order of preference
+ENCODINGS = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+class RenderedMap:
+    """ Rendered components of a map: its divs, and its script under each content encoding (None is uncompressed) """
+
+    def __init__(self, divs, scripts):
+        self.divs = divs
+        self.scripts = scripts
+        self.render_id = hashlib.sha1(scripts[None]).hexdigest()[:16]
+
+    @classmethod
+    def render(cls, models):
+        script, divs = components(models, wrap_script=False)
+        script = script.encode()
+        scripts = {None: script, 'gzip': gzip.compress(script, compresslevel=9)}
+        if brotli is not None:
+            scripts['br'] = brotli.compress(script, quality=BROTLI_QUALITY)
+        return cls(divs, scripts)
+
+    def to_redis(self):
+        values = {'divs': json.dumps(self.divs), 'identity': self.scripts[None]}
+        values.update({encoding: self.scripts[encoding] for encoding in self.scripts if encoding is not None})
+        return values
+
+    @classmethod
+    def from_redis(cls, values):
+        values = {k.decode(): v for k, v in values.items()}
+        scripts = {None: values.pop('identity')}
+        divs = json.loads(values.pop('divs'))
+        scripts.update(values)
+        return cls(divs, scripts)
+
+    def script_encoding(self, accept_encodings):
+        """ The best encoding of the script for a request's Accept-Encoding (None for uncompressed) """
+        for encoding in ENCODINGS:
+            if (encoding in self.scripts) and (accept_encodings.quality(encoding) > 0):
+                return encoding
+        return None
+
+
+def code_revision():
+    """
+    The deployed revision, from SOURCE_VERSION or HEROKU_SLUG_COMMIT if either is set, otherwise a hash of the app's
+    source files (so that a change to the map code is never served with a render made by the old code)
+    """
+    revision = os.getenv('SOURCE_VERSION') or os.getenv('HEROKU_SLUG_COMMIT')
+    if revision:
+        return revision
+
+    app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    h = hashlib.sha1()
+    for path in sorted(glob.glob(os.path.join(app_dir, '**', '*.py'), recursive=True)):
+        h.update(os.path.relpath(path, app_dir).encode())
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return 'source:' + h.hexdigest()
+
+
+CODE_REVISION = code_revision()
+
+
+def map_cache_key(dataset, positioning_version, tolerance):
+    version = hashlib.sha1(json.dumps([MAP_CACHE_FORMAT_VERSION, bokeh.__version__, positioning_version, tolerance,
+                                       ENCODINGS, CODE_REVISION]).encode()).hexdigest()[:16]
+    return f"{KEY_PREFIX}{dataset}:{version}"
+
+
+def load_rendered_map(dataset, positioning_version, tolerance, make_models):
+    """
+    The RenderedMap of dataset's overview map, from Redis if some process has already rendered it for this version of
+    the positioning data. Otherwise the models returned by make_models() are rendered and stored for the others.
+    """
+    key = map_cache_key(dataset, positioning_version, tolerance)
+    try:
+        values = conn.hgetall(key)
+        if values:
+            conn.expire(key, MAP_CACHE_TTL)  # Kept as long as processes serving this render keep starting
+            return RenderedMap.from_redis(values)
+    except redis.exceptions.RedisError:
+        return RenderedMap.render(make_models())
+
+    rendered = RenderedMap.render(make_models())
+    try:
+        with conn.pipeline() as pipe:
+            pipe.watch(key)
+            if pipe.exists(key):  # Another process stored its render while this one was rendering
+                raise redis.exceptions.WatchError()
+            pipe.multi()
+            pipe.hset(key, mapping=rendered.to_redis())
+            pipe.expire(key, MAP_CACHE_TTL)
+            pipe.execute()
+    except redis.exceptions.WatchError:
+        try:
+            values = conn.hgetall(key)
+        except redis.exceptions.RedisError:
+            values = None
+        return RenderedMap.from_redis(values) if values else rendered
+    except redis.exceptions.RedisError:
+        return rendered
+
+    # Renders of older positioning data (or code) aren't needed any more
+    try:
+        for old_key in conn.scan_iter(match=f"{KEY_PREFIX}{dataset}:*"):
+            if old_key.decode() != key:
+                conn.delete(old_key)
+    except redis.exceptions.RedisError:
+        pass
+
+    return rendered
@@ -0,0 +1,256 @@
+"""
+Helpers for looking up positions of film segments along the flight lines loaded by load_flight_lines().
+"""
+import os
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+
+def positioning_version(positioning_dir):
+    """ Identifies the current contents of a positioning directory (changes whenever a file is added or modified) """
+    h = hashlib.sha1()
+    for entry in sorted(os.scandir(positioning_dir), key=lambda e: e.name):
+        if entry.name.endswith('.csv'):
+            st = entry.stat()
+            h.update(f"{entry.name}|{st.st_size}|{st.st_mtime_ns}\n".encode())
+    return h.hexdigest()[:16]
+
+
+def find_flight_line(flight_lines, flight, raw_date=None):
+    """ The flight line for a segment's flight (and year, if known), or None if there's no positioning for it """
+    if flight is None:
+        return None
+    if raw_date is not None:
+        df = flight_lines.get((flight, raw_date % 100))
+        if df is not None:
+            return df
+    return flight_lines.get((flight, None))
+
+
+# Fields served by /api/positioning, and the flight line column each comes from
+TRACK_FIELDS = {
+    'cbd': 'CBD',
+    'latitude': 'Latitude',
+    'longitude': 'Longitude',
+    'x': 'X',
+    'y': 'Y',
+    'thickness': 'Thickness'
+}
+
+
+EARTH_RADIUS = 6371008.8  # Mean radius (m), for along-track distances
+
+GEOLOCATION_FIELDS = ['start_lat', 'start_lon', 'end_lat', 'end_lon', 'length_m', 'min_lat', 'min_lon', 'max_lat',
+                      'max_lon', 'min_x', 'min_y', 'max_x', 'max_y', 'mean_thickness']
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """ Great-circle distance in metres between lat1, lon1 and lat2, lon2 (degrees, arrays) """
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
+def along_track_distance(lat, lon):
+    """ Cumulative great-circle distance in metres along a track of lat, lon points (degrees) """
+    return np.concatenate([[0.0], np.cumsum(haversine(lat[:-1], lon[:-1], lat[1:], lon[1:]))])
+
+
+def sorted_track(df):
+    """
+    {field: float array} of TRACK_FIELDS along flight line df, sorted by CBD (NaN for columns df doesn't have). Also
+    includes the cumulative along-track distance, and prefix sums of thickness (and of the number of points with a
+    thickness) so that the mean thickness over any range of points takes two lookups.
+    """
+    cbd = df['CBD'].to_numpy(dtype=float)
+    order = None if np.all(cbd[1:] >= cbd[:-1]) else np.argsort(cbd, kind='stable')
+
+    track = {}
+    for field, column in TRACK_FIELDS.items():
+        values = df[column].to_numpy(dtype=float) if column in df.columns else np.full(len(df), np.nan)
+        track[field] = values if order is None else values[order]
+
+    has_thickness = ~np.isnan(track['thickness'])
+    track['distance'] = along_track_distance(track['latitude'], track['longitude'])
+    track['thickness_sum'] = np.concatenate([[0.0], np.cumsum(np.where(has_thickness, track['thickness'], 0))])
+    track['thickness_count'] = np.concatenate([[0], np.cumsum(has_thickness)])
+    return track
+
+
+def cbd_range(cbds, first_cbd=None, last_cbd=None):
+    """ Slice of sorted array cbds covering first_cbd to last_cbd (inclusive; either may be None, in either order) """
+    if (first_cbd is not None) and (last_cbd is not None) and (first_cbd > last_cbd):
+        first_cbd, last_cbd = last_cbd, first_cbd
+    start = 0 if first_cbd is None else np.searchsorted(cbds, first_cbd, side='left')
+    stop = len(cbds) if last_cbd is None else np.searchsorted(cbds, last_cbd, side='right')
+    return slice(int(start), int(stop))
+
+
+def range_reduce(ufunc, values, starts, stops):
+    """ ufunc.reduce(values[start:stop]) for each pair of starts and stops, all at once (NaN for empty ranges) """
+    padded = np.append(values, np.nan)  # So that a stop of len(values) is a valid index
+    idx = np.empty(2 * len(starts), dtype=np.intp)
+    idx[0::2] = starts
+    idx[1::2] = stops
+    reduced = ufunc.reduceat(padded, idx)[0::2]
+    return np.where(stops > starts, reduced, np.nan)
+
+
+def interp_track(cbd, values, cbds, side='right'):
+    """
+    values linearly interpolated along a track at cbds. Where a CBD is shared by several track points, the value of the
+    first (side='left') or last (side='right') of them is used. CBDs outside of the range covered by the track (or
+    missing) are given NaN rather than being extrapolated.
+    """
+    cbds = np.asarray(cbds, dtype=float)
+    v = np.interp(cbds, cbd, values)  # Which already gives the last of several points at one CBD
+    if side == 'left':
+        i = np.minimum(np.searchsorted(cbd, cbds, side='left'), len(cbd) - 1)
+        exact = cbd[i] == cbds
+        v[exact] = values[i[exact]]
+    v[~((cbds >= cbd[0]) & (cbds <= cbd[-1]))] = np.nan  # Also NaN for missing CBDs
+    return v
+
+
+def track_positions(track, first_cbds, last_cbds):
+    """ start_lat, start_lon, end_lat, end_lon of segments on one flight line (a sorted_track()) """
+    return {
+        'start_lat': interp_track(track['cbd'], track['latitude'], first_cbds),
+        'start_lon': interp_track(track['cbd'], track['longitude'], first_cbds),
+        'end_lat': interp_track(track['cbd'], track['latitude'], last_cbds),
+        'end_lon': interp_track(track['cbd'], track['longitude'], last_cbds)
+    }
+
+
+def wrap_longitude(lon):
+    return (lon + 180) % 360 - 180
+
+
+def geolocate_on_track(track, first_cbds, last_cbds):
+    """
+    GEOLOCATION_FIELDS of segments on one flight line (a sorted_track()), given arrays of their first and last CBDs.
+    The bounding boxes cover the track points within each segment's CBD range plus its interpolated ends, with
+    min_lon > max_lon for boxes that cross the antimeridian. x/y are projected map coordinates.
+    """
+    cbd = track['cbd']
+    lo, hi = np.fmin(first_cbds, last_cbds), np.fmax(first_cbds, last_cbds)  # A missing CBD gives a single point
+    starts = np.searchsorted(cbd, lo, side='left')
+    stops = np.searchsorted(cbd, hi, side='right')
+
+    def interp(cbds, values, side='right'):
+        return interp_track(cbd, values, cbds, side)
+
+    geo = track_positions(track, first_cbds, last_cbds)
+
+    # Length: from the start of the range to its first track point, along the track to its last point, and on to the
+    # end of the range (or straight from start to end if no track point is in the range)
+    lo_lat, lo_lon = interp(lo, track['latitude'], side='left'), interp(lo, track['longitude'], side='left')
+    hi_lat, hi_lon = interp(hi, track['latitude']), interp(hi, track['longitude'])
+    first, last = np.minimum(starts, len(cbd) - 1), np.maximum(stops - 1, 0)
+    with np.errstate(invalid='ignore'):
+        geo['length_m'] = np.where(
+            stops > starts,
+            haversine(lo_lat, lo_lon, track['latitude'][first], track['longitude'][first]) +
+            track['distance'][last] - track['distance'][first] +
+            haversine(track['latitude'][last], track['longitude'][last], hi_lat, hi_lon),
+            haversine(lo_lat, lo_lon, hi_lat, hi_lon))
+
+    ends = {
+        'lat': (geo['start_lat'], geo['end_lat']),
+        'x': (interp(first_cbds, track['x']), interp(last_cbds, track['x'])),
+        'y': (interp(first_cbds, track['y']), interp(last_cbds, track['y']))
+    }
+    with np.errstate(invalid='ignore'):
+        for name, field in [('lat', 'latitude'), ('x', 'x'), ('y', 'y')]:
+            geo[f'min_{name}'] = np.fmin(range_reduce(np.minimum, track[field], starts, stops), np.fmin(*ends[name]))
+            geo[f'max_{name}'] = np.fmax(range_reduce(np.maximum, track[field], starts, stops), np.fmax(*ends[name]))
+
+        # Longitudes: boxes wider than 180 degrees in [-180, 180) are redone in [0, 360), and kept if that's narrower
+        boxes = []
+        for lon, end_lon in [(track['longitude'], (geo['start_lon'], geo['end_lon'])),
+                             (track['longitude'] % 360, (geo['start_lon'] % 360, geo['end_lon'] % 360))]:
+            boxes.append((np.fmin(range_reduce(np.minimum, lon, starts, stops), np.fmin(*end_lon)),
+                          np.fmax(range_reduce(np.maximum, lon, starts, stops), np.fmax(*end_lon))))
+        (min_a, max_a), (min_b, max_b) = boxes
+        use_b = ((max_a - min_a) > 180) & ((max_b - min_b) < (max_a - min_a))
+        geo['min_lon'] = np.where(use_b, wrap_longitude(min_b), min_a)
+        geo['max_lon'] = np.where(use_b, wrap_longitude(max_b), max_a)
+
+        n_thickness = track['thickness_count'][stops] - track['thickness_count'][starts]
+        geo['mean_thickness'] = (track['thickness_sum'][stops] - track['thickness_sum'][starts]) / n_thickness
+
+    return geo
+
+
+def track_finder(flight_lines):
+    """
+    get_track(dataset, flight, raw_date) for segment_positions() and segment_geolocation(): the sorted_track() of the
+    flight line find_flight_line() picks from flight_lines (dataset name -> loaded flight lines), built on first use
+    """
+    tracks = {}  # id() of a flight line DataFrame -> its sorted_track()
+
+    def get_track(dataset, flight, raw_date):
+        df = find_flight_line(flight_lines.get(dataset, {}), flight, raw_date)
+        if df is None:
+            return None
+        if id(df) not in tracks:
+            tracks[id(df)] = sorted_track(df)
+        return tracks[id(df)]
+
+    return get_track
+
+
+def flight_line_groups(get_track, datasets, flights, raw_dates):
+    """ (track, indices) for each flight line that segments (parallel sequences of dataset, flight, raw_date) are on """
+    flights = np.array(flights, dtype=float)  # None becomes NaN
+    years = np.array(raw_dates, dtype=float) % 100
+
+    keys = pd.DataFrame({'dataset': pd.Series(datasets, dtype=object), 'flight': flights, 'year': years})
+    for (dataset, flight, year), idxs in keys.groupby(['dataset', 'flight', 'year'], dropna=False).indices.items():
+        if (not isinstance(dataset, str)) or np.isnan(flight):
+            continue
+        track = get_track(dataset, int(flight), None if np.isnan(year) else int(year))
+        if (track is None) or (len(track['cbd']) == 0):
+            continue
+        yield track, idxs
+
+
+def segment_positions(get_track, datasets, flights, raw_dates, first_cbds, last_cbds):
+    """
+    Start and end latitude/longitude of a batch of segments, given as parallel sequences of their dataset, flight,
+    raw_date, first_cbd, and last_cbd. get_track is as for segment_geolocation(), which gives the same positions.
+
+    Returns arrays (start_lat, start_lon, end_lat, end_lon), with NaN where a position isn't known.
+    """
+    fields = ['start_lat', 'start_lon', 'end_lat', 'end_lon']
+    positions = {field: np.full(len(flights), np.nan) for field in fields}
+
+    first_cbds = np.array(first_cbds, dtype=float)
+    last_cbds = np.array(last_cbds, dtype=float)
+    for track, idxs in flight_line_groups(get_track, datasets, flights, raw_dates):
+        for field, values in track_positions(track, first_cbds[idxs], last_cbds[idxs]).items():
+            positions[field][idxs] = values
+
+    return tuple(positions[field] for field in fields)
+
+
+def segment_geolocation(get_track, datasets, flights, raw_dates, first_cbds, last_cbds):
+    """
+    GEOLOCATION_FIELDS for a batch of segments, given as parallel sequences of their dataset, flight, raw_date,
+    first_cbd, and last_cbd. get_track(dataset, flight, raw_date) returns the sorted_track() of the flight line to use,
+    or None if there isn't one (see track_finder()).
+
+    Returns {field: array}, with NaN where a value isn't known. Segments are grouped by flight line and each group is
+    computed with whole-array operations.
+    """
+    geo = {field: np.full(len(flights), np.nan) for field in GEOLOCATION_FIELDS}
+
+    first_cbds = np.array(first_cbds, dtype=float)
+    last_cbds = np.array(last_cbds, dtype=float)
+    for track, idxs in flight_line_groups(get_track, datasets, flights, raw_dates):
+        for field, values in geolocate_on_track(track, first_cbds[idxs], last_cbds[idxs]).items():
+            geo[field][idxs] = values
+
+    return geo
@@ -0,0 +1,184 @@
+"""
+Binary cache of the flight lines loaded by load_flight_lines(), so that processes don't have to parse and reproject
+every positioning CSV when they start.
+
+Each dataset is cached as two files in the cache directory:
+
+- <dataset>-<key>.bin holds the numeric columns of every flight line, one after another, each as raw array data
+- <dataset>.json is the manifest. It lists the source CSVs (size, mtime, and SHA-1) the cache was built from, and,
+  for each flight line, where each column is in the .bin file (or the value of columns that are constant, like url).
+  Keys that share a flight line (like (flight, None) and (flight, year)) still share one DataFrame.
+
+The .bin file is memory mapped, and the DataFrames handed out are read-only views into it, so loading is mostly
+reading the manifest, and the processes of one machine (or one gunicorn --preload master and its workers) share the
+same pages. The cache is rebuilt whenever a CSV is added, removed, or changed. A CSV with a new mtime but the same
+contents (for example, after a fresh checkout) doesn't invalidate it.
+"""
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from .map import load_flight_lines
+
+CACHE_FORMAT_VERSION = 3  # Bump this whenever load_flight_lines() changes what it loads
+ALIGNMENT = 8  # Byte alignment of each array in the .bin file
+
+
+def file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def source_files(positioning_dir):
+    """ {filename: os.stat_result} of the positioning CSVs """
+    return {e.name: e.stat() for e in os.scandir(positioning_dir) if e.name.endswith('.csv')}
+
+
+def describe_sources(positioning_dir):
+    return {name: {'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                   'sha1': file_sha1(os.path.join(positioning_dir, name))}
+            for name, st in sorted(source_files(positioning_dir).items())}
+
+
+def sources_match(positioning_dir, sources):
+    """ True if the CSVs in positioning_dir are the ones described by sources (hashing only files whose stat changed) """
+    current = source_files(positioning_dir)
+    if set(current) != set(sources):
+        return False
+    for name, st in current.items():
+        s = sources[name]
+        if (st.st_size, st.st_mtime_ns) == (s['size'], s['mtime_ns']):
+            continue
+        if (st.st_size != s['size']) or (file_sha1(os.path.join(positioning_dir, name)) != s['sha1']):
+            return False
+    return True
+
+
+def check_cache_dir(cache_dir):
+    # Web processes, workers and build_positioning_cache.py don't share a working directory, so a relative path would
+    # give each of them its own cache
+    if not os.path.isabs(cache_dir):
+        raise ValueError(f"Positioning cache directory {cache_dir} must be an absolute path (set POSITIONING_CACHE_DIR "
+                         f"to an absolute path, or to an empty string to disable the cache)")
+
+
+def manifest_path(cache_dir, dataset):
+    return os.path.join(cache_dir, f"{dataset}.json")
+
+
+def constant_value(values):
+    """ The single value of an object column, as something JSON can hold """
+    v = values[0]
+    if not all((x == v) or (x is None and v is None) for x in values):
+        raise ValueError("Only numeric or constant columns can be cached")
+    return v.item() if isinstance(v, np.generic) else v
+
+
+def build_positioning_cache(positioning_dir, dataset, cache_dir):
+    """ Load the flight lines of positioning_dir from the CSVs and write them to the cache. Returns the flight lines. """
+    sources = describe_sources(positioning_dir)
+    flight_lines = load_flight_lines(positioning_dir, dataset)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    key = hashlib.sha1(json.dumps([CACHE_FORMAT_VERSION, sources], sort_keys=True).encode()).hexdigest()[:16]
+    bin_name = f"{dataset}-{key}.bin"
+
+    flights = []
+    offset = 0
+    fd, tmp_bin = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        def write_array(a):
+            nonlocal offset
+            a = np.ascontiguousarray(a)
+            pad = (-offset) % ALIGNMENT
+            f.write(b'\0' * pad)
+            offset += pad
+            entry = {'dtype': a.dtype.str, 'offset': offset}
+            f.write(a.tobytes())
+            offset += a.nbytes
+            return entry
+
+        keys = []  # (key, index in flights) in the order of flight_lines
+        written = {}  # id(df) -> index in flights, since several keys can share a DataFrame
+        for flight_key, df in flight_lines.items():
+            if id(df) not in written:
+                columns = []
+                for name in df.columns:
+                    values = df[name].to_numpy()
+                    if values.dtype.kind in 'biuf':
+                        columns.append(dict(name=name, **write_array(values)))
+                    else:
+                        columns.append({'name': name, 'value': constant_value(values) if len(values) else None,
+                                        'dtype': values.dtype.str})
+                written[id(df)] = len(flights)
+                flights.append({'n_rows': len(df), 'index': write_array(df.index.to_numpy()), 'columns': columns})
+            keys.append([list(flight_key), written[id(df)]])
+    os.replace(tmp_bin, os.path.join(cache_dir, bin_name))
+
+    manifest = {'format_version': CACHE_FORMAT_VERSION, 'dataset': dataset, 'sources': sources,
+                'bin': bin_name, 'flights': flights, 'keys': keys}
+    fd, tmp_manifest = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_manifest, manifest_path(cache_dir, dataset))
+
+    # Remove older versions (processes that still have them mapped keep their copy until they exit)
+    for name in os.listdir(cache_dir):
+        if name.startswith(f"{dataset}-") and name.endswith('.bin') and (name != bin_name):
+            os.remove(os.path.join(cache_dir, name))
+
+    return flight_lines
+
+
+def read_positioning_cache(cache_dir, manifest):
+    data = np.memmap(os.path.join(cache_dir, manifest['bin']), dtype=np.uint8, mode='r')
+
+    def array(entry, n):
+        dtype = np.dtype(entry['dtype'])
+        return data[entry['offset']:entry['offset'] + n * dtype.itemsize].view(dtype)
+
+    dfs = []
+    for flight in manifest['flights']:
+        n = flight['n_rows']
+        columns = {}
+        for c in flight['columns']:
+            if 'offset' in c:
+                columns[c['name']] = array(c, n)
+            else:
+                columns[c['name']] = np.full(n, c['value'], dtype=np.dtype(c['dtype']))
+        dfs.append(pd.DataFrame(columns, index=array(flight['index'], n), copy=False))
+
+    return {tuple(key): dfs[i] for key, i in manifest['keys']}
+
+
+def load_cached_flight_lines(positioning_dir, dataset, cache_dir):
+    """
+    Same result as load_flight_lines(positioning_dir, dataset), from the cache in cache_dir if it is up to date
+    (otherwise it is rebuilt). Without a cache_dir, the CSVs are always loaded directly.
+    """
+    if not cache_dir:
+        return load_flight_lines(positioning_dir, dataset)
+    check_cache_dir(cache_dir)
+
+    try:
+        with open(manifest_path(cache_dir, dataset)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = None
+
+    if (manifest is not None) and (manifest.get('format_version') == CACHE_FORMAT_VERSION) and \
+            sources_match(positioning_dir, manifest['sources']):
+        try:
+            return read_positioning_cache(cache_dir, manifest)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Positioning cache for {dataset} couldn't be read ({e}), rebuilding it")
+
+    print(f"Building positioning cache for {dataset} in {cache_dir}")
+    return build_positioning_cache(positioning_dir, dataset, cache_dir)
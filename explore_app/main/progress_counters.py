@@ -0,0 +1,263 @@
+"""
+Per-flight labelling progress counters, kept up to date as segments change.
+
+For every (flight, raw_date) of each dataset, a Redis hash holds the number of non-junk segments, how many of them are
+verified, and how many aren't ESM scope (only flights with some non-ESM segments are listed on the stats page). The
+pseudo-dataset ALL_SEGMENTS holds the overall number of segments and verified segments, junk included. Every
+commit that changes segments adds the difference to these counters, so reading the current progress never touches the
+segment table:
+
+- ORM changes (the segment API, the CSV importers) are picked up from each flush by the session event listeners below.
+- Set-based updates (bulk_update_segments) add their own differences with add_deltas().
+
+Differences are only sent to Redis once the transaction commits. Anything that gets missed (Redis unavailable, a
+write that bypasses both of these paths) is fixed by the next full reconciliation, which recounts everything with a
+single GROUP BY query and replaces the counters.
+
+A recount must not overwrite a difference it doesn't include, nor include one that is added again afterwards. So every
+transaction that changes the counters is listed in the PENDING_KEY sorted set from its first flush until its
+difference has been applied, and the recount WATCHes both the counters and that set: it only counts while no
+transaction is pending, and its result is only written if nothing touched either key in the meantime.
+"""
+import time
+import uuid
+from collections import Counter
+
+import redis
+from sqlalchemy import event, func, case, inspect
+from sqlalchemy.orm import Session
+
+from worker import conn
+from .. import metrics
+from ..film_segment import FilmSegment
+
+KEY_PREFIX = 'rfs:progress:'
+COUNTERS = ['total', 'verified', 'listed']
+ALL_SEGMENTS = '*'
+RECONCILED_FIELD = 'reconciled_at'  # Time of the last full recount (also marks the counters as initialized)
+PENDING_KEY = 'rfs:progress-pending'  # Transactions whose differences haven't been applied yet, scored by start time
+PENDING_TIMEOUT = 2*60*60  # Entries older than this (longer than any bulk update job) were left by a crashed process
+RECONCILE_ATTEMPTS = 5
+
+# Columns that decide which counters a segment adds to
+COUNTED_COLUMNS = ['dataset', 'flight', 'raw_date', 'is_junk', 'is_verified', 'scope_type']
+
+
+def counter_field(flight, raw_date, counter):
+    return f"{'' if flight is None else flight}|{'' if raw_date is None else raw_date}|{counter}"
+
+
+def parse_counter_field(field):
+    # int(float()) also reads fields written as floats (like "5.0") before values were normalized
+    flight, raw_date, counter = field.split('|')
+    return (int(float(flight)) if flight else None), (int(float(raw_date)) if raw_date else None), counter
+
+
+def segment_counts(state):
+    """ {(dataset, flight, raw_date, counter): 1} for each counter a segment (dict of COUNTED_COLUMNS) adds to """
+    counts = {(ALL_SEGMENTS, None, None, 'total'): 1}
+    if state['is_verified'] is True:
+        counts[(ALL_SEGMENTS, None, None, 'verified')] = 1
+
+    if (state['dataset'] is None) or (state['is_junk'] is not False):
+        return counts
+
+    group = (state['dataset'], state['flight'], state['raw_date'])
+    counts[group + ('total',)] = 1
+    if state['is_verified'] is True:
+        counts[group + ('verified',)] = 1
+    if (state['scope_type'] is not None) and (state['scope_type'] != FilmSegment.ESM_SCOPE):
+        counts[group + ('listed',)] = 1
+    return counts
+
+
+def segment_delta(before, after):
+    """ Change in the counters when a segment changes from state before to state after (either may be None) """
+    delta = Counter()
+    if before is not None:
+        delta.subtract(segment_counts(before))
+    if after is not None:
+        delta.update(segment_counts(after))
+    return delta
+
+
+def add_deltas(session, delta):
+    """ Queue counter changes to be applied when session's transaction commits """
+    session.info.setdefault('progress_deltas', Counter()).update(delta)
+
+    # Hold off recounts until the changes are applied
+    if any(v != 0 for v in delta.values()) and ('progress_pending' not in session.info):
+        token = uuid.uuid4().hex
+        try:
+            conn.zadd(PENDING_KEY, {token: time.time()})
+            session.info['progress_pending'] = token
+        except redis.exceptions.RedisError:
+            pass
+
+
+def apply_deltas(delta, token=None):
+    """ Add delta to the counters, and remove token (of the transaction it came from) from the pending transactions """
+    delta = {k: v for k, v in delta.items() if v != 0}
+    if (not delta) and (token is None):
+        return
+    try:
+        pipe = conn.pipeline(transaction=True)
+        for (dataset, flight, raw_date, counter), v in delta.items():
+            pipe.hincrby(KEY_PREFIX + dataset, counter_field(flight, raw_date, counter), v)
+        if token is not None:
+            pipe.zrem(PENDING_KEY, token)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        metrics.incr('progress_counters.dropped')  # Fixed at the next reconciliation
+
+
+# ORM changes
+
+def counted_values(state):
+    """
+    state with plain Python values, as they will read back from the database. The CSV importers assign numpy and
+    pandas values (np.True_, or floats for integer columns), which would otherwise miss the flag checks in
+    segment_counts() and give the same group a second counter field.
+    """
+    state = dict(state)
+    for c in ['flight', 'raw_date']:
+        if state[c] is not None:
+            state[c] = int(state[c])
+    for c in ['is_junk', 'is_verified']:
+        if state[c] is not None:
+            state[c] = bool(state[c])
+    for c in ['dataset', 'scope_type']:
+        if state[c] is not None:
+            state[c] = str(state[c])
+    return state
+
+
+def instance_states(obj):
+    """ (before, after) values of COUNTED_COLUMNS for a flushed FilmSegment """
+    attrs = inspect(obj).attrs
+    before, after = {}, {}
+    for c in COUNTED_COLUMNS:
+        history = attrs[c].history
+        after[c] = getattr(obj, c)
+        if history.deleted:
+            before[c] = history.deleted[0]
+        elif history.unchanged:
+            before[c] = history.unchanged[0]
+        else:
+            before[c] = after[c]
+    return counted_values(before), counted_values(after)
+
+
+@event.listens_for(Session, 'after_flush')
+def record_flushed_changes(session, flush_context):
+    # The session's new/dirty/deleted collections and attribute histories still show what was just flushed
+    delta = Counter()
+    for obj in session.new:
+        if isinstance(obj, FilmSegment):
+            delta.update(segment_delta(None, instance_states(obj)[1]))
+    for obj in session.dirty:
+        if isinstance(obj, FilmSegment) and session.is_modified(obj):
+            delta.update(segment_delta(*instance_states(obj)))
+    for obj in session.deleted:
+        if isinstance(obj, FilmSegment):
+            delta.update(segment_delta(instance_states(obj)[0], None))
+    add_deltas(session, delta)
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_committed_changes(session):
+    delta = session.info.pop('progress_deltas', None)
+    token = session.info.pop('progress_pending', None)
+    if delta or token:
+        apply_deltas(delta or {}, token)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_rolled_back_changes(session):
+    session.info.pop('progress_deltas', None)
+    token = session.info.pop('progress_pending', None)
+    if token is not None:
+        apply_deltas({}, token)
+
+
+# Full recount
+
+def count_flight_progress(session, dataset):
+    """ [(flight, raw_date, total, verified, listed)] for dataset, counted from the segment table """
+    if dataset == ALL_SEGMENTS:
+        total, verified = session.query(
+            func.count(FilmSegment.id), func.sum(case((FilmSegment.is_verified == True, 1), else_=0))).one()
+        return [(None, None, total, verified or 0, 0)]
+
+    groups = session.query(
+        FilmSegment.flight, FilmSegment.raw_date,
+        func.count(FilmSegment.id),
+        func.sum(case((FilmSegment.is_verified == True, 1), else_=0)),
+        func.sum(case((FilmSegment.scope_type != FilmSegment.ESM_SCOPE, 1), else_=0))
+    ).filter(FilmSegment.dataset == dataset).filter(FilmSegment.is_junk == False).group_by(
+        FilmSegment.flight, FilmSegment.raw_date).all()
+    return [(fid, fdate, int(total), int(verified), int(listed)) for fid, fdate, total, verified, listed in groups]
+
+
+def progress_values(groups):
+    """ Contents of a dataset's counter hash for groups, as returned by count_flight_progress() """
+    values = {RECONCILED_FIELD: time.time()}
+    for fid, fdate, total, verified, listed in groups:
+        for counter, v in zip(COUNTERS, (total, verified, listed)):
+            values[counter_field(fid, fdate, counter)] = v
+    return values
+
+
+def reconcile_flight_progress(session, dataset, attempts=RECONCILE_ATTEMPTS):
+    """
+    Recount dataset from the segment table and replace its counters, as long as no transaction changes them while
+    counting (otherwise this retries, up to attempts times). Returns the recount.
+    """
+    key = KEY_PREFIX + dataset
+    for attempt in range(attempts):
+        if attempt > 0:
+            time.sleep(0.1 * 2**attempt)
+        try:
+            conn.zremrangebyscore(PENDING_KEY, 0, time.time() - PENDING_TIMEOUT)
+            with conn.pipeline() as pipe:
+                pipe.watch(key, PENDING_KEY)
+                if pipe.zcard(PENDING_KEY) > 0:  # Changes committed (or about to be) whose differences aren't applied
+                    continue
+
+                groups = count_flight_progress(session, dataset)
+
+                pipe.multi()
+                pipe.delete(key)
+                pipe.hset(key, mapping=progress_values(groups))
+                pipe.execute()
+                return groups
+        except redis.exceptions.WatchError:
+            continue
+        except redis.exceptions.RedisError:
+            break
+
+    metrics.incr('progress_counters.reconcile_skipped')  # Left as they are until the next reconciliation
+    return count_flight_progress(session, dataset)
+
+
+def load_flight_progress(dataset):
+    """
+    ([(flight, raw_date, total, verified, listed)], time of the last reconciliation) for dataset from the counters, or
+    (None, None) if there are no counters (never reconciled, or Redis can't be reached)
+    """
+    try:
+        values = conn.hgetall(KEY_PREFIX + dataset)
+    except redis.exceptions.RedisError:
+        return None, None
+    if RECONCILED_FIELD.encode() not in values:
+        return None, None
+
+    reconciled_at = float(values.pop(RECONCILED_FIELD.encode()))
+    groups = {}
+    for field, v in values.items():
+        fid, fdate, counter = parse_counter_field(field.decode())
+        groups.setdefault((fid, fdate), dict.fromkeys(COUNTERS, 0))[counter] += int(v)
+
+    groups = [(fid, fdate, c['total'], c['verified'], c['listed']) for (fid, fdate), c in groups.items()
+              if c['total'] > 0]
+    return groups, reconciled_at
@@ -0,0 +1,87 @@
+"""
+Polar stereographic projection (EPSG method 9829, "variant B": defined by a latitude of true scale) on an ellipsoid,
+in plain numpy, for projecting positioning data onto the Antarctic (EPSG:3031) and Arctic (EPSG:3413) maps without
+importing cartopy.
+
+Formulas are from Snyder, "Map Projections - A Working Manual" (USGS Professional Paper 1395, 1987), pp. 160-162,
+as also given in IOGP Guidance Note 7-2, section 3.2.2.
+"""
+import numpy as np
+
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+
+INVERSE_ITERATIONS = 15  # Fixed-point iterations for latitude in inverse(); converges to < 1e-15 rad well before this
+
+
+class PolarStereographic:
+    """
+    Polar stereographic projection with latitude of true scale lat_ts (degrees; negative for the south polar aspect),
+    central meridian lon_0 (degrees), and false easting/northing in metres.
+    """
+
+    def __init__(self, lat_ts, lon_0=0.0, false_easting=0.0, false_northing=0.0, a=WGS84_A, f=WGS84_F):
+        self.lat_ts = lat_ts
+        self.lon_0 = lon_0
+        self.false_easting = false_easting
+        self.false_northing = false_northing
+        self.a = a
+        self.e = np.sqrt(f * (2 - f))
+        self.south = lat_ts < 0
+
+        # Work in the north polar aspect; the south polar aspect is the same with the signs of the latitudes flipped
+        phi_c = np.radians(abs(lat_ts))
+        if abs(lat_ts) == 90:  # True scale at the pole
+            e = self.e
+            self.scale = 2 * a / np.sqrt((1 + e) ** (1 + e) * (1 - e) ** (1 - e))
+        else:
+            m_c = np.cos(phi_c) / np.sqrt(1 - (self.e * np.sin(phi_c)) ** 2)
+            self.scale = a * m_c / self.t(phi_c)
+
+    def t(self, phi):
+        e_sin = self.e * np.sin(phi)
+        return np.tan(np.pi / 4 - phi / 2) / ((1 - e_sin) / (1 + e_sin)) ** (self.e / 2)
+
+    def forward(self, lon, lat):
+        """ Projected (x, y) in metres of lon, lat (degrees, any array shape) """
+        lon = np.asarray(lon, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+
+        dlon = np.radians(lon - self.lon_0)
+        rho = self.scale * self.t(np.radians(-lat if self.south else lat))
+
+        x = rho * np.sin(dlon)
+        y = rho * np.cos(dlon) if self.south else -rho * np.cos(dlon)
+        return x + self.false_easting, y + self.false_northing
+
+    def inverse(self, x, y):
+        """ (lon, lat) in degrees of projected x, y (metres, any array shape). Longitudes are in [-180, 180). """
+        x = np.asarray(x, dtype=float) - self.false_easting
+        y = np.asarray(y, dtype=float) - self.false_northing
+
+        t = np.hypot(x, y) / self.scale
+        e = self.e
+        phi = np.pi / 2 - 2 * np.arctan(t)
+        for _ in range(INVERSE_ITERATIONS):
+            e_sin = e * np.sin(phi)
+            phi = np.pi / 2 - 2 * np.arctan(t * ((1 - e_sin) / (1 + e_sin)) ** (e / 2))
+
+        if self.south:
+            lat = -np.degrees(phi)
+            dlon = np.arctan2(x, y)
+        else:
+            lat = np.degrees(phi)
+            dlon = np.arctan2(x, -y)
+
+        lon = (self.lon_0 + np.degrees(dlon) + 180) % 360 - 180
+        return lon, lat
+
+
+# The projections of the two maps (same parameters as cartopy's Stereographic CRSs used for them before)
+EPSG_3031 = PolarStereographic(lat_ts=-71, lon_0=0)  # Antarctic Polar Stereographic
+EPSG_3413 = PolarStereographic(lat_ts=70, lon_0=-45)  # NSIDC Sea Ice Polar Stereographic North
+
+DATASET_PROJECTIONS = {
+    'antarctica': EPSG_3031,
+    'greenland': EPSG_3413
+}
@@ -15,32 +15,63 @@ import time
 from explore_app.film_segment import FilmSegment
 
 from explore_app.main.map import make_bokeh_map
+from explore_app.main.progress_counters import reconcile_flight_progress, load_flight_progress, ALL_SEGMENTS
 
 from flask import current_app as app
 from flask import g
-from sqlalchemy import and_
 
 flight_progress_stats = {'greenland': {}, 'antarctica': {}}
 
-def update_flight_progress_stats(session):
-    update_flight_progress_stats_dataset(session, 'antarctica', 'Antarctica ')
-    update_flight_progress_stats_dataset(session, 'greenland', 'Greenland ', separate_by_date=True)
+# Name prefix, and whether flights are listed separately for each date
+flight_progress_datasets = {
+    'antarctica': ('Antarctica ', False),
+    'greenland': ('Greenland ', True)
+}
 
-def update_flight_progress_stats_dataset(session, dataset, flight_name_prefix, separate_by_date=False):
+def update_flight_progress_stats(session):
+    """ Recount the progress of every flight from the database, replacing the progress counters """
+    for dataset in list(flight_progress_datasets) + [ALL_SEGMENTS]:
+        groups = reconcile_flight_progress(session, dataset)
+        if dataset in flight_progress_datasets:
+            update_flight_progress_stats_dataset(dataset, groups)
+
+def load_progress_groups(session, dataset):
+    groups, _ = load_flight_progress(dataset)
+    if groups is None:  # No counters yet
+        groups = reconcile_flight_progress(session, dataset)
+    return groups
+
+def load_flight_progress_stats(session):
+    """ Current progress of every flight from the progress counters (recounted if there aren't any yet) """
+    for dataset in flight_progress_datasets:
+        update_flight_progress_stats_dataset(dataset, load_progress_groups(session, dataset))
+
+def load_overall_progress(session):
+    """ (number of verified segments, total number of segments), from the progress counters """
+    groups = load_progress_groups(session, ALL_SEGMENTS)
+    if not groups:
+        return 0, 0
+    _, _, total, verified, _ = groups[0]
+    return verified, total
+
+def update_flight_progress_stats_dataset(dataset, groups):
+    # groups holds the total and verified (non-junk) counts for every flight and date. Flights are listed if they have
+    # any non-ESM segments, but the counts include all scope types.
+    flight_name_prefix, separate_by_date = flight_progress_datasets[dataset]
+    groups = sorted(groups, key=lambda x: (x[0] is None, x[0] or 0, x[1] is None, x[1] or 0))
+
+    counts = {(fid, fdate): (total, verified) for fid, fdate, total, verified, _ in groups}
     if separate_by_date:
-        distinct_flights = FilmSegment.query.filter(FilmSegment.dataset == dataset).filter(FilmSegment.is_junk == False).filter(FilmSegment.scope_type != FilmSegment.ESM_SCOPE).with_entities(FilmSegment.flight, FilmSegment.raw_date).distinct().all()
+        distinct_flights = [(fid, fdate) for fid, fdate, _, _, n_listed in groups if n_listed > 0]
     else:
-        distinct_flights = FilmSegment.query.filter(FilmSegment.dataset == dataset).filter(FilmSegment.is_junk == False).filter(FilmSegment.scope_type != FilmSegment.ESM_SCOPE).with_entities(FilmSegment.flight).distinct().all()
-        distinct_flights = [(x[0], None) for x in distinct_flights]
+        # Not separated by date, so only the segments without a date are counted
+        distinct_flights = list(dict.fromkeys((fid, None) for fid, _, _, _, n_listed in groups if n_listed > 0))
 
     verified_list = []
     unverified_list = []
     total_list = []
     for fid, fdate in distinct_flights:
-        q = FilmSegment.query.filter(and_(FilmSegment.flight == fid, FilmSegment.raw_date == fdate,
-                                            FilmSegment.dataset == dataset, FilmSegment.is_junk == False))
-        count_verified = q.filter(FilmSegment.is_verified == True).count()
-        count_total = q.count()
+        count_total, count_verified = counts.get((fid, fdate), (0, 0))
 
         verified_list.append(count_verified)
         total_list.append(count_total)
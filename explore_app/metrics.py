@@ -0,0 +1,68 @@
+"""
+Simple counters and timers shared by the web and worker processes.
+
+Values are kept in a Redis hash (using the same connection as the job queue) so that every gunicorn worker and every
+RQ worker adds to the same numbers. If Redis can't be reached, values are kept in a per-process dict instead so that
+collecting metrics never breaks a request.
+"""
+import time
+from collections import defaultdict
+
+import redis
+
+from worker import conn
+
+METRICS_KEY = 'rfs:metrics'
+
+local_metrics = defaultdict(float)
+
+
+def incr(name, amount=1):
+    try:
+        conn.hincrbyfloat(METRICS_KEY, name, amount)
+    except redis.exceptions.RedisError:
+        local_metrics[name] += amount
+
+
+def observe(name, seconds, size=None):
+    """ Record one timed event (and optionally its size in bytes) under name """
+    values = {f"{name}.count": 1, f"{name}.seconds": seconds}
+    if size is not None:
+        values[f"{name}.bytes"] = size
+
+    try:
+        pipe = conn.pipeline(transaction=False)
+        for k, v in values.items():
+            pipe.hincrbyfloat(METRICS_KEY, k, v)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        for k, v in values.items():
+            local_metrics[k] += v
+
+
+class timed:
+    """ Context manager version of observe() """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t_start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        observe(self.name, time.time() - self.t_start)
+
+
+def get_metrics(prefix=''):
+    metrics = dict(local_metrics)
+    try:
+        shared = conn.hgetall(METRICS_KEY)
+    except redis.exceptions.RedisError:
+        shared = {}
+
+    for k, v in shared.items():
+        k = k.decode()
+        metrics[k] = metrics.get(k, 0) + float(v)
+
+    return {k: v for k, v in sorted(metrics.items()) if k.startswith(prefix)}
@@ -0,0 +1,84 @@
+"""
+Leader election for the periodic APScheduler jobs.
+
+scheduler.start() runs in every web process (each gunicorn worker of each dyno), so without coordination every
+process runs its own copy of each job. Jobs wrapped with leader_only() first take a lease on the job, a Redis key
+(on the same connection as the job queue) holding the id of the process that owns it. The owner renews the lease each
+time it runs the job. Every other process finds the lease held and skips its run. If the owner goes away, its lease
+expires and the next process to try takes over, which is counted as a handoff.
+
+Jobs that clean up something local to a machine (like the local artifact store) take a lease per host instead, so
+exactly one process on each machine runs them.
+
+If Redis can't be reached, jobs run in every process as they would without leases. Jobs must be safe to run
+concurrently anyway, since a lease can expire while its owner is still running the job.
+"""
+import os
+import socket
+import functools
+
+import redis
+
+from worker import conn
+from . import metrics, scheduler
+
+LEASE_PREFIX = 'rfs:lease:'
+LEASE_TTL_FACTOR = 1.5  # Leases last this many job intervals, so the owner renews them before they expire
+
+
+def process_id():
+    # Read each time, since gunicorn forks workers after the app is imported
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def acquire_lease(key, owner, ttl):
+    """
+    Take or renew the lease key for owner for ttl seconds. Returns (True if owner holds the lease, True if the lease
+    was just taken over from a different owner).
+    """
+    with conn.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            current = pipe.get(key)
+            if (current is not None) and (current.decode() != owner):
+                return False, False
+            previous = pipe.get(key + ':owner')  # Last owner, kept after the lease expires
+
+            pipe.multi()
+            pipe.set(key, owner, px=int(1000 * ttl))
+            pipe.set(key + ':owner', owner)
+            pipe.execute()
+        except redis.exceptions.WatchError:  # Another process took the lease first
+            return False, False
+
+    handoff = (current is None) and (previous is not None) and (previous.decode() != owner)
+    return True, handoff
+
+
+def leader_only(name, interval, per_host=False):
+    """
+    Decorator for a job scheduled every interval seconds, so that it only runs in the process holding its lease
+    (one process cluster-wide, or one per host if per_host is set). Records the job's duration in the
+    scheduler.<name> metrics and lease takeovers in scheduler.<name>.handoff.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if scheduler.app.config['SCHEDULER_LEADER_ELECTION']:
+                key = LEASE_PREFIX + name + ((':' + socket.gethostname()) if per_host else '')
+                try:
+                    is_leader, handoff = acquire_lease(key, process_id(), LEASE_TTL_FACTOR * interval)
+                except redis.exceptions.RedisError:
+                    is_leader, handoff = True, False
+                    metrics.incr(f'scheduler.{name}.lease_error')
+
+                if not is_leader:
+                    return None
+                if handoff:
+                    print(f"Took over the {name} lease")
+                    metrics.incr(f'scheduler.{name}.handoff')
+
+            with metrics.timed(f'scheduler.{name}'):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,35 @@
+import os
+import time
+import argparse
+
+from explore_app import create_app
+
+app = create_app()
+app.app_context().push()
+
+from explore_app.api.api_routes import FILTER_SPEC_ARGS, ordered_query, flight_lines
+from explore_app.api.export import EXPORT_FORMATS, write_export
+
+
+if __name__ == "__main__":
+    # Export segment metadata (with start/end positions) matching a query to a Parquet or Arrow IPC file.
+    # Filter arguments are the same as for /query and /api/query. Example:
+    #   python export_segments.py antarctica_flight37.parquet --dataset antarctica --flight 37 --sort cbd
+
+    parser = argparse.ArgumentParser(description="Export segment metadata to a Parquet or Arrow IPC file")
+    parser.add_argument('output', type=str, help="Output file (format is chosen by the .parquet or .arrow extension)")
+    parser.add_argument('--format', type=str, default=None, choices=list(EXPORT_FORMATS), help="Override output format")
+    parser.add_argument('--row_group_size', type=int, default=app.config['EXPORT_ROW_GROUP_SIZE'], help="Rows per row group")
+    for arg in FILTER_SPEC_ARGS:
+        parser.add_argument(f'--{arg}', type=str, default=None, help=f"Query filter ({arg})")
+    args = parser.parse_args()
+
+    fmt = args.format or os.path.splitext(args.output)[1].lstrip('.')
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {fmt} - use --format or one of the extensions {list(EXPORT_FORMATS)}")
+
+    filter_spec = {k: getattr(args, k) for k in FILTER_SPEC_ARGS if getattr(args, k)}
+
+    t_start = time.time()
+    n_rows = write_export(ordered_query(filter_spec), flight_lines, args.output, fmt, args.row_group_size)
+    print(f"Exported {n_rows} segments to {args.output} in {time.time() - t_start:.1f} seconds")
@@ -0,0 +1,48 @@
+"""indexes for segment query patterns
+
+Revision ID: 5c1f3e9a7b2d
+Revises: b843fc84bb11
+Create Date: 2026-10-18 09:12:44.518203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1f3e9a7b2d'
+down_revision = 'b843fc84bb11'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Next/previous segment lookups (by frame within a reel, by CBD within a flight)
+    op.create_index('ix_film_segment_reel_scope_frame', 'film_segment', ['reel', 'scope_type', 'first_frame'], unique=False)
+    op.create_index('ix_film_segment_flight_scope_cbd', 'film_segment', ['flight', 'scope_type', 'first_cbd'], unique=False)
+
+    # Flight pages, CBD plots (which match on the year, raw_date % 100), and progress stats
+    op.create_index('ix_film_segment_dataset_flight_date', 'film_segment', ['dataset', 'flight', 'raw_date'], unique=False)
+    op.create_index('ix_film_segment_dataset_flight_year', 'film_segment', ['dataset', 'flight', sa.text('(raw_date % 100)')], unique=False)
+
+    # Keyset pagination of query results
+    op.create_index('ix_film_segment_cbd_id', 'film_segment', ['first_cbd', 'id'], unique=False)
+    op.create_index('ix_film_segment_frame_id', 'film_segment', ['first_frame', 'id'], unique=False)
+
+    # Exact path lookups already use the unique constraint on path. The importers' substring matches
+    # (path.contains(...), i.e. LIKE '%...%') need a trigram index, which only PostgreSQL has.
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        op.create_index('ix_film_segment_path_trgm', 'film_segment', ['path'], unique=False,
+                        postgresql_using='gin', postgresql_ops={'path': 'gin_trgm_ops'})
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_film_segment_path_trgm', table_name='film_segment')
+    op.drop_index('ix_film_segment_frame_id', table_name='film_segment')
+    op.drop_index('ix_film_segment_cbd_id', table_name='film_segment')
+    op.drop_index('ix_film_segment_dataset_flight_year', table_name='film_segment')
+    op.drop_index('ix_film_segment_dataset_flight_date', table_name='film_segment')
+    op.drop_index('ix_film_segment_flight_scope_cbd', table_name='film_segment')
+    op.drop_index('ix_film_segment_reel_scope_frame', table_name='film_segment')